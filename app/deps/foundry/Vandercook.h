@@ -11,6 +11,7 @@
 @interface Vandercook : NSObject
 + (NSDictionary *)aatAttributes:(NSDictionary *)options;
 + (NSBezierPath *)traceGlyphs:(NSRange)glyph_range atOffset:(NSPoint)offset withLayout:(NSLayoutManager *)layout;
++ (NSBezierPath *)traceGlyphs:(NSRange)glyph_range atOffset:(NSPoint)offset withLayout:(NSLayoutManager *)layout cache:(NSCache *)cache;
 + (NSArray *)lineFragmentsInRange:(NSRange)char_range withLayout:(NSLayoutManager *)layout;
 + (NSArray *)textContainersInRange:(NSRange)rng withLayout:(NSLayoutManager *)layout;
 @end
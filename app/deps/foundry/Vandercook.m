@@ -78,6 +78,10 @@ static NSDictionary *AAT;
 
 
 + (NSBezierPath *)traceGlyphs:(NSRange)rng atOffset:(NSPoint)offset withLayout:(NSLayoutManager *)layout{
+    return [self traceGlyphs:rng atOffset:offset withLayout:layout cache:nil];
+}
+
++ (NSBezierPath *)traceGlyphs:(NSRange)rng atOffset:(NSPoint)offset withLayout:(NSLayoutManager *)layout cache:(NSCache *)cache{
     NSRange glyph_range = [layout glyphRangeForCharacterRange:rng actualCharacterRange:NULL];
 
     NSBezierPath *path = [NSBezierPath bezierPath];
@@ -95,14 +99,25 @@ static NSDictionary *AAT;
         glyph_pt.x += line_rect.origin.x + offset.x;
         glyph_pt.y += line_rect.origin.y + offset.y;
         glyph_pt.y *= -1;
-        [path moveToPoint:glyph_pt];
 
-        // add the glyph to the path
+        // look up the glyph's outline (tracing it at the origin if it isn't already cached)
         NSUInteger txt_idx = [layout characterIndexForGlyphAtIndex:glyph_idx];
         NSFont *font = [store attribute:@"NSFont" atIndex:txt_idx effectiveRange:nil];
         NSGlyph glyph = [layout glyphAtIndex:glyph_idx];
-        [path appendBezierPathWithGlyph:glyph inFont:font];
-        [path closePath];
+        NSString *key = [NSString stringWithFormat:@"%@ %u %f", font.fontName, glyph, font.pointSize];
+        NSBezierPath *outline = [cache objectForKey:key];
+        if (!outline){
+            outline = [NSBezierPath bezierPath];
+            [outline moveToPoint:NSZeroPoint];
+            [outline appendBezierPathWithGlyph:glyph inFont:font];
+            [outline closePath];
+            [cache setObject:outline forKey:key cost:outline.elementCount * 3 * sizeof(NSPoint)];
+        }
+
+        // add it to the path in its laid-out position
+        NSAffineTransform *shift = [NSAffineTransform transform];
+        [shift translateXBy:glyph_pt.x yBy:glyph_pt.y];
+        [path appendBezierPath:[shift transformBezierPath:outline]];
     }
 
     return path;
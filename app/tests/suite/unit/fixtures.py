@@ -0,0 +1,62 @@
+# encoding: utf-8
+"""Helpers shared by the unit tests (imported as a top-level module since the tests are run
+either as scripts or via `python -m unittest discover` from this directory)"""
+import os
+import zlib
+import struct
+
+ICON = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../icon.png')
+
+def xml_document(paras=200):
+    """An xml string of `paras` paragraphs with nested tags, self-closed tags, and entities
+
+    The paragraphs are separated by single & double newlines (plus ones followed by a &flush;
+    entity suppressing the next paragraph's indent).
+    """
+    grafs = []
+    for i in range(paras):
+        grafs.append(u'<p>para %i has <b>bold</b> and <i>italic <b>nested</b></i> bits<br/>\n'
+                     u'with a second line, some é accents, &amp; an entity</p>%s'
+                     % (i, u'\n\n' if i%3 else u'\n&flush;'))
+    return u'<doc>%s</doc>' % u''.join(grafs)
+
+def read_chunks(data):
+    """Split a png file into a {chunk-tag:[data, ...]} dict (checking each chunk's crc)"""
+    assert data[:8] == '\x89PNG\r\n\x1a\n'
+    pos, chunks = 8, {}
+    while pos < len(data):
+        length, = struct.unpack('>I', data[pos:pos+4])
+        tag, body = data[pos+4:pos+8], data[pos+8:pos+8+length]
+        crc, = struct.unpack('>I', data[pos+8+length:pos+12+length])
+        assert crc == zlib.crc32(tag+body) & 0xffffffff, 'bad crc in %s chunk' % tag
+        chunks.setdefault(tag, []).append(body)
+        pos += 12 + length
+    return chunks
+
+def read_png(data):
+    """Decode an 8-bit RGB(A) png into a (pixels, chunks) tuple"""
+    import numpy as np
+    chunks = read_chunks(data)
+    w, h, depth, color = struct.unpack('>IIBB', chunks['IHDR'][0][:10])
+    bpp = 4 if color==6 else 3
+    raw = np.frombuffer(zlib.decompress(''.join(chunks['IDAT'])), dtype=np.uint8).reshape(h, w*bpp+1)
+
+    # undo the filters one row at a time (the slow but obvious way)
+    rows = np.zeros((h, w*bpp), dtype=np.int32)
+    for y in range(h):
+        kind, line = raw[y, 0], raw[y, 1:].astype(np.int32)
+        up = rows[y-1] if y else np.zeros(w*bpp, dtype=np.int32)
+        for i in range(w*bpp):
+            a = rows[y, i-bpp] if i >= bpp else 0
+            b = up[i]
+            c = up[i-bpp] if i >= bpp else 0
+            if kind == 0: pred = 0
+            elif kind == 1: pred = a
+            elif kind == 2: pred = b
+            elif kind == 3: pred = (a + b) >> 1
+            else:
+                p = a + b - c
+                pa, pb, pc = abs(p-a), abs(p-b), abs(p-c)
+                pred = a if pa <= pb and pa <= pc else b if pb <= pc else c
+            rows[y, i] = (line[i] + pred) & 0xff
+    return rows.astype(np.uint8).reshape(h, w, bpp), chunks
@@ -0,0 +1,92 @@
+# encoding: utf-8
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../../..'))
+
+from plotdevice.util.disk import atomic_write, unlink, DiskQuota
+
+class AtomicWriteTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'entry')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_file_appears_once_complete(self):
+        with atomic_write(self.path) as f:
+            f.write('partial')
+            self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(open(self.path).read(), 'partial')
+        self.assertEqual(os.listdir(self.tmpdir), ['entry'])
+
+    def test_errors_leave_nothing_behind(self):
+        with atomic_write(self.path) as f:
+            f.write('old')
+        with self.assertRaises(ValueError):
+            with atomic_write(self.path) as f:
+                f.write('new')
+                raise ValueError()
+        self.assertEqual(open(self.path).read(), 'old')
+        self.assertEqual(os.listdir(self.tmpdir), ['entry'])
+
+    def test_unlink_missing_file(self):
+        unlink(self.path) # shouldn't raise
+
+class DiskQuotaTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.quota = DiskQuota(self.tmpdir, 1000, ('.meta', '.body'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def entry(self, stem, used, body=190, meta=10):
+        # write a .meta/.body pair last used `used` seconds ago
+        for ext, size in ('.meta', meta), ('.body', body):
+            path = os.path.join(self.tmpdir, stem+ext)
+            with open(path, 'wb') as f:
+                f.write('x' * size)
+            os.utime(path, (time.time()-used,)*2)
+        self.quota.add(body+meta)
+
+    def stems(self):
+        return sorted(set(os.path.splitext(name)[0] for name in os.listdir(self.tmpdir)))
+
+    def test_least_recently_used_entries_are_deleted(self):
+        for i in range(5):
+            self.entry('e%i' % i, used=100-i)
+        self.assertEqual(self.stems(), ['e0', 'e1', 'e2', 'e3', 'e4'])
+        self.entry('e5', used=0)
+        self.assertEqual(self.stems(), ['e2', 'e3', 'e4', 'e5']) # (down to 90% of capacity)
+        self.assertEqual(self.quota.usage, 800)
+
+    def test_recency_is_the_latest_of_an_entrys_files(self):
+        for i in range(5):
+            self.entry('e%i' % i, used=100-i)
+        os.utime(os.path.join(self.tmpdir, 'e0.meta'), None) # e.g., a revalidated response
+        self.entry('e5', used=0)
+        self.assertEqual(self.stems(), ['e0', 'e3', 'e4', 'e5'])
+
+    def test_other_files_are_ignored(self):
+        with open(os.path.join(self.tmpdir, 'notes.txt'), 'wb') as f:
+            f.write('x' * 5000)
+        self.entry('e0', used=0)
+        self.quota.prune()
+        self.assertEqual(self.quota.usage, 200)
+        self.assertIn('notes.txt', os.listdir(self.tmpdir))
+
+    def test_usage_is_rescanned(self):
+        self.entry('e0', used=0)
+        self.quota.prune()
+        other = DiskQuota(self.tmpdir, 1000, ('.meta', '.body')) # (e.g., in another process)
+        self.assertIsNone(other.usage)
+        other.add(0)
+        self.assertEqual(other.usage, 200)
+
+if __name__ == '__main__':
+    unittest.main()
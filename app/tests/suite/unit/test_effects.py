@@ -0,0 +1,54 @@
+# encoding: utf-8
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../../..'))
+
+import plotdevice
+from plotdevice.gfx import Image
+from plotdevice.gfx.effects import MaskCache
+from fixtures import ICON
+
+ctx = plotdevice.ctx
+
+class MaskCacheTests(unittest.TestCase):
+    def setUp(self):
+        ctx._resetContext()
+        self.masks = MaskCache()
+        self.img = Image(ICON)
+
+    def test_masks_are_reused(self):
+        mask = self.masks.get(self.img, 'alpha', False)
+        self.assertIs(self.masks.get(self.img, 'alpha', False), mask)
+        self.assertIs(self.masks.get(Image(ICON), 'alpha', False), mask) # (same NSImage)
+        self.assertEqual(len(self.masks._entries), 1)
+
+    def test_keys(self):
+        alpha = self.masks.get(self.img, 'alpha', False)
+        self.assertIsNot(self.masks.get(self.img, 'alpha', True), alpha)
+        self.assertIsNot(self.masks.get(self.img, 'red', False), alpha)
+        self.assertIsNot(self.masks.get(Image(ICON, width=64), 'alpha', False), alpha)
+        self.assertEqual(len(self.masks._entries), 4)
+
+    def test_prefetched_masks(self):
+        self.masks.prefetch(self.img, 'alpha', False)
+        mask = self.masks.get(self.img, 'alpha', False) # (waits for the background render)
+        self.assertEqual(len(self.masks._entries), 1)
+        self.assertEqual(self.masks._pending, {})
+        self.assertIs(self.masks.get(self.img, 'alpha', False), mask)
+
+    def test_mutable_images_are_not_cached(self):
+        self.img.pixels # (switches the image to a private, writable bitmap)
+        self.masks.prefetch(self.img, 'alpha', False)
+        self.assertIsNotNone(self.masks.get(self.img, 'alpha', False))
+        self.assertEqual(len(self.masks._entries), 0)
+
+    def test_budget(self):
+        self.masks.budget = 1
+        self.masks.get(self.img, 'alpha', False)
+        latest = self.masks.get(self.img, 'red', False)
+        self.assertEqual(len(self.masks._entries), 1) # (the most recent is always kept)
+        self.assertIs(self.masks.get(self.img, 'red', False), latest)
+
+if __name__ == '__main__':
+    unittest.main()
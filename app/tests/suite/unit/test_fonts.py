@@ -0,0 +1,142 @@
+# encoding: utf-8
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../../..'))
+
+from plotdevice.lib import foundry
+
+class Unlisted(object):
+    # stands in for the NSFontManager when the fonts shouldn't need to be enumerated
+    def __getattr__(self, name):
+        raise AssertionError('%s called' % name)
+
+class LibrarianTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fonts = os.path.join(self.tmpdir, 'Fonts')
+        os.mkdir(self.fonts)
+        self.index = os.path.join(self.tmpdir, 'cache', 'fonts.json')
+        self.font_dirs, self.fm = foundry.FONT_DIRS, foundry._fm
+        foundry.FONT_DIRS = (self.fonts, os.path.join(self.tmpdir, 'missing'))
+
+    def tearDown(self):
+        foundry.FONT_DIRS, foundry._fm = self.font_dirs, self.fm
+        shutil.rmtree(self.tmpdir)
+
+    def install(self, mtime):
+        # simulate a font being added to the folder
+        os.utime(self.fonts, (mtime, mtime))
+
+    def saved(self):
+        lib = foundry.Librarian(self.index)
+        lib.parent_fam('Helvetica')
+        lib._save()
+        return lib
+
+    def test_fingerprint_tracks_the_font_folders(self):
+        self.install(1000)
+        first = foundry.fonts_fingerprint()
+        self.assertEqual(foundry.fonts_fingerprint(), first)
+        self.install(2000)
+        self.assertNotEqual(foundry.fonts_fingerprint(), first)
+
+    def test_index_is_written(self):
+        lib = self.saved()
+        with open(self.index) as f:
+            index = json.load(f)
+        self.assertEqual(index['fingerprint'], foundry.fonts_fingerprint())
+        self.assertEqual(index['fonts'], lib.font_names)
+        self.assertEqual(index['parents'], {'Helvetica':'Helvetica'})
+
+    def test_matching_index_skips_enumeration(self):
+        lib = self.saved()
+        foundry._fm = Unlisted()
+        reloaded = foundry.Librarian(self.index)
+        self.assertEqual(reloaded.font_names, lib.font_names)
+        self.assertEqual(reloaded.fam_names, lib.fam_names)
+        self.assertEqual(reloaded.parent_fam('Helvetica'), 'Helvetica')
+        self.assertFalse(reloaded._dirty)
+
+    def test_stale_index_is_ignored(self):
+        self.install(1000)
+        self.saved()
+        self.install(2000)
+        lib = foundry.Librarian(self.index)
+        self.assertTrue(lib._dirty)
+        self.assertEqual(lib._parents, {})
+
+    def test_refresh_checks_the_fingerprint(self):
+        self.install(1000)
+        lib = self.saved()
+        foundry._fm = Unlisted()
+        lib._checked = 0
+        lib.refresh() # (unchanged, so nothing is listed)
+
+        foundry._fm = self.fm
+        self.install(2000)
+        lib.refresh() # (throttled)
+        self.assertEqual(lib._parents, {'Helvetica':'Helvetica'})
+        lib._checked = 0
+        lib.refresh()
+        self.assertEqual(lib._fingerprint, foundry.fonts_fingerprint())
+        self.assertEqual(lib._parents, {})
+
+FAMILIES = ['Helvetica', 'Helvetica Neue', 'Minion Pro', 'Adobe Garamond Pro', 'Gill Sans MT',
+            'Gill Sans', 'Myriad Std', 'Times New Roman', 'Times']
+
+def linear_find(fams, word):
+    # the scan over the whole family list that FamilyIndex replaces
+    if word in fams:
+        return word
+    q = foundry.sanitized(word)
+    corpus = foundry.sanitized(fams)
+    if q in corpus:
+        return fams[corpus.index(q)]
+    elif q:
+        corpus = foundry.debranded(fams, keep=foundry.branding(word))
+        if word in corpus:
+            return fams[corpus.index(word)]
+        elif q in foundry.sanitized(corpus):
+            return fams[foundry.sanitized(corpus).index(q)]
+
+class FamilyIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.index = foundry.FamilyIndex(FAMILIES)
+
+    def test_exact_names(self):
+        for fam in FAMILIES:
+            self.assertEqual(self.index.find(fam), fam)
+
+    def test_case_and_whitespace(self):
+        self.assertEqual(self.index.find('HELVETICA-NEUE'), 'Helvetica Neue')
+        self.assertEqual(self.index.find('gill sans mt'), 'Gill Sans MT')
+        self.assertEqual(self.index.find('timesnewroman'), 'Times New Roman')
+
+    def test_branding(self):
+        self.assertEqual(self.index.find('Minion'), 'Minion Pro')
+        self.assertEqual(self.index.find('garamond'), 'Adobe Garamond Pro')
+        self.assertEqual(self.index.find('Myriad'), 'Myriad Std')
+        self.assertEqual(self.index.find('Gill Sans'), 'Gill Sans') # (exact matches come first)
+
+    def test_no_match(self):
+        self.assertIsNone(self.index.find('Comic Sans'))
+        self.assertIsNone(self.index.find(''))
+
+    def test_matches_the_linear_scan(self):
+        queries = ['Helvetica', 'helvetica neue', 'Minion', 'MINION PRO', 'Adobe Garamond',
+                   'Garamond Pro', 'Myriad Pro', 'myriad', 'Gill', 'Gill Sans Std', 'Times MT',
+                   'Times Std', 'times', 'Roman', 'Helvetica Pro']
+        for word in queries:
+            self.assertEqual(self.index.find(word), linear_find(FAMILIES, word), word)
+
+    def test_suggestions(self):
+        self.assertEqual(self.index.suggest('Helvetca')[0], 'Helvetica')
+        self.assertEqual(self.index.suggest('Gil Sans', count=2), ['Gill Sans', 'Gill Sans MT'])
+        self.assertEqual(len(self.index.suggest('xyzzy')), 4) # (falls back to ranking everything)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,219 @@
+# encoding: utf-8
+import os
+import sys
+import struct
+import shutil
+import tempfile
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../../..'))
+
+from plotdevice.util.gif import GifWriter, quantize, lzw_encode
+
+def lzw_decode(block, min_code_size):
+    # a by-the-book gif decoder for checking lzw_encode's output
+    clear, eoi = 1 << min_code_size, (1 << min_code_size) + 1
+    data = bytearray(block)
+    acc = nbits = pos = 0
+    width, table, prev, out = min_code_size+1, None, None, []
+    while True:
+        while nbits < width:
+            acc |= data[pos] << nbits
+            pos, nbits = pos+1, nbits+8
+        code = acc & ((1 << width) - 1)
+        acc, nbits = acc >> width, nbits - width
+
+        if code == clear:
+            table = [[c] for c in range(clear)] + [None, None]
+            width, prev = min_code_size+1, None
+            continue
+        if code == eoi:
+            return out
+
+        if prev is None:
+            entry = table[code]
+        else:
+            if code < len(table):
+                entry = table[code]
+            else:
+                entry = table[prev] + [table[prev][0]]
+            if len(table) < 4096:
+                table.append(table[prev] + [entry[0]])
+            if len(table) == (1 << width) and width < 12:
+                width += 1
+        out.extend(entry)
+        prev = code
+
+def sub_blocks(data, pos):
+    # concatenate the length-prefixed sub-blocks starting at pos
+    chunks = []
+    while True:
+        n = ord(data[pos])
+        pos += 1
+        if not n:
+            return ''.join(chunks), pos
+        chunks.append(data[pos:pos+n])
+        pos += n
+
+def read_gif(path):
+    """Decode a gif into a list of (rgba, delay, rect) tuples (plus the netscape loop count)"""
+    data = open(path, 'rb').read()
+    assert data[:6] == 'GIF89a'
+    w, h, flags = struct.unpack('<HHB', data[6:11])
+    pos, palette = 13, None
+    if flags & 0x80:
+        n = 2 << (flags & 7)
+        palette = np.frombuffer(data[pos:pos+3*n], dtype=np.uint8).reshape(-1, 3)
+        pos += 3*n
+
+    screen = np.zeros((h, w, 4), dtype=np.uint8)
+    frames, loop, gce = [], None, (0, 0, None)
+    while data[pos] != ';':
+        if data[pos] == '!':
+            label = data[pos+1]
+            ext, pos = sub_blocks(data, pos+2)
+            if label == '\xf9':
+                packed, delay, idx = struct.unpack('<BHB', ext[:4])
+                gce = ((packed >> 2) & 7, delay, idx if packed & 1 else None)
+            elif label == '\xff' and ext.startswith('NETSCAPE2.0'):
+                loop = struct.unpack('<H', ext[12:14])[0]
+        else:
+            assert data[pos] == ','
+            x, y, fw, fh, fl = struct.unpack('<HHHHB', data[pos+1:pos+10])
+            pos, table = pos+10, palette
+            if fl & 0x80:
+                n = 2 << (fl & 7)
+                table = np.frombuffer(data[pos:pos+3*n], dtype=np.uint8).reshape(-1, 3)
+                pos += 3*n
+            min_code_size = ord(data[pos])
+            block, pos = sub_blocks(data, pos+1)
+            indices = np.array(lzw_decode(block, min_code_size)[:fw*fh]).reshape(fh, fw)
+
+            disposal, delay, transparent = gce
+            drawn = indices != transparent
+            region = screen[y:y+fh, x:x+fw]
+            region[drawn, :3] = table[indices[drawn]]
+            region[drawn, 3] = 255
+            frames.append((screen.copy(), delay, (x, y, fw, fh)))
+            if disposal == 2:
+                region[:] = 0
+            gce = (0, 0, None)
+    return frames, loop
+
+def visible(rgba):
+    # zero out the color of transparent pixels (which gifs don't preserve)
+    rgba = rgba.copy()
+    rgba[rgba[..., 3] == 0] = 0
+    return rgba
+
+class GifTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'anim.gif')
+        self.rand = np.random.RandomState(1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def frame(self, colors=16, size=(24, 32)):
+        # an opaque frame with a limited palette (so quantization is lossless)
+        palette = self.rand.randint(0, 256, (colors, 3)).astype(np.uint8)
+        rgba = np.empty(size + (4,), dtype=np.uint8)
+        rgba[..., :3] = palette[self.rand.randint(0, colors, size)]
+        rgba[..., 3] = 255
+        return rgba
+
+    def write(self, frames, **opts):
+        gif = GifWriter(self.path, **opts)
+        for rgba in frames:
+            gif.addFrame(rgba)
+        gif.closeFile()
+        self.assertTrue(gif.doneWriting())
+        return gif
+
+    def test_frames_round_trip(self):
+        first, second = self.frame(), self.frame()
+        second[:4] = 0 # a transparent band forces the previous frame to be cleared first
+        self.write([first, second], fps=10, loop=-1)
+        decoded, loop = read_gif(self.path)
+        self.assertEqual(loop, 0)
+        self.assertEqual(len(decoded), 2)
+        for rgba, (out, delay, rect) in zip([first, second], decoded):
+            self.assertTrue(np.array_equal(out, visible(rgba)))
+            self.assertEqual(delay, 10)
+
+    def test_only_changed_pixels_are_encoded(self):
+        first = self.frame()
+        second = first.copy()
+        second[5:9, 10:20, :3] = 255 - second[5:9, 10:20, :3]
+        self.write([first, second])
+        decoded, _ = read_gif(self.path)
+        self.assertEqual(decoded[1][2], (10, 5, 10, 4))
+        self.assertTrue(np.array_equal(decoded[1][0], second))
+
+    def test_identical_frames_extend_the_delay(self):
+        first = self.frame()
+        gif = self.write([first, first.copy(), first.copy(), self.frame()], fps=30)
+        self.assertEqual(gif.framesWritten(), 4)
+        decoded, _ = read_gif(self.path)
+        self.assertEqual([d for _, d, _ in decoded], [10, 3])
+
+    def test_global_palette(self):
+        colors = self.frame(colors=8)
+        self.write([colors, colors[::-1].copy()], palette='global')
+        decoded, _ = read_gif(self.path)
+        self.assertTrue(np.array_equal(decoded[1][0], colors[::-1]))
+
+    def test_premultiplied_input(self):
+        rgba = self.frame()
+        rgba[..., 3] = 200
+        rgba[..., :3] = rgba[..., :3].astype(np.uint32) * 200 // 255
+        self.write([rgba])
+        out = read_gif(self.path)[0][0][0]
+        self.assertTrue(np.all(out[..., 3] == 255))
+        self.assertLessEqual(np.abs(out[..., :3].astype(int) * 200 // 255 - rgba[..., :3]).max(), 1)
+
+    def test_bad_options(self):
+        with self.assertRaises(ValueError):
+            GifWriter(self.path, palette='adaptive')
+        with self.assertRaises(ValueError):
+            GifWriter(self.path, quantize='kmeans')
+
+class QuantizeTests(unittest.TestCase):
+    def setUp(self):
+        self.rgb = np.random.RandomState(1024).randint(0, 256, (5000, 3)).astype(np.uint8)
+
+    def test_small_palettes_are_lossless(self):
+        palette, labels = quantize(self.rgb[:100], 256)
+        self.assertTrue(np.array_equal(palette[labels], self.rgb[:100]))
+
+    def test_palette_size(self):
+        for method in ('median', 'octree'):
+            for colors in (2, 16, 255):
+                palette, labels = quantize(self.rgb, colors, method)
+                self.assertLessEqual(len(palette), colors)
+                self.assertEqual(labels.shape, (len(self.rgb),))
+                self.assertLess(labels.max(), len(palette))
+
+    def test_empty_input(self):
+        palette, labels = quantize(np.zeros((0, 3), dtype=np.uint8))
+        self.assertEqual(len(labels), 0)
+
+class LZWTests(unittest.TestCase):
+    def test_round_trip(self):
+        rand = np.random.RandomState(1024)
+        for bits, n in ((2, 10), (2, 50000), (8, 1), (8, 100000)):
+            indices = rand.randint(0, 1 << bits, n).astype(np.uint8)
+            block = lzw_encode(indices, bits)
+            self.assertEqual(ord(block[0]), bits)
+            data, _ = sub_blocks(block, 1)
+            self.assertEqual(lzw_decode(data, bits), indices.tolist())
+
+    def test_runs(self):
+        # long runs exercise the table's KwKwK case and fill it up repeatedly
+        indices = np.repeat(np.arange(4, dtype=np.uint8), 30000)
+        data, _ = sub_blocks(lzw_encode(indices, 2), 1)
+        self.assertEqual(lzw_decode(data, 2), indices.tolist())
+
+if __name__ == '__main__':
+    unittest.main()
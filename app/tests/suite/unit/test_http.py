@@ -0,0 +1,162 @@
+# encoding: utf-8
+import os
+import sys
+import time
+import shutil
+import urllib2
+import tempfile
+import unittest
+from threading import Thread
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../../..'))
+
+from plotdevice.util.http import fetch, fetch_all, fetch_async, HTTPCache, ConnectionPool, MAX_REDIRECTS, _shared
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep connections alive
+    log = []
+
+    def do_GET(self):
+        etag = '"%s"' % self.path
+        self.log.append((self.client_address, self.path, self.headers.getheader('If-None-Match')))
+        if self.path.startswith('/hop'):
+            # /hopN redirects to /hop(N-1) and /hop0 is a regular page
+            hops = int(self.path[4:])
+            if hops:
+                return self.reply(302, Location='/hop%i' % (hops-1))
+        elif self.path == '/loop':
+            return self.reply(302, Location='/loop')
+        elif self.path == '/created':
+            return self.reply(201, self.path * 5000)
+        elif self.path == '/missing':
+            return self.reply(404, 'not found')
+        elif self.path.startswith('/slow'):
+            time.sleep(0.3)
+        if self.headers.getheader('If-None-Match') == etag:
+            return self.reply(304, ETag=etag)
+        maxage = '0' if 'stale' in self.path else '60'
+        self.reply(200, self.path * 5000, ETag=etag, **{'Cache-Control':'max-age=%s' % maxage})
+
+    def reply(self, status, body='', **headers):
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class FetchTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = Server(('127.0.0.1', 0), Handler)
+        thread = Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        cls.root = 'http://127.0.0.1:%i' % cls.server.server_port
+
+    @classmethod
+    def tearDownClass(cls):
+        _shared('pool', ConnectionPool).close()
+        cls.server.shutdown()
+
+    def setUp(self):
+        del Handler.log[:]
+        self.tmpdir = tempfile.mkdtemp()
+        # a single connection per host means a leaked (or doubly released) slot shows up as
+        # a hang (or a ValueError) on the next request
+        self.cache, self.pool = HTTPCache(self.tmpdir, capacity=100000), ConnectionPool(per_host=1)
+
+    def tearDown(self):
+        self.pool.close() # (lets the server's handler threads stop waiting on our connections)
+        shutil.rmtree(self.tmpdir)
+
+    def fetch(self, path):
+        return fetch(self.root+path, self.cache, self.pool)
+
+    def test_fresh_responses_come_from_disk(self):
+        for i in range(3):
+            self.assertEqual(self.fetch('/fresh').read(), '/fresh' * 5000)
+        self.assertEqual(len(Handler.log), 1)
+
+    def test_stale_responses_are_revalidated(self):
+        for i in range(3):
+            resp = self.fetch('/stale')
+            self.assertEqual(resp.read(), '/stale' * 5000)
+            self.assertTrue(resp.cached)
+        self.assertEqual([l[2] for l in Handler.log], [None, '"/stale"', '"/stale"'])
+
+    def test_connections_are_reused(self):
+        for path in ('/a', '/b', '/c'):
+            self.fetch(path).read()
+        self.assertEqual(len(set(l[0] for l in Handler.log)), 1)
+
+    def test_fetch_all_preserves_order(self):
+        urls = [self.root+'/batch%i' % i for i in range(4)]
+        bodies = [r.read() for r in fetch_all(urls)]
+        self.assertEqual(bodies, ['/batch%i' % i * 5000 for i in range(4)])
+
+    def test_fetch_all_is_concurrent(self):
+        stamp = time.time() # (keep the shared cache from answering for the server)
+        urls = [self.root+'/slow%i-%f' % (i, stamp) for i in range(4)]
+        start = time.time()
+        self.assertEqual(len(fetch_all(urls)), 4)
+        self.assertLess(time.time() - start, 0.9)
+
+    def test_fetch_all_errors(self):
+        stamp = time.time()
+        paths = ['/slow-a%f' % stamp, '/missing', '/slow-b%f' % stamp]
+        with self.assertRaises(urllib2.HTTPError) as cm:
+            fetch_all([self.root+p for p in paths])
+        self.assertEqual(cm.exception.code, 404)
+        self.assertEqual(sorted(l[1] for l in Handler.log), sorted(paths)) # (all were fetched)
+
+    def test_fetch_async(self):
+        path = '/async%f' % time.time()
+        future = fetch_async(self.root+path)
+        self.assertEqual(future.result().read(), path * 5000)
+        self.assertTrue(future.done())
+
+    def test_cache_is_pruned(self):
+        self.fetch('/first').read()
+        for i in range(10):
+            self.fetch('/page%i' % i).read()
+        self.assertLessEqual(self.cache._quota.usage, self.cache.capacity)
+        self.assertTrue(self.cache.lookup(self.root+'/page9'))
+        self.assertFalse(self.cache.lookup(self.root+'/first'))
+
+    def test_redirects_are_followed(self):
+        resp = self.fetch('/hop%i' % MAX_REDIRECTS)
+        self.assertEqual(resp.read(), '/hop0' * 5000)
+
+    def test_redirect_exhaustion(self):
+        with self.assertRaises(urllib2.HTTPError) as cm:
+            self.fetch('/loop')
+        self.assertEqual(cm.exception.code, 302)
+        self.assertIn('Too many redirects', cm.exception.msg)
+        self.assertEqual(len(Handler.log), MAX_REDIRECTS+1)
+
+        # the pool's slot was released exactly once (so the host is still reachable)
+        self.assertEqual(self.fetch('/after').read(), '/after' * 5000)
+
+    def test_redirect_exhaustion_by_one(self):
+        with self.assertRaises(urllib2.HTTPError):
+            self.fetch('/hop%i' % (MAX_REDIRECTS+1))
+
+    def test_success_statuses(self):
+        self.assertEqual(self.fetch('/created').read(), '/created' * 5000)
+
+    def test_error_statuses(self):
+        with self.assertRaises(urllib2.HTTPError) as cm:
+            self.fetch('/missing')
+        self.assertEqual(cm.exception.code, 404)
+        self.assertEqual(self.fetch('/after').read(), '/after' * 5000)
+
+if __name__ == '__main__':
+    unittest.main()
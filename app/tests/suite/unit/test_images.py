@@ -0,0 +1,375 @@
+# encoding: utf-8
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../../..'))
+
+import plotdevice
+from plotdevice import DeviceError
+from plotdevice.gfx import Image
+from plotdevice.lib.cocoa import NSImage
+from plotdevice.gfx import image as image_module
+from plotdevice.gfx.image import ImageCache, ImagePrefetcher, ThumbnailCache, _bitmap_rep
+from fixtures import ICON
+
+ctx = plotdevice.ctx
+
+
+def _blank(w=4, h=4):
+    return NSImage.alloc().initWithSize_((w, h))
+
+class ImageCacheTests(unittest.TestCase):
+    def test_least_recently_used_are_evicted(self):
+        cache = ImageCache(budget=250)
+        for key in 'abc':
+            cache.put(key, _blank(), nbytes=100, pin=False)
+        self.assertEqual(sorted(cache._entries), ['b', 'c'])
+        self.assertEqual((cache.nbytes, cache.evictions), (200, 1))
+
+        cache.get('b', pin=False) # make `c' the least recently used
+        cache.put('d', _blank(), nbytes=100, pin=False)
+        self.assertEqual(sorted(cache._entries), ['b', 'd'])
+
+    def test_pinned_images_outlast_the_budget(self):
+        cache = ImageCache(budget=150)
+        cache.put('a', _blank(), nbytes=100)
+        cache.put('b', _blank(), nbytes=100)
+        self.assertEqual(len(cache), 2) # both are in use in the current frame
+        self.assertEqual(cache.nbytes, 200)
+
+        cache.unpin()
+        self.assertEqual(len(cache), 1)
+        self.assertLessEqual(cache.nbytes, cache.budget)
+
+    def test_stale_entries_are_dropped(self):
+        cache = ImageCache()
+        cache.put('a', _blank(), mtime=10, nbytes=100)
+        self.assertIsNotNone(cache.get('a', mtime=10))
+        self.assertIsNone(cache.get('a', mtime=11))
+        self.assertNotIn('a', cache)
+        self.assertEqual((cache.hits, cache.misses, cache.nbytes), (1, 1, 0))
+
+    def test_replacing_an_entry(self):
+        cache = ImageCache()
+        first, second = _blank(), _blank()
+        cache.put('a', first, nbytes=100)
+        cache.put('a', second, nbytes=50)
+        self.assertIs(cache.get('a'), second)
+        self.assertEqual(cache.nbytes, 50)
+        self.assertEqual(list(cache._origins.values()), ['a'])
+
+    def test_decoded_size(self):
+        cache = ImageCache()
+        cache.put('a', _blank(8, 2))
+        self.assertEqual(cache.nbytes, 4*8*2)
+
+    def test_stats(self):
+        cache = ImageCache(budget=150)
+        cache.put('a', _blank(), nbytes=100, pin=False)
+        cache.put('b', _blank(), nbytes=100, pin=False)
+        cache.get('b')
+        cache.get('c')
+        self.assertEqual(cache.stats(), dict(hits=1, misses=1, evictions=1, images=1, bytes=100, budget=150))
+
+class MipmapTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = ImageCache()
+        self.icon = NSImage.alloc().initWithContentsOfFile_(ICON) # 128x128 pixels
+
+    def dims(self, image):
+        rep = _bitmap_rep(image)
+        return rep.pixelsWide(), rep.pixelsHigh()
+
+    def test_levels(self):
+        self.assertIsNone(self.cache.mipmap(self.icon, (100, 100))) # (not small enough to bother)
+        self.assertEqual(self.dims(self.cache.mipmap(self.icon, (64, 64))), (64, 64))
+        self.assertEqual(self.dims(self.cache.mipmap(self.icon, (20, 30))), (32, 32))
+        self.assertEqual(self.dims(self.cache.mipmap(self.icon, (0.1, 0.1))), (1, 1))
+
+    def test_chains_are_reused(self):
+        quarter = self.cache.mipmap(self.icon, (32, 32))
+        self.assertIs(self.cache.mipmap(self.icon, (32, 32)), quarter)
+        self.assertEqual(len(self.cache), 1) # a single entry for the whole chain
+
+        # intermediate levels are kept as well
+        half = self.cache.mipmap(self.icon, (64, 64))
+        self.assertEqual(self.dims(half), (64, 64))
+        self.assertIs(self.cache.mipmap(self.icon, (32, 32)), quarter)
+
+    def test_uncached_originals_are_charged_to_the_chain(self):
+        self.cache.mipmap(self.icon, (64, 64))
+        self.assertEqual(self.cache.nbytes, 4 * (128*128 + 64*64))
+
+    def test_cached_originals_are_charged_once(self):
+        self.cache.put('icon', self.icon)
+        self.cache.mipmap(self.icon, (64, 64))
+        self.assertEqual(self.cache.nbytes, 4 * (128*128 + 64*64))
+
+    def test_evicting_the_original_drops_its_chain(self):
+        self.cache.put('icon', self.icon, pin=False)
+        self.cache.mipmap(self.icon, (64, 64))
+        self.cache.unpin()
+        self.cache.budget = 0
+        self.cache.unpin()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.nbytes, 0)
+
+class ThumbnailCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.thumbs = ThumbnailCache(os.path.join(self.tmpdir, 'thumbs'))
+        self.icon = NSImage.alloc().initWithContentsOfFile_(ICON)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        self.thumbs.put(ICON, 1, 128, self.icon)
+        thumb = self.thumbs.get(ICON, 1, 128)
+        rep = _bitmap_rep(thumb)
+        self.assertEqual((rep.pixelsWide(), rep.pixelsHigh()), (128, 128))
+
+    def test_keys(self):
+        self.thumbs.put(ICON, 1, 128, self.icon)
+        self.assertIsNone(self.thumbs.get(ICON, 2, 128)) # the file has since been modified
+        self.assertIsNone(self.thumbs.get(ICON, 1, 64))
+
+    def test_truncated_files_are_ignored(self):
+        self.thumbs.put(ICON, 1, 128, self.icon)
+        fn = self.thumbs._filename(ICON, 1, 128)
+        with open(fn, 'r+b') as f:
+            f.truncate(1000)
+        self.assertIsNone(self.thumbs.get(ICON, 1, 128))
+
+    def test_capacity(self):
+        self.thumbs = ThumbnailCache(self.thumbs.root, capacity=3 * 128*128*4)
+        for mtime in range(5):
+            self.thumbs.put(ICON, mtime, 128, self.icon)
+        self.assertLessEqual(self.thumbs._quota.usage, self.thumbs.capacity)
+        self.assertIsNotNone(self.thumbs.get(ICON, 4, 128))
+        self.assertIsNone(self.thumbs.get(ICON, 0, 128))
+
+    def test_levels_of_files_are_reused_across_runs(self):
+        cache = ImageCache(disk=self.thumbs.root)
+        cache.put(ICON, self.icon, 1, origin=ICON, dims=(128, 128))
+        cache.mipmap(self.icon, (32, 32))
+        self.assertEqual(len(os.listdir(self.thumbs.root)), 1)
+
+        # a later run reads the level from disk rather than resampling the original
+        fresh = ImageCache(disk=self.thumbs.root)
+        fresh.put(ICON, self.icon, 1, origin=ICON, dims=(128, 128))
+        halve, image_module._halve = image_module._halve, None
+        try:
+            level = fresh.mipmap(self.icon, (32, 32))
+        finally:
+            image_module._halve = halve
+        rep = _bitmap_rep(level)
+        self.assertEqual((rep.pixelsWide(), rep.pixelsHigh()), (32, 32))
+
+class PrefetchWindowTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(6):
+            path = os.path.join(self.tmpdir, 'img-%i.png' % i)
+            shutil.copy(ICON, path)
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def wait_for(self, condition):
+        deadline = time.time() + 10
+        while not condition():
+            self.assertLess(time.time(), deadline, 'prefetcher stalled')
+            time.sleep(0.01)
+
+    def decoded(self, prefetcher):
+        # wait for the paths in the window to finish decoding
+        self.wait_for(lambda: all(done.is_set() for done in prefetcher._claims.values()))
+        return [p for p in self.paths if p in prefetcher.cache]
+
+    def test_window_limits_decoding_ahead(self):
+        prefetcher = ImagePrefetcher(ImageCache(), workers=2, window=2)
+        prefetcher.add(self.paths)
+        self.assertEqual(self.decoded(prefetcher), self.paths[:2])
+        time.sleep(0.1)
+        self.assertEqual(self.decoded(prefetcher), self.paths[:2]) # nothing more until they're drawn
+
+    def test_claiming_frees_a_slot(self):
+        prefetcher = ImagePrefetcher(ImageCache(), workers=2, window=2)
+        prefetcher.add(self.paths)
+        for i, path in enumerate(self.paths):
+            prefetcher.claim(path)
+            self.assertIn(path, prefetcher.cache)
+            self.assertLessEqual(len(prefetcher._claims), 2)
+            self.assertEqual(self.decoded(prefetcher), self.paths[:i+3])
+        self.assertEqual(len(prefetcher._claims), 0)
+
+    def test_skipped_paths_are_released(self):
+        prefetcher = ImagePrefetcher(ImageCache(), workers=2, window=3)
+        prefetcher.add(self.paths)
+        self.decoded(prefetcher)
+        prefetcher.claim(self.paths[2]) # skipping the first two
+        self.assertEqual(list(prefetcher._claims), self.paths[3:6])
+
+    def test_jumping_past_the_window(self):
+        prefetcher = ImagePrefetcher(ImageCache(), workers=2, window=2)
+        prefetcher.add(self.paths)
+        self.decoded(prefetcher)
+        prefetcher.claim(self.paths[3]) # (not yet prefetched so it's left for the caller to load)
+        self.assertEqual(list(prefetcher._claims), self.paths[4:6])
+        self.assertEqual(len(prefetcher._upcoming), 0)
+
+    def test_prefetched_images_are_evictable(self):
+        cache = ImageCache()
+        prefetcher = ImagePrefetcher(cache, workers=2, window=2)
+        prefetcher.add(self.paths)
+        self.decoded(prefetcher)
+
+        # nothing's been drawn so the budget applies to the prefetched images right away
+        cache.budget = 0
+        cache.unpin()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.nbytes, 0)
+
+    def test_claim_after_completion(self):
+        cache = ImageCache()
+        prefetcher = ImagePrefetcher(cache, workers=1, window=1)
+        prefetcher.add(self.paths[:1])
+        self.decoded(prefetcher)
+        prefetcher.claim(self.paths[0]) # shouldn't block
+        self.assertIsNotNone(cache.get(self.paths[0]))
+        prefetcher.claim(self.paths[0]) # (nor should claiming a path twice)
+
+class PixelTests(unittest.TestCase):
+    def setUp(self):
+        ctx._resetContext()
+
+    def test_pixels_of_a_file(self):
+        img = Image(ICON)
+        pixels = img.pixels
+        self.assertEqual(pixels.shape, (128, 128, 4))
+        self.assertIs(img.pixels, pixels) # (rendered once then reused)
+        self.assertIsNone(Image(ICON)._pixels) # the cached original is left alone
+
+    def test_arrays_are_shared(self):
+        import numpy
+        arr = numpy.zeros((3, 5, 4), dtype=numpy.uint8)
+        img = Image.from_array(arr, 10, 20)
+        self.assertEqual((img.x, img.y, tuple(img.size)), (10, 20, (5, 3)))
+        arr[1, 1] = 255
+        self.assertEqual(img.pixels[1, 1].tolist(), [255]*4)
+
+    def test_rgb_arrays(self):
+        import numpy
+        img = Image.from_array(numpy.ones((2, 2, 3), dtype=numpy.uint8))
+        self.assertEqual(img.pixels[..., 3].tolist(), [[255, 255], [255, 255]])
+
+    def test_bad_arrays(self):
+        import numpy
+        for arr in (numpy.zeros((2, 2, 4)), numpy.zeros((2, 2), dtype=numpy.uint8),
+                    numpy.zeros((2, 2, 2), dtype=numpy.uint8)):
+            with self.assertRaises(DeviceError):
+                Image.from_array(arr)
+
+    def test_assigning_pixels(self):
+        import numpy
+        img = Image.from_array(numpy.zeros((2, 2, 4), dtype=numpy.uint8))
+        img.pixels = 128
+        self.assertEqual(img.pixels.min(), 128)
+
+class SnapshotTests(unittest.TestCase):
+    def setUp(self):
+        ctx._resetContext()
+
+    def pixel_image(self):
+        import numpy
+        return Image.from_array(numpy.zeros((4, 4, 4), dtype=numpy.uint8))
+
+    def test_copies_own_their_pixels(self):
+        img = self.pixel_image()
+        clone = img.copy()
+        img.pixels[:] = 255
+        self.assertEqual(clone.pixels.max(), 0)
+
+    def test_copies_keep_their_state(self):
+        img = Image(ICON, 10, 20, width=30)
+        img.rotate(45)
+        img.alpha = 0.5
+        clone = img.copy()
+        self.assertEqual(clone.transform.matrix, img.transform.matrix)
+        self.assertEqual((clone.x, clone.y, clone.width), (img.x, img.y, img.width))
+        self.assertEqual(clone.alpha, 0.5)
+        self.assertIs(clone._nsImage, img._nsImage) # (unmodified bitmaps are shared)
+
+    def test_snapshots_own_their_pixels(self):
+        img = self.pixel_image()
+        ctx.canvas.append(img)
+        snap = ctx.canvas._snapshot()
+        img.pixels[:] = 255
+        self.assertEqual(snap._grobs[0].pixels.max(), 0)
+
+    def test_snapshots_own_their_stencils(self):
+        img = self.pixel_image()
+        with ctx.clip(img):
+            ctx.rect(0, 0, 4, 4)
+        snap = ctx.canvas._snapshot()
+        img.pixels[:] = 255
+        self.assertIsNot(snap._grobs[0].bmp, img)
+        self.assertEqual(snap._grobs[0].bmp.pixels.max(), 0)
+
+class CanvasRasterTests(unittest.TestCase):
+    def setUp(self):
+        ctx._resetContext()
+        ctx.size(40, 30)
+        self.canvas = ctx.canvas
+        self.path = ctx.rect(0, 0, 20, 20, fill='red')
+
+    def settled(self):
+        # the content-hash is taken on the second pass, so the third is the first reuse
+        self.canvas.rasterize()
+        self.canvas.rasterize()
+        return self.canvas.rasterize()
+
+    def test_unchanged_canvases_are_reused(self):
+        bitmap = self.settled()
+        self.assertIs(self.canvas.rasterize(), bitmap)
+        self.assertIs(Image(self.canvas)._nsImage, bitmap)
+        self.assertIs(self.canvas.snapshot()._nsImage, bitmap)
+        self.assertIsNot(self.canvas.rasterize(zoom=2), bitmap)
+
+    def test_appended_grobs_are_drawn_over_a_copy(self):
+        bitmap = self.settled()
+        ctx.oval(10, 10, 10, 10)
+        updated = self.canvas.rasterize()
+        self.assertIsNot(updated, bitmap)
+        self.assertEqual(self.canvas._raster[4], 2)
+        self.assertIs(self.canvas.rasterize(), updated)
+
+    def test_in_place_changes_invalidate_the_bitmap(self):
+        bitmap = self.settled()
+        self.path.fill = 'blue'
+        self.assertIsNot(self.canvas.rasterize(), bitmap)
+
+    def test_clearing_invalidates_the_bitmap(self):
+        bitmap = self.settled()
+        ctx.clear(self.path)
+        self.assertIsNot(self.canvas.rasterize(), bitmap)
+
+    def test_uncached(self):
+        bitmap = self.settled()
+        self.assertIsNot(self.canvas.rasterize(cached=False), bitmap)
+        self.assertIs(self.canvas.rasterize(), bitmap)
+
+    def test_snapshots_are_independent(self):
+        snap = self.canvas.snapshot()
+        ctx.oval(10, 10, 10, 10)
+        self.assertIsNot(self.canvas.snapshot()._nsImage, snap._nsImage)
+        self.assertEqual(snap.size, (40, 30))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# encoding: utf-8
+import os
+import sys
+import zlib
+import struct
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../../..'))
+
+from plotdevice.util import png
+from fixtures import read_png, read_chunks
+
+class PNGTests(unittest.TestCase):
+    def setUp(self):
+        rand = np.random.RandomState(1024)
+        # a mix of noise and smooth gradients so the adaptive filter picks different filters
+        self.rgba = rand.randint(0, 256, (20, 16, 4)).astype(np.uint8)
+        self.rgba[10:] = np.arange(16*4, dtype=np.uint8).reshape(16, 4) * 3
+        self.rgba[..., 3] = 255
+
+    def test_filters_round_trip(self):
+        for method in ('adaptive',) + png.FILTERS:
+            pixels, _ = read_png(png.encode(self.rgba, filter=method))
+            self.assertTrue(np.array_equal(pixels, self.rgba), method)
+
+    def test_rgb_input(self):
+        rgb = self.rgba[..., :3]
+        pixels, chunks = read_png(png.encode(rgb))
+        self.assertEqual(ord(chunks['IHDR'][0][9]), 2)
+        self.assertTrue(np.array_equal(pixels, rgb))
+
+    def test_parallel_deflate(self):
+        big = np.tile(self.rgba, (30, 40, 1)) # large enough to be split between several threads
+        self.assertGreater(big.nbytes, 2*png.CHUNK_SIZE)
+        serial, parallel = png.encode(big, filter='up'), png.encode(big, filter='up', threads=4)
+        self.assertNotEqual(serial, parallel)
+        for data in serial, parallel:
+            raw = zlib.decompress(''.join(read_chunks(data)['IDAT']))
+            self.assertEqual(len(raw), big.shape[0] * (big.shape[1]*4 + 1))
+        self.assertEqual(zlib.decompress(''.join(read_chunks(serial)['IDAT'])),
+                         zlib.decompress(''.join(read_chunks(parallel)['IDAT'])))
+
+    def test_premultiplied_alpha(self):
+        rgba = self.rgba.copy()
+        rgba[..., 3] = 128
+        rgba[..., :3] = rgba[..., :3].astype(np.uint32) * 128 // 255
+        pixels, _ = read_png(png.encode(rgba))
+        self.assertLessEqual(np.abs(pixels[..., :3].astype(int) * 128 // 255 - rgba[..., :3]).max(), 1)
+
+        straight, _ = read_png(png.encode(rgba, premultiplied=False))
+        self.assertTrue(np.array_equal(straight, rgba))
+
+    def test_text_chunks(self):
+        _, chunks = read_png(png.encode(self.rgba, text={'Software':'PlotDevice', 'Title':'test'}))
+        self.assertEqual(chunks['tEXt'], ['Software\0PlotDevice', 'Title\0test'])
+
+    def test_bad_args(self):
+        with self.assertRaises(ValueError):
+            png.encode(self.rgba[..., :2])
+        with self.assertRaises(ValueError):
+            png.encode(self.rgba, filter='median')
+
+if __name__ == '__main__':
+    unittest.main()
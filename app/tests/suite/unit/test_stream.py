@@ -0,0 +1,87 @@
+# encoding: utf-8
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from threading import Thread
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../../..'))
+
+from plotdevice.util.stream import FrameStream
+from fixtures import read_png
+
+class FrameStreamTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'frames')
+        self.rgba = np.zeros((3, 5, 4), dtype=np.uint8)
+        self.rgba[..., 3] = 255
+        self.rgba[1, 2] = (64, 64, 64, 128) # premultiplied 50% grey
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, format, frames):
+        stream = FrameStream(self.path, format)
+        for num, rgba in enumerate(frames):
+            stream.addFrame(stream.encode(rgba, num+1))
+        stream.closeFile()
+        self.assertTrue(stream.doneWriting())
+        self.assertEqual(stream.framesWritten(), len(frames))
+        return open(self.path, 'rb').read()
+
+    def test_rgba(self):
+        data = self.write('rgba', [self.rgba, self.rgba])
+        frame = 'FRAME 1 5 3\n'
+        self.assertTrue(data.startswith(frame))
+        pixels = np.frombuffer(data[len(frame):len(frame)+60], dtype=np.uint8).reshape(3, 5, 4)
+        self.assertEqual(tuple(pixels[1, 2]), (127, 127, 127, 128)) # (unpremultiplied)
+        self.assertEqual(data[len(frame)+60:].split('\n')[0], 'FRAME 2 5 3')
+        self.assertEqual(len(data), 2 * (len(frame) + 60))
+
+    def test_y4m(self):
+        white = np.ones((2, 2, 4), dtype=np.uint8) * 255
+        data = self.write('y4m', [white, white])
+        header, rest = data.split('\n', 1)
+        self.assertEqual(header, 'YUV4MPEG2 W2 H2 F30:1 Ip A1:1 C444 XCOLORRANGE=FULL')
+        frame, rest = rest.split('\n', 1)
+        self.assertEqual(frame, 'FRAME Xframe=1')
+        self.assertEqual([ord(c) for c in rest[:12]], [255]*4 + [128]*8)
+
+    def test_y4m_size_is_fixed(self):
+        stream = FrameStream(self.path, 'y4m')
+        stream.addFrame(stream.encode(self.rgba, 1))
+        with self.assertRaises(ValueError):
+            stream.addFrame(stream.encode(self.rgba[:2], 2))
+        stream.closeFile()
+
+    def test_png(self):
+        data = self.write('png', [self.rgba])
+        pixels, chunks = read_png(data)
+        self.assertEqual(chunks['tEXt'], ['Frame\x001'])
+        self.assertEqual(pixels.shape, (3, 5, 4))
+
+    def test_bad_format(self):
+        with self.assertRaises(ValueError):
+            FrameStream(self.path, 'mp4')
+
+    def test_reader_hanging_up(self):
+        os.mkfifo(self.path)
+        def reader():
+            with open(self.path, 'rb') as f:
+                f.read(10)
+        thread = Thread(target=reader)
+        thread.start()
+
+        stream = FrameStream(self.path, 'rgba') # (blocks until the reader opens the pipe)
+        big = np.zeros((512, 512, 4), dtype=np.uint8)
+        for num in range(1, 10):
+            stream.addFrame(stream.encode(big, num)) # shouldn't raise once the pipe breaks
+        thread.join()
+        self.assertTrue(stream.broken)
+        stream.closeFile()
+        self.assertTrue(stream.doneWriting())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,367 @@
+# encoding: utf-8
+import os
+import re
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../../..'))
+
+import plotdevice
+from plotdevice import DeviceError
+from plotdevice.gfx import Text, Stylesheet
+from plotdevice.gfx import text as text_module
+from plotdevice.lib import foundry
+from plotdevice.lib.cocoa import NSCache
+from fixtures import xml_document
+
+ctx = plotdevice.ctx
+
+def _indents(txt):
+    # the first-line indent of each paragraph
+    store = txt._store
+    return [store.attribute_atIndex_effectiveRange_('NSParagraphStyle', m.start, None)[0].firstLineHeadIndent()
+            for m in txt.paragraphs if m.start < store.length()]
+
+class StylesheetKeyTests(unittest.TestCase):
+    def sheet(self):
+        sheet = Stylesheet()
+        sheet.style('h1', size=30, fill='red')
+        sheet.style('em', italic=True)
+        return sheet
+
+    def test_copies_share_a_key(self):
+        sheet = self.sheet()
+        self.assertEqual(sheet.copy()._version, sheet._version)
+
+    def test_equal_contents_share_a_key(self):
+        self.assertEqual(self.sheet()._version, self.sheet()._version)
+        self.assertEqual(Stylesheet()._version, Stylesheet()._version)
+
+    def test_changes_alter_the_key(self):
+        sheet = self.sheet()
+        orig = sheet._version
+        sheet.style('h1', size=31)
+        self.assertNotEqual(sheet._version, orig)
+
+        edited = sheet._version
+        del sheet['em']
+        self.assertNotEqual(sheet._version, edited)
+
+    def test_copies_are_independent(self):
+        sheet = self.sheet()
+        orig = sheet._version
+        dupe = sheet.copy()
+        dupe.style('h2', size=20)
+        self.assertEqual(sheet._version, orig)
+        self.assertNotEqual(dupe._version, orig)
+
+class CacheKeyTests(unittest.TestCase):
+    def setUp(self):
+        ctx._resetContext()
+        ctx._stylecache.clear()
+        ctx._stylecache.hits = ctx._stylecache.misses = 0
+        ctx._textcache.clear()
+        ctx._textcache.hits = ctx._textcache.misses = 0
+
+    def test_texts_sharing_a_stylesheet_hit_the_style_cache(self):
+        Text(u'first', 0, 0)
+        misses = ctx._stylecache.misses
+        Text(u'second', 0, 0)
+        self.assertEqual(ctx._stylecache.misses, misses)
+        self.assertGreater(ctx._stylecache.hits, 0)
+
+    def test_style_cache_survives_a_new_frame(self):
+        Text(u'first', 0, 0)
+        misses = ctx._stylecache.misses
+        ctx._resetContext() # (which starts over with a fresh Stylesheet)
+        Text(u'second', 0, 0)
+        self.assertEqual(ctx._stylecache.misses, misses)
+
+    def test_measurements_survive_a_new_frame(self):
+        first = ctx.measure(u'hello world')
+        ctx._resetContext()
+        self.assertEqual(ctx.measure(u'hello world'), first)
+        self.assertEqual(ctx._textcache.misses, 1)
+        self.assertEqual(ctx._textcache.hits, 1)
+
+    def test_measurements_track_the_stylesheet(self):
+        ctx.measure(u'hello world')
+        ctx.stylesheet('big', size=96)
+        ctx.measure(u'hello world')
+        self.assertEqual(ctx._textcache.misses, 2)
+
+    def test_measurements_track_the_font(self):
+        small = ctx.measure(u'hello world', size=12)
+        big = ctx.measure(u'hello world', size=24)
+        self.assertGreater(big.width, small.width)
+        self.assertEqual(ctx._textcache.misses, 2)
+        self.assertEqual(ctx.measure(u'hello world', size=12), small)
+        self.assertEqual(ctx._textcache.hits, 1)
+
+class MetricsCacheTests(unittest.TestCase):
+    def setUp(self):
+        ctx._resetContext()
+        self.cache = text_module.MetricsCache(size=2)
+
+    def test_least_recently_used_are_evicted(self):
+        for txt in (u'a', u'b', u'c'):
+            self.cache.measure(txt)
+        self.cache.measure(u'b')
+        self.cache.measure(u'a')
+        self.assertEqual(self.cache.stats()['misses'], 4)
+        self.assertEqual(self.cache.stats()['evictions'], 2)
+        self.assertEqual(self.cache.stats()['entries'], 2)
+
+    def test_results_are_not_shared(self):
+        size = self.cache.measure(u'hello')
+        size.width = 0
+        self.assertGreater(self.cache.measure(u'hello').width, 0)
+
+    def test_fill_is_ignored(self):
+        self.cache.measure(u'hello', fill='red')
+        self.cache.measure(u'hello', fill='blue')
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_dimensions_are_part_of_the_key(self):
+        self.cache.measure(u'hello world')
+        narrow = self.cache.measure(u'hello world', width=20)
+        self.assertEqual(self.cache.stats()['misses'], 2)
+        self.assertLessEqual(narrow.width, 20)
+
+class ApproxMeasureTests(unittest.TestCase):
+    def setUp(self):
+        ctx._resetContext()
+        self.cache = text_module.MetricsCache()
+
+    def test_estimates_are_close(self):
+        for txt in (u'hello world', u'AVATAR WAVE', u'Typography, 1234567890'):
+            for opts in (dict(size=12), dict(size=48, weight='bold'), dict(size=24, tracking=100)):
+                exact = self.cache.measure(txt, **opts)
+                approx = self.cache.measure(txt, approx=True, **opts)
+                self.assertAlmostEqual(approx.width / exact.width, 1.0, delta=0.05, msg=(txt, opts))
+
+    def test_estimates_are_not_cached(self):
+        self.cache.measure(u'hello world', approx=True)
+        self.cache.measure(u'hello world', approx=True)
+        stats = self.cache.stats()
+        self.assertEqual((stats['estimates'], stats['misses'], stats['entries']), (2, 0, 0))
+        self.assertEqual(stats['faces'], 1)
+
+    def test_exact_measurements_are_preferred(self):
+        exact = self.cache.measure(u'hello world')
+        self.assertEqual(self.cache.measure(u'hello world', approx=True), exact)
+        self.assertEqual(self.cache.stats()['estimates'], 0)
+
+    def test_verify(self):
+        self.cache.measure(u'hello world', approx=True, verify=True)
+        self.assertEqual((self.cache.stats()['estimates'], self.cache.stats()['misses']), (0, 1))
+
+    def test_fallbacks(self):
+        self.cache.measure(u'hello\nworld', approx=True)              # multiple lines
+        self.cache.measure(u'hello world', approx=True, align=text_module.CENTER) # a layout option
+        narrow = self.cache.measure(u'hello world', 20, approx=True)   # wrapped
+        self.assertEqual((self.cache.stats()['estimates'], self.cache.stats()['misses']), (0, 3))
+        self.assertLessEqual(narrow.width, 20)
+
+class LabelsTests(unittest.TestCase):
+    def setUp(self):
+        ctx._resetContext()
+        self.strings = [u'one', u'two', u'three', u'forty-four']
+        self.xs, self.ys = [10, 20, 30, 40], [100, 200, 300, 400]
+
+    def test_sizes_match_measure(self):
+        lbls = ctx.labels(self.strings, self.xs, self.ys, size=18, plot=False)
+        for txt, w, h in zip(self.strings, lbls.widths, lbls.heights):
+            self.assertAlmostEqual(w, ctx.measure(txt, size=18).width, delta=0.5)
+            self.assertGreater(h, 0)
+
+    def test_alignment(self):
+        left = ctx.labels(self.strings, self.xs, self.ys, plot=False)
+        for align, share in ((text_module.RIGHT, 1.0), (text_module.CENTER, 0.5)):
+            lbls = ctx.labels(self.strings, self.xs, self.ys, align=align, plot=False)
+            for (x, y, w, h), (lx, ly, lw, lh) in zip(lbls._boxes, left._boxes):
+                self.assertAlmostEqual(x, lx - lw*share, places=3)
+                self.assertAlmostEqual(y, ly, places=3)
+
+    def test_shared_coordinates(self):
+        lbls = ctx.labels(self.strings, 50, self.ys, plot=False)
+        self.assertEqual(lbls.xs, [50]*4)
+        self.assertEqual(lbls.ys, self.ys)
+        self.assertTrue(all(abs(x-50) < 1 for x, y, w, h in lbls._boxes))
+
+    def test_mismatched_lengths(self):
+        with self.assertRaises(DeviceError):
+            ctx.labels(self.strings, self.xs[:2], self.ys, plot=False)
+
+    def test_strings(self):
+        lbls = ctx.labels(['caf\xc3\xa9', 42, u'', u'two\nlines'], 0, 0, plot=False)
+        self.assertEqual(lbls.strings, [u'caf\xe9', u'42', u'', u'two\nlines'])
+        self.assertEqual(lbls._boxes[2][2:], (0, 0))
+        self.assertGreater(lbls.heights[3], lbls.heights[0]) # (newlines stay within a label)
+
+    def test_bounds(self):
+        lbls = ctx.labels(self.strings, self.xs, self.ys, plot=False)
+        left, top = [min(b[i] for b in lbls._boxes) for i in (0, 1)]
+        right, bottom = [max(b[i] + b[i+2] for b in lbls._boxes) for i in (0, 1)]
+        (x, y), (w, h) = lbls.bounds
+        for val, expected in zip((x, y, w, h), (left, top, right-left, bottom-top)):
+            self.assertAlmostEqual(val, expected, places=3)
+
+    def test_plotting(self):
+        ctx.labels(self.strings, self.xs, self.ys, plot=False)
+        self.assertEqual(len(ctx.canvas), 0)
+        lbls = ctx.labels(self.strings, self.xs, self.ys)
+        self.assertEqual(len(ctx.canvas), 1)
+        self.assertIs(ctx.canvas[0], lbls)
+
+    def test_copies(self):
+        lbls = ctx.labels(self.strings, self.xs, self.ys, plot=False)
+        clone = lbls.copy()
+        self.assertEqual(clone._boxes, lbls._boxes)
+        self.assertEqual(clone.strings, lbls.strings)
+
+class StreamedTextTests(unittest.TestCase):
+    def setUp(self):
+        ctx._resetContext()
+        self.threshold = text_module.STREAM_THRESHOLD
+        text_module.STREAM_THRESHOLD = 1000 # stream anything longer than a few paragraphs
+
+    def tearDown(self):
+        text_module.STREAM_THRESHOLD = self.threshold
+
+    def parsed(self, xml):
+        # lay out the xml without streaming it
+        text_module.STREAM_THRESHOLD = len(xml)+1
+        try:
+            return Text(xml=xml, width=300, indent=2)
+        finally:
+            text_module.STREAM_THRESHOLD = 1000
+
+    def test_streamed_text_matches_a_single_parse(self):
+        xml = xml_document(2000)
+        streamed, whole = Text(xml=xml, width=300, indent=2), self.parsed(xml)
+        self.assertEqual(streamed.text, whole.text)
+        self.assertEqual(_indents(streamed), _indents(whole))
+        self.assertEqual(streamed._nodes.get('b'), whole._nodes.get('b'))
+
+    def test_appending_to_streamed_text(self):
+        xml = xml_document(500)
+        streamed, whole = Text(xml=xml, width=300, indent=2), self.parsed(xml)
+        for txt in streamed, whole:
+            txt.append(xml=xml_document(5))
+        self.assertEqual(streamed.text, whole.text)
+        self.assertEqual(_indents(streamed), _indents(whole))
+        self.assertEqual(streamed._nodes.get('p'), whole._nodes.get('p'))
+
+class GlyphCacheTests(unittest.TestCase):
+    def setUp(self):
+        ctx._resetContext()
+        self.outlines = foundry._outlines
+        foundry._outlines = NSCache.alloc().init()
+
+    def tearDown(self):
+        foundry._outlines = self.outlines
+
+    def trace(self, obj, cache):
+        # the elements of a Text (or TextMatch) object's path, traced using a given cache
+        foundry._outlines = cache
+        path = obj.path._nsBezierPath
+        return [path.elementAtIndex_associatedPoints_(i) for i in range(path.elementCount())]
+
+    def assertSameOutline(self, ours, ref):
+        self.assertEqual(len(ours), len(ref))
+        for (kind, pts), (ref_kind, ref_pts) in zip(ours, ref):
+            self.assertEqual(kind, ref_kind)
+            for pt, ref_pt in zip(pts, ref_pts):
+                self.assertAlmostEqual(pt.x, ref_pt.x, places=3)
+                self.assertAlmostEqual(pt.y, ref_pt.y, places=3)
+
+    def test_cached_outlines_match_a_fresh_trace(self):
+        txt = Text(u'banana bandana\nabba', 10, 40, width=80, size=24)
+        ref = self.trace(txt, None) # (a nil cache traces every glyph from scratch)
+        cache = NSCache.alloc().init()
+        self.assertSameOutline(self.trace(txt, cache), ref) # cold
+        self.assertSameOutline(self.trace(txt, cache), ref) # warm
+
+    def test_sizes_and_faces_are_kept_apart(self):
+        cache = NSCache.alloc().init()
+        for opts in (dict(size=12), dict(size=36), dict(size=36, weight='bold')):
+            txt = Text(u'aaa', 0, 0, **opts)
+            ref = self.trace(txt, None)
+            self.assertSameOutline(self.trace(txt, cache), ref)
+
+    def test_matches_share_the_cache(self):
+        txt = Text(u'one two one', 0, 0, size=18)
+        match = txt.find('one')[1]
+        cache = NSCache.alloc().init()
+        self.trace(txt, cache)
+        self.assertSameOutline(self.trace(match, cache), self.trace(match, None))
+
+class OverleafTests(unittest.TestCase):
+    def setUp(self):
+        ctx._resetContext()
+        self.txt = Text(xml=xml_document(400), width=200, height=300)
+
+    def pages(self):
+        # the original followed by each of its overleaf() pages
+        pages = [self.txt]
+        while True:
+            page = pages[-1].overleaf()
+            if page is None:
+                return pages
+            pages.append(page)
+
+    def shown(self, page):
+        return unicode(page._store.attributedSubstringFromRange_((0, sum(page.frames[-1]._chars))).string())
+
+    def test_pages_cover_the_string(self):
+        pages = self.pages()
+        self.assertGreater(len(pages), 3)
+        self.assertEqual(u''.join(self.shown(pg) for pg in pages), self.txt.text)
+
+    def test_pages_load_a_window(self):
+        pages = self.pages()
+        for pg in pages[1:-1]:
+            self.assertLess(pg._store.length(), len(pg))
+            self.assertIs(pg._grafs, pages[1]._grafs) # (the paragraph breaks are only found once)
+
+    def test_page_text_includes_the_overflow(self):
+        page = self.txt.overleaf()
+        offset = page._cursor
+        self.assertEqual(len(page), len(self.txt) - offset)
+        self.assertEqual(page.text, self.txt.text[offset:])
+        self.assertEqual(len(page), len(page.text))
+
+    def test_find_all_on_a_page(self):
+        page = self.txt.overleaf()
+        rest = self.txt.text[page._cursor:]
+        found = page.find(u'bold', all)
+        self.assertEqual(len(found), rest.count(u'bold'))
+        self.assertEqual([m.start for m in found], [m.start() for m in re.finditer(u'bold', rest)])
+
+    def test_select_all_on_a_page(self):
+        page = self.txt.overleaf()
+        offset = page._cursor
+        expected = [e for e in self.txt._nodes.get('p') if e.end > offset]
+        found = page.select('p', all)
+        self.assertEqual(len(found), len(expected))
+        for m in found:
+            self.assertLess(m.start, len(page)) # (a paragraph split by the page-break starts before 0)
+            self.assertTrue(0 < m.end <= len(page))
+        self.assertEqual(found[-1].text, self.txt.text[expected[-1].start:expected[-1].end])
+
+    def test_visible_matches_stay_on_the_page(self):
+        page = self.txt.overleaf()
+        shown = sum(page.frames[-1]._chars)
+        self.assertTrue(all(m.start < shown for m in page.select('p')))
+        self.assertTrue(all(m.start < shown for m in page.find(u'bold')))
+
+    def test_long_paragraphs_load_a_window(self):
+        self.txt = Text(u' '.join(u'word%i' % i for i in range(5000)), width=200, height=300)
+        pages = self.pages()
+        self.assertEqual(u''.join(self.shown(pg) for pg in pages), self.txt.text)
+        for pg in pages[1:-1]:
+            self.assertLessEqual(pg._store.length(), 2*text_module.PAGE_WINDOW)
+            self.assertTrue(pg._store.string().endswith(u' ')) # (cut at a word break)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# encoding: utf-8
+import os
+import sys
+import random
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../../..'))
+
+import plotdevice
+from plotdevice import DeviceError
+from plotdevice.util import XMLParser, ElementIndex, Element
+from fixtures import xml_document
+
+def _absolute(batches):
+    # merge the per-batch regions into a single dict of absolute ranges
+    text, regions = u'', {}
+    for txt, batch in batches:
+        for cascade, runs in batch.items():
+            regions.setdefault(cascade, []).extend((start+len(text), length) for start, length in runs)
+        text += txt
+    return text, regions
+
+class XMLStreamTests(unittest.TestCase):
+    def test_batches_match_a_single_parse(self):
+        xml = xml_document()
+        whole = XMLParser(xml)
+        for batch in (64, 1000, 10000):
+            index = ElementIndex()
+            text, regions = _absolute(XMLParser.stream(xml, nodes=index, batch=batch))
+            self.assertEqual(text, whole.text)
+            self.assertEqual(sorted(regions), sorted(whole.regions))
+            for cascade in regions:
+                self.assertEqual(sorted(regions[cascade]), sorted(whole.regions[cascade]))
+            for tag in ('doc', 'p', 'b', 'i', 'br'):
+                self.assertEqual(index.get(tag), whole.nodes.get(tag))
+
+    def test_offsets_are_applied(self):
+        xml = xml_document(20)
+        whole = XMLParser(xml, offset=100)
+        index = ElementIndex()
+        list(XMLParser.stream(xml, offset=100, nodes=index, batch=64))
+        self.assertEqual(index.get('p'), whole.nodes.get('p'))
+        self.assertEqual(index.get('p')[0].start, 100)
+
+    def test_empty_input(self):
+        self.assertEqual(_absolute(XMLParser.stream(u'')), (u'', {}))
+
+    def test_errors_report_the_right_line(self):
+        xml = xml_document(50).replace(u'para 40 has <b>bold</b>', u'para 40 has <b>bold</i>')
+        with self.assertRaises(DeviceError) as cm:
+            list(XMLParser.stream(xml, batch=64))
+        self.assertIn(u'para 40 has', unicode(cm.exception))
+
+class ElementIndexTests(unittest.TestCase):
+    def setUp(self):
+        rand = random.Random(1024)
+        self.elts = []
+        for i in range(400):
+            start = rand.randint(0, 5000)
+            length = rand.choice([0, 0, 1, 5, 40, 300, 2000]) # incl. self-closed & long-running tags
+            self.elts.append(Element(rand.choice('abc'), {}, (), start, start+length))
+        self.index = ElementIndex(self.elts)
+        self.rand = rand
+
+    def expected(self, tag, start=None, end=None, delta=0, floor=float('-inf')):
+        # the brute-force equivalent of scan()
+        found = []
+        for elt in sorted([e for e in self.elts if e.tag == tag], key=lambda e:e.start):
+            elt = elt._replace(start=elt.start+delta, end=elt.end+delta)
+            if elt.end <= floor:
+                continue
+            if start is not None and elt.end <= start and not elt.start == elt.end == start:
+                continue
+            if end is not None and elt.start >= end:
+                continue
+            found.append(elt)
+        return found
+
+    def check(self, index, delta=0):
+        floor = 0 if delta < 0 else float('-inf') # (shifting left cuts off anything ending <= 0)
+        for tag in 'abc':
+            self.assertEqual(list(index.scan(tag)), self.expected(tag, delta=delta, floor=floor))
+            for i in range(50):
+                start = self.rand.randint(-100, 5500)
+                end = start + self.rand.choice([0, 1, 10, 500, 3000])
+                self.assertEqual(list(index.scan(tag, start, end)),
+                                 self.expected(tag, start, end, delta, floor))
+                self.assertEqual(list(index.scan(tag, start=start)),
+                                 self.expected(tag, start=start, delta=delta, floor=floor))
+                self.assertEqual(list(index.scan(tag, end=end)),
+                                 self.expected(tag, end=end, delta=delta, floor=floor))
+
+    def test_scan(self):
+        self.check(self.index)
+
+    def test_shifted(self):
+        for delta in (-1000, -2500, 300):
+            self.check(self.index.shifted(delta), delta)
+        self.check(self.index.shifted(-1000).shifted(-1500), -2500)
+
+    def test_shifting_leaves_the_original_alone(self):
+        before = self.index.get('a')
+        self.index.shifted(-2000).add(Element('a', {}, (), 0, 10))
+        self.assertEqual(self.index.get('a'), before)
+
+    def test_adding_after_a_shift(self):
+        shifted = self.index.shifted(-1000)
+        shifted.add(Element('a', {}, (), 10, 20))
+        self.assertIn(Element('a', {}, (), 10, 20), shifted.get('a'))
+        self.assertNotIn(Element('a', {}, (), 1010, 1020), self.index.get('a'))
+
+    def test_mapping_interface(self):
+        shifted = self.index.shifted(-10000) # everything's been cut off
+        self.assertEqual(len(shifted), 0)
+        self.assertEqual(shifted.keys(), [])
+        self.assertNotIn('a', shifted)
+        self.assertEqual(len(self.index), len(self.elts))
+        self.assertEqual(sorted(self.index.keys()), ['a', 'b', 'c'])
+
+    def test_overlapping(self):
+        found = self.index.overlapping(1000, 1200)
+        self.assertEqual(found, sorted(sum([self.expected(t, 1000, 1200) for t in 'abc'], []), key=lambda e:e.start))
+
+if __name__ == '__main__':
+    unittest.main()
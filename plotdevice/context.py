@@ -1,14 +1,18 @@
 # encoding: utf-8
-import os, re, types
+import os, re, types, copy
 from contextlib import contextmanager, nested
 from collections import namedtuple
+from multiprocessing import cpu_count
 from os.path import exists, expanduser
 
 from .lib.cocoa import *
 from .lib import pathmatics
+from .lib.io import bitmap_data, png_data, png, ContentHash
 from .util import _copy_attr, _copy_attrs, _flatten, trim_zeroes, numlike, autorelease
 from .gfx.geometry import Dimension, parse_coords
 from .gfx.typography import Layout
+from .gfx.image import ImageCache
+from .gfx.text import MetricsCache, StyleCache
 from .gfx import *
 from . import gfx, lib, util, Halted, DeviceError
 
@@ -33,7 +37,9 @@ class Context(object):
         """
         self.canvas = Canvas() if canvas is None else canvas
         self._ns = {} if ns is None else ns
-        self._imagecache = {}
+        self._imagecache = ImageCache()
+        self._textcache = MetricsCache()
+        self._stylecache = StyleCache()
         self._statestack = []
         self._vars = []
 
@@ -72,6 +78,9 @@ class Context(object):
         """Do a thorough reset of all the state variables"""
         self._activate()
 
+        # images drawn in the previous frame can be evicted from the cache again
+        self._imagecache.unpin()
+
         # color state
         self._colormode = RGB
         self._colorrange = 1.0
@@ -1242,10 +1251,40 @@ class Context(object):
         text_args = {k:v for k,v in kwargs.items() if k in Text._opts}
         return Text(txt, x, y, **text_args).path
 
+    def labels(self, strings, xs, ys, **kwargs):
+        """Draw a batch of short strings, each at its own position
+
+        Usage:
+          labels(strings, xs, ys, **kwargs)
+
+        Arguments:
+          - `strings` is a list of unicode strings or utf-8 encoded bytestrings
+          - `xs` & `ys` are lists of coordinates (one per string) or single values to be
+            shared by all the labels. Each `y` is the baseline of its label and each `x`
+            is its left edge, center, or right edge depending on the current align() setting.
+
+        Keyword Args:
+          Accepts the same styling arguments as text() (which apply to every label) along
+          with `plot` to control whether the Labels are drawn to the canvas immediately.
+
+        Returns:
+          A Labels object. Its `widths` and `heights` properties are lists with the
+          dimensions of the individual labels.
+
+        Since the strings are typeset together and drawn as a single graphics object,
+        labels() is much faster than calling text() once per string when plotting large
+        numbers of them (e.g., axis ticks or data-point annotations).
+        """
+        draw = self._should_plot(kwargs)
+        Labels.validate(kwargs)
+        lbls = Labels(strings, xs, ys, **kwargs)
+        if draw:
+            lbls.draw()
+        return lbls
+
     def textmetrics(self, txt, width=None, height=None, **kwargs):
         """Legacy command. Equivalent to: measure(txt, width, height)"""
-        txt = Text(txt, 0, 0, width, height, **kwargs)
-        return txt.metrics
+        return self._textcache.measure(txt, width, height, **kwargs)
 
     def textwidth(self, txt, width=None, **kwargs):
         """Legacy command. Equivalent to: measure(txt, width).width"""
@@ -1336,6 +1375,22 @@ class Context(object):
         img = Image(path, data=data)
         return img.size
 
+    def prefetch(self, paths, window=8):
+        """Start loading a sequence of image files in the background
+
+        Decodes the files on a pool of threads so they're ready by the time image() is called
+        with each path. Images are loaded in order and at most `window` of them will be decoded
+        ahead of their use at any time (drawing a path lets the next one start, and any earlier
+        paths that were skipped rather than drawn are given up on). Returns the list of paths,
+        so it can wrap a call to files() in a loop:
+
+            for fn in prefetch(files('~/Pictures/*.jpg')):
+                image(fn, 0, 0, width=60)
+        """
+        paths = list(paths)
+        self._imagecache.prefetch(paths, window)
+        return paths
+
     ### draw, erase, and save-to-file ###
 
     def _should_plot(self, opts):
@@ -1510,12 +1565,15 @@ class Context(object):
 
         When called with a string, the size will reflect the current font() settings
         and will layout the text using the optional `width` and `height` arguments.
+        Passing approx=True will estimate the size of single-line strings from the
+        font's character widths rather than typesetting them (and verify=True will
+        override it, making it simple to double-check a final measurement).
 
         If `obj` if a file() object, PlotDevice will treat it as an image file and
         return its pixel dimensions.
         """
         if isinstance(obj, basestring):
-            obj = Text(obj, 0, 0, width, height, **kwargs)
+            return self._textcache.measure(obj, width, height, **kwargs)
 
         if hasattr(obj, 'metrics'):
             return obj.metrics
@@ -1610,8 +1668,12 @@ class _PDFRenderView(NSView):
         return True
 
 class Canvas(object):
+    _background = None
 
     def __init__(self, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT, unit=px):
+        self._version = self._base = 0 # content version & the last non-append change
+        self._raster = None             # (version, base, zoom, pagesize, len(grobs), digest, NSImage)
+        self._hasher = None             # ContentHash used to notice in-place changes to grobs
         self.unit = unit
         self.width = width
         self.height = height
@@ -1635,6 +1697,7 @@ class Canvas(object):
         else:
             for grob in grobs:
                 self._drop(grob, self._grobs)
+        self._touch()
 
     def _drop(self, grob, container):
         if grob in container:
@@ -1653,6 +1716,20 @@ class Canvas(object):
         dpx = self.unit.basis
         return Size(self.width*dpx, self.height*dpx)
 
+    def _touch(self, appended=False):
+        # bump the content version (noting whether the rasterized bitmap can just be drawn
+        # over to bring it up to date or whether the whole display list needs to be redrawn)
+        self._version += 1
+        if not appended:
+            self._base = self._version
+
+    def _get_background(self):
+        return self._background
+    def _set_background(self, bg):
+        self._background = bg
+        self._touch()
+    background = property(_get_background, _set_background)
+
     def _get_unit(self):
         return self._unit
     def _set_unit(self, u):
@@ -1672,10 +1749,33 @@ class Canvas(object):
     def __getitem__(self, index):
         return self._grobs[index]
 
+    def _snapshot(self):
+        """Return a copy of the canvas with its own display list (and copies of the grobs) so
+        the current frame can be rasterized in the background while the next one is drawn
+        without the script's modifications to retained grobs leaking into it"""
+        snap = object.__new__(Canvas)
+        snap.__dict__.update(self.__dict__)
+        snap._grobs = snap._container = [Canvas._frozen(grob) for grob in self._grobs]
+        snap._stack = [snap._container]
+        snap._raster = snap._hasher = None
+        return snap
+
+    @staticmethod
+    def _frozen(grob):
+        # Frobs (effects & stencils) don't copy their contents so duplicate them by hand
+        if hasattr(grob, 'contents'):
+            frob = copy.copy(grob)
+            frob._grobs = [Canvas._frozen(g) for g in grob.contents]
+            if getattr(frob, 'bmp', None) is not None:
+                frob.bmp = frob.bmp.copy() # (an image-based stencil's pixels can change too)
+            return frob
+        return grob.copy() # (Images get a private copy of their pixels if they've been accessed)
+
     def append(self, el):
         # when beziers, images, and text are added, they're placed in the current
         # tail of the container stack (see push/pop)
         self._container.append(el)
+        self._touch(appended=self._container is self._grobs)
 
     def push(self, containerFrob):
         # when Frobs like Stencils or Effects are added, they become their own container
@@ -1683,16 +1783,18 @@ class Canvas(object):
         self._stack.insert(0, containerFrob)
         self._container.append(containerFrob)
         self._container = containerFrob
+        self._touch()
 
     def pop(self):
         try:
             del self._stack[0]
             self._container = self._stack[0]
+            self._touch()
         except IndexError, e:
             raise DeviceError, "pop: too many canvas pops!"
 
-    def draw(self):
-        if self.background is not None:
+    def draw(self, start=0):
+        if self.background is not None and not start:
             rect = ((0,0), self.pagesize)
             if isinstance(self.background, Gradient):
                 self.background.fill(rect)
@@ -1701,7 +1803,7 @@ class Canvas(object):
                 NSRectFillUsingOperation(rect, NSCompositeSourceOver)
 
         with autorelease():
-            for grob in self._grobs:
+            for grob in self._grobs[start:]:
                 grob._draw()
         # import cProfile
         # cProfile.runctx('[grob._draw() for grob in self._grobs*10]', globals(), {"self":self}, sort='cumulative')
@@ -1760,17 +1862,88 @@ class Canvas(object):
         img.addRepresentation_(offscreen)
         return img
 
-    def rasterize(self, zoom=1.0):
-        """Return an NSImage with the canvas dimensions scaled to the specified zoom level"""
+    def _rgba(self, zoom=1.0):
+        """Return an (h,w,4) numpy array of 8-bit RGBA (premultiplied) pixels with the canvas
+        drawn into it at the specified zoom level"""
+        import numpy
+        from Cocoa import NSBitmapImageRep, NSDeviceRGBColorSpace
+        w, h = [int(dim*zoom) for dim in self.pagesize]
+        pixels = numpy.zeros((h, w, 4), dtype=numpy.uint8)
+
+        # let the bitmap draw directly into the array's buffer
+        rep = NSBitmapImageRep.alloc().initWithBitmapDataPlanes_pixelsWide_pixelsHigh_bitsPerSample_samplesPerPixel_hasAlpha_isPlanar_colorSpaceName_bitmapFormat_bytesPerRow_bitsPerPixel_(
+          (pixels, None, None, None, None), w, h, 8, 4, True, False, NSDeviceRGBColorSpace, 0, w*4, 32
+        )
+
+        port = NSGraphicsContext.graphicsContextWithBitmapImageRep_(rep).graphicsPort()
+        ns_ctx = NSGraphicsContext.graphicsContextWithGraphicsPort_flipped_(port, True)
+        NSGraphicsContext.saveGraphicsState()
+        NSGraphicsContext.setCurrentContext_(ns_ctx)
+        trans = NSAffineTransform.transform()
+        trans.translateXBy_yBy_(0, h)
+        trans.scaleXBy_yBy_(zoom,-zoom)
+        trans.concat()
+        self.draw()
+        NSGraphicsContext.restoreGraphicsState()
+        return pixels
+
+    def rasterize(self, zoom=1.0, cached=True):
+        """Return an NSImage with the canvas dimensions scaled to the specified zoom level
+
+        The most recent bitmap is kept around and returned as-is if the canvas hasn't changed
+        since it was drawn. If the only changes have been grobs added to the top level of the
+        canvas, they're drawn over a copy of the previous bitmap rather than starting from
+        scratch. Either way, a bitmap is never altered once it's been returned.
+
+        Since grobs that are already on the canvas can be modified in place, a bitmap is only
+        reused if a content-hash of the grobs it was drawn from still matches. The hash is
+        only taken once the canvas has been rasterized a second time without being cleared in
+        between (so canvases that are redrawn from scratch every frame don't pay for it).
+        Passing cached=False ignores the previous bitmap altogether (and doesn't replace it).
+        """
         w,h = self.pagesize
+        start, prev, verify = 0, None, False
+        if cached and self._raster:
+            version, base, r_zoom, r_size, count, digest, image = self._raster
+            if (r_zoom, r_size) == (zoom, (w,h)) and base == self._base:
+                verify = True
+                if digest is not None and digest == self._digest(count):
+                    if version == self._version:
+                        return image
+                    start, prev = count, image
+
         img = NSImage.alloc().initWithSize_((w*zoom, h*zoom))
         img.setFlipped_(True)
         img.lockFocus()
+        if prev:
+            rect = ((0,0), (w*zoom, h*zoom))
+            prev.drawInRect_fromRect_operation_fraction_respectFlipped_hints_(rect, rect, NSCompositeCopy, 1.0, True, None)
         trans = NSAffineTransform.transform()
         trans.scaleBy_(zoom)
         trans.concat()
-        self.draw()
+        self.draw(start)
         img.unlockFocus()
+
+        if cached:
+            digest = self._digest() if verify else None
+            self._raster = (self._version, self._base, zoom, (w,h), len(self._grobs), digest, img)
+        return img
+
+    def _digest(self, count=None):
+        # a content-hash of the background and the first `count` grobs
+        if self._hasher is None:
+            self._hasher = ContentHash()
+        return self._hasher((self.background, self._grobs[:count]))
+
+    def snapshot(self, zoom=1.0):
+        """Return an Image of the canvas's current contents (without adding it to the canvas)
+
+        The `zoom` factor sets the resolution of the bitmap but the Image will still be sized
+        to cover the canvas. The bitmap is reused (see rasterize) if the canvas is unchanged
+        since the last snapshot.
+        """
+        img = Image(None, 0, 0, self.width, self.height)
+        img._nsImage = self.rasterize(zoom)
         return img
 
     def _getImageData(self, format):
@@ -1780,23 +1953,10 @@ class Canvas(object):
         elif format == 'eps':
             view = _PDFRenderView.alloc().initWithCanvas_(self)
             return view.dataWithEPSInsideRect_(view.bounds())
+        elif format == 'png' and png is not None:
+            return png_data(self._rgba(), threads=cpu_count())
         else:
-            imgTypes = {"gif":  NSGIFFileType,
-                        "jpg":  NSJPEGFileType,
-                        "jpeg": NSJPEGFileType,
-                        "png":  NSPNGFileType,
-                        "tiff": NSTIFFFileType}
-            if format not in imgTypes:
-                badformat = "Filename should end in .pdf, .eps, .tiff, .gif, .jpg or .png"
-                raise DeviceError(badformat)
-            data = self.rasterize().TIFFRepresentation()
-            if format != 'tiff':
-                imgType = imgTypes[format]
-                rep = NSBitmapImageRep.imageRepWithData_(data)
-                props = {NSImageCompressionFactor:1.0} if format in ('jpg','jpeg') else None
-                return rep.representationUsingType_properties_(imgType, props)
-            else:
-                return data
+            return bitmap_data(self.rasterize(cached=False), format)
 
     def save(self, fname, format=None):
         """Write the current graphics objects to an image file"""
@@ -1,11 +1,14 @@
 # encoding: utf-8
 import os
 import re
+import objc
 from contextlib import contextmanager
+from threading import RLock, Event, Thread
+from Queue import Queue
 from ..lib.cocoa import *
 
 from plotdevice import DeviceError
-from ..util import _copy_attr, _copy_attrs, numlike
+from ..util import _copy_attr, _copy_attrs, numlike, autorelease, odict
 from .colors import Color
 from .geometry import Point
 from . import _cg_context, _cg_layer, _cg_port
@@ -297,6 +300,7 @@ class Stencil(Frob):
             self.channel = channel
             self.invert = invert
             self.bmp = stencil
+            _masks.prefetch(stencil, channel, invert) # start rendering the mask in the background
 
     def set(self):
         port = _cg_port()
@@ -316,19 +320,8 @@ class Stencil(Frob):
                 CGContextClip(port)
 
         elif hasattr(self, 'bmp'):
-            # run the filter chain and render to a cg-image
-            singlechannel = ciFilter(self.channel, self.bmp._ciImage)
-            greyscale = ciFilter(self.invert, singlechannel)
-            ci_ctx = CIContext.contextWithOptions_(None)
-            maskRef = ci_ctx.createCGImage_fromRect_(greyscale, ((0,0), self.bmp.size))
-
-            # turn the image into an ‘imagemask’ cg-image
-            cg_mask = CGImageMaskCreate(CGImageGetWidth(maskRef),
-                                        CGImageGetHeight(maskRef),
-                                        CGImageGetBitsPerComponent(maskRef),
-                                        CGImageGetBitsPerPixel(maskRef),
-                                        CGImageGetBytesPerRow(maskRef),
-                                        CGImageGetDataProvider(maskRef), None, False);
+            # reuse the mask from a previous frame (or the background render) if possible
+            cg_mask = _masks.get(self.bmp, self.channel, self.invert)
 
             # the mask is sitting at (0,0) until transformed to screen coords
             xf = self.bmp._screen_transform
@@ -345,6 +338,116 @@ class ClippingPath(Stencil):
     pass # NodeBox compat...
 
 
+### image-mask cache ###
+
+STENCIL_CACHE_BUDGET = 64 * 1024 * 1024 # bytes of mask data to hold onto between uses
+
+class MaskCache(object):
+    """An LRU cache of the cg image-masks generated for Image-based Stencils
+
+    Masks are keyed by the NSImage they were rendered from (a reference to which is kept in
+    the cache so its id can't be reused) along with the channel, inversion, and size. Entries
+    can be computed ahead of time on a background thread via prefetch() and get() will wait
+    for any such render that's still in progress rather than duplicating the work.
+    """
+    def __init__(self, budget=STENCIL_CACHE_BUDGET):
+        self.budget = budget
+        self._entries = odict() # key -> (NSImage, mask, nbytes)
+        self._pending = {}      # key -> Event (set once a background render finishes)
+        self._usage = 0
+        self._lock = RLock()
+        self._queue = None
+
+    def get(self, img, channel, invert):
+        """Return the image-mask for a given Image, channel, and inversion"""
+        key = self._key(img, channel, invert)
+        if key is None:
+            return _stencil_mask(img, channel, invert)
+
+        with self._lock:
+            pending = self._pending.get(key)
+        if pending:
+            pending.wait()
+
+        with self._lock:
+            if key in self._entries:
+                entry = self._entries.pop(key)
+                self._entries[key] = entry # move to the most-recently-used end
+                return entry[1]
+        return self._put(key, img._nsImage, _stencil_mask(img, channel, invert))
+
+    def prefetch(self, img, channel, invert):
+        """Start rendering an image-mask on the background thread (if it isn't already cached)"""
+        if img._pending:
+            return # don't block on a url that's still downloading
+        key = self._key(img, channel, invert)
+        with self._lock:
+            if key is None or key in self._entries or key in self._pending:
+                return
+            self._pending[key] = Event()
+            if self._queue is None:
+                self._queue = Queue()
+                worker = Thread(target=self._work, name='plotdevice-masks')
+                worker.daemon = True
+                worker.start()
+        self._queue.put((key, img, channel, invert))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._usage = 0
+
+    def _key(self, img, channel, invert):
+        if img._pixels is not None:
+            return None # the bitmap is mutable so its mask can't be reused
+        return (objc.pyobjc_id(img._nsImage), channel, invert, tuple(img.size))
+
+    def _put(self, key, image, mask):
+        nbytes = CGImageGetBytesPerRow(mask) * CGImageGetHeight(mask)
+        with self._lock:
+            if key in self._entries:
+                self._usage -= self._entries.pop(key)[2]
+            self._entries[key] = (image, mask, nbytes)
+            self._usage += nbytes
+            while self._usage > self.budget and len(self._entries) > 1:
+                _, (_, _, size) = self._entries.popitem(last=False)
+                self._usage -= size
+        return mask
+
+    def _work(self):
+        while True:
+            key, img, channel, invert = self._queue.get()
+            try:
+                with autorelease():
+                    self._put(key, img._nsImage, _stencil_mask(img, channel, invert))
+            except Exception:
+                pass # let get() re-raise the error when it tries again in the foreground
+            finally:
+                with self._lock:
+                    self._pending.pop(key).set()
+
+_masks = MaskCache()
+
+def _stencil_mask(img, channel, invert):
+    """Run the filter chain on an Image and return the result as an ‘imagemask’ cg-image"""
+    singlechannel = ciFilter(channel, img._ciImage)
+    greyscale = ciFilter(invert, singlechannel)
+    maskRef = _ci_context().createCGImage_fromRect_(greyscale, ((0,0), img.size))
+    return CGImageMaskCreate(CGImageGetWidth(maskRef),
+                             CGImageGetHeight(maskRef),
+                             CGImageGetBitsPerComponent(maskRef),
+                             CGImageGetBitsPerPixel(maskRef),
+                             CGImageGetBytesPerRow(maskRef),
+                             CGImageGetDataProvider(maskRef), None, False)
+
+_ci_ctx = None
+def _ci_context():
+    # core-image contexts are expensive to set up (but safe to share between threads)
+    global _ci_ctx
+    if _ci_ctx is None:
+        _ci_ctx = CIContext.contextWithOptions_(None)
+    return _ci_ctx
+
 ### core-image filters for channel separation and inversion ###
 
 def ciFilter(opt, img):
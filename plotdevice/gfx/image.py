@@ -4,12 +4,20 @@ import re
 import json
 import warnings
 import math
+import objc
+import struct
+from hashlib import sha1
 from contextlib import contextmanager
+from threading import RLock, Event, Thread
+from collections import deque
+from Queue import Queue
+from multiprocessing import cpu_count
 from ..lib.cocoa import *
 
 from plotdevice import DeviceError
-from ..util import _copy_attrs, autorelease
-from ..util.http import GET
+from ..util import _copy_attrs, autorelease, odict
+from ..util.disk import atomic_write, DiskQuota
+from ..util.http import GET, fetch_async
 from ..lib.io import MovieExportSession, ImageExportSession
 from .geometry import Region, Size, Point, Transform, CENTER
 from .atoms import TransformMixin, EffectsMixin, BoundsMixin, Grob
@@ -18,11 +26,23 @@ from . import _ns_context
 _ctx = None
 __all__ = ("Image", 'ImageWriter')
 
+# default memory limit for decoded images held by the ImageCache (in bytes)
+IMAGE_CACHE_BUDGET = 512 * 1024 * 1024
+
+# default disk space limit for the ThumbnailCache (in bytes)
+THUMBNAIL_CACHE_CAPACITY = 1024 * 1024 * 1024
+
+# default number of images the ImagePrefetcher will decode ahead of their use
+PREFETCH_WINDOW = 8
+
 ### The bitmap/vector image-container (a.k.a. NSImage proxy) ###
 
 class Image(EffectsMixin, TransformMixin, BoundsMixin, Grob):
     stateAttrs = ('_nsImage',)
     opts = ('data',)
+    _image = None   # the NSImage (once loaded)
+    _pending = None # a (url, Future) pair for a download that's still in flight
+    _pixels = None  # the numpy array backing the bitmap (once .pixels has been accessed)
 
     def __init__(self, *args, **kwargs):
         """
@@ -40,6 +60,10 @@ class Image(EffectsMixin, TransformMixin, BoundsMixin, Grob):
           - alpha: the image opacity (0-1.0)
           - blend: a blend mode name
 
+        Images with a url as their src are downloaded in the background (concurrently with
+        any others that have been created) and only waited for once the image's pixels or
+        dimensions are needed (typically when the canvas is drawn).
+
          Example usage:
            x,y, w,h = 10,10, 200,200
            Image("foo.png", x, y, w, h)
@@ -68,8 +92,14 @@ class Image(EffectsMixin, TransformMixin, BoundsMixin, Grob):
             if isinstance(src, NSImage):
                 self._nsImage = src.copy()
                 self._nsImage.setFlipped_(True)
+            elif getattr(src, '_pixels', None) is not None:
+                # don't let two Images write to the same pixel buffer
+                pixels = src._pixels.copy()
+                self._nsImage, self._pixels = _pixel_image(pixels, src._nsImage.size()), pixels
             elif hasattr(src, '_nsImage'):
                 self._nsImage = src._nsImage
+            elif isinstance(src, basestring) and re.match(r'https?:', src):
+                self._pending = (src, fetch_async(src))
             elif isinstance(src, basestring):
                 self._nsImage = self._lazyload(path=src)
             else:
@@ -90,13 +120,66 @@ class Image(EffectsMixin, TransformMixin, BoundsMixin, Grob):
                 if k in BoundsMixin.opts:
                     setattr(self, k, v)
 
-    def _lazyload(self, path=None, data=None):
+    def copy(self):
+        """Returns a deep copy of this grob (with its own copy of any .pixels buffer)"""
+        clone = Image()
+        _copy_attrs(self, clone, self._state.difference(['_nsImage']))
+        if self._pixels is not None:
+            # don't let two Images write to the same pixel buffer
+            pixels = self._pixels.copy()
+            clone._nsImage, clone._pixels = _pixel_image(pixels, self._nsImage.size()), pixels
+        else:
+            # otherwise the NSImage is never modified so it can be shared (as can a pending download)
+            clone._image, clone._pending = self._image, self._pending
+        return clone
+
+    def _get_nsImage(self):
+        if self._pending:
+            # finish loading a url that was queued up in the constructor
+            (url, download), self._pending = self._pending, None
+            self._image = self._lazyload(path=url, response=download.result())
+        return self._image
+    def _set_nsImage(self, image):
+        self._pending = self._pixels = None
+        self._image = image
+    _nsImage = property(_get_nsImage, _set_nsImage)
+
+    @classmethod
+    def from_array(cls, pixels, *args, **kwargs):
+        """Create an Image from an (h,w,4) or (h,w,3) numpy array of 8-bit RGB(A) pixels
+
+        RGBA arrays should be premultiplied (i.e., in the same format as the .pixels property).
+        If the array is already a contiguous block of RGBA bytes it will be used as the image's
+        buffer directly, meaning later changes to its contents will show up in the image.
+
+        Any additional arguments are handled the same way as in the Image constructor:
+          Image.from_array(arr, x, y, width=w)
+        """
+        import numpy
+        pixels = numpy.asarray(pixels)
+        if pixels.dtype != numpy.uint8 or pixels.ndim != 3 or pixels.shape[2] not in (3, 4):
+            badarray = 'Expected an (h,w,4) or (h,w,3) array of uint8 pixels (not %s %r)' % (pixels.dtype, pixels.shape)
+            raise DeviceError(badarray)
+        if pixels.shape[2] == 3:
+            opaque = numpy.empty(pixels.shape[:2] + (4,), dtype=numpy.uint8)
+            opaque[..., :3], opaque[..., 3] = pixels, 255
+            pixels = opaque
+
+        img = cls(None, *args, **kwargs)
+        pixels = numpy.ascontiguousarray(pixels)
+        img._nsImage, img._pixels = _pixel_image(pixels), pixels
+        return img
+
+    def _lazyload(self, path=None, data=None, response=None):
         # loads either a `path` or `data` kwarg and returns an NSImage
-        # `path` should be the path of a valid image file
+        # `path` should be the path of a valid image file (or a url)
+        # `response` is an already-fetched http.Response for a url `path`
         # `data` should be the bytestring contents of an image file, or base64-encoded
         #        with the characters "base64," prepended to it
         NSDataBase64DecodingIgnoreUnknownCharacters = 1
         _cache = _ctx._imagecache
+        origin = None # the source file (if any)
+        dims = None   # its pixel dimensions (if it's a bitmap that hasn't been decoded yet)
 
         if data is not None:
             # convert the str into an NSData (possibly decoding along the way)
@@ -107,18 +190,20 @@ class Image(EffectsMixin, TransformMixin, BoundsMixin, Grob):
             key, mtime, err_info = data.hash(), None, type(data)
 
             # return a cached image if possible...
-            if key in _cache:
-                return _cache[key][0]
+            cached = _cache.get(key)
+            if cached is not None:
+                return cached
             # ...or load from the data
             image = NSImage.alloc().initWithData_(data)
         elif path is not None:
             if re.match(r'https?:', path):
-                # load from url
+                # load from url (unless it was already fetched in the background)
                 key = err_info = path
-                resp, mtime = GET(path)
+                resp, mtime = (response, response.mtime) if response else GET(path)
                 # return a cached image if possible...
-                if path in _cache and _cache[path][1] >= mtime:
-                    return _cache[path][0]
+                cached = _cache.get(path, mtime)
+                if cached is not None:
+                    return cached
                 # ...or load from the data
                 bytes = resp.read()
                 data = NSData.dataWithBytes_length_(bytes, len(bytes))
@@ -127,26 +212,31 @@ class Image(EffectsMixin, TransformMixin, BoundsMixin, Grob):
                 # load from file path
                 try:
                     path = NSString.stringByExpandingTildeInPath(path)
+                    _cache.wait(path) # let any in-progress prefetch finish
                     mtime = os.path.getmtime(path)
                     # return a cached image if possible...
-                    if path in _cache and _cache[path][1] >= mtime:
-                        return _cache[path][0]
+                    cached = _cache.get(path, mtime)
+                    if cached is not None:
+                        return cached
                 except:
                     notfound = 'Image "%s" not found.' % path
                     raise DeviceError(notfound)
-                key = err_info = path
-                # ...or load from the file
-                image = NSImage.alloc().initWithContentsOfFile_(path)
+                key = err_info = origin = path
+                # ...or load from the file. if reduced copies are being saved to disk, just
+                # reference it instead so the original isn't read and decoded unless it winds
+                # up being drawn at full size (ImageCache.mipmap checks the disk first)
+                dims = _cache.disk and _pixel_dims(path)
+                if dims:
+                    image = NSImage.alloc().initByReferencingFile_(path)
+                else:
+                    image = NSImage.alloc().initWithContentsOfFile_(path)
 
         # if we wound up with a valid image, configure and cache the NSImage
         # before returning it
         if image is None:
             invalid = "Doesn't seem to contain image data: %r" % err_info
             raise DeviceError(invalid)
-        image.setFlipped_(True)
-        image.setCacheMode_(NSImageCacheNever)
-        _cache[key] = (image, mtime)
-        return _cache[key][0]
+        return _cache.put(key, _configured(image), mtime, origin=origin, dims=dims or None)
 
     @property
     def image(self):
@@ -167,6 +257,34 @@ class Image(EffectsMixin, TransformMixin, BoundsMixin, Grob):
             bitmap = image.representations()[0]
         return bitmap
 
+    def _get_pixels(self):
+        if self._pixels is None:
+            # render the image into a private buffer (leaving the cached NSImage unaltered)
+            import numpy
+            bitmap = self._nsBitmap
+            w, h = bitmap.pixelsWide(), bitmap.pixelsHigh()
+            pixels = numpy.zeros((h, w, 4), dtype=numpy.uint8)
+            image = _pixel_image(pixels, self._nsImage.size())
+            ns_ctx = NSGraphicsContext.graphicsContextWithBitmapImageRep_(image.representations()[0])
+            NSGraphicsContext.saveGraphicsState()
+            NSGraphicsContext.setCurrentContext_(ns_ctx)
+            bitmap.drawInRect_(((0,0), (w,h)))
+            NSGraphicsContext.restoreGraphicsState()
+            self._nsImage, self._pixels = image, pixels
+
+        # let the bitmap know its contents may be about to change
+        # (so it doesn't draw from a stale copy the next time around)
+        for rep in self._nsImage.representations():
+            rep.bitmapData()
+        return self._pixels
+    def _set_pixels(self, pixels):
+        self._get_pixels()[:] = pixels
+    pixels = property(_get_pixels, _set_pixels, doc="""An (h,w,4) numpy array of the image's 8-bit RGBA pixels
+
+        The color values are premultiplied by the alpha channel and the first row is the top
+        of the image. The array is the bitmap's actual storage, so modifying it in place will
+        alter the image the next time it's drawn.""")
+
     @property
     def _ciImage(self):
         # core-image needs to be told to compensate for our flipped coords
@@ -235,6 +353,21 @@ class Image(EffectsMixin, TransformMixin, BoundsMixin, Grob):
         xf.scale(factor)           # scale to fit size constraints (if any)
         return xf
 
+    def _mipmap(self, ns_ctx):
+        """Returns a power-of-two reduction of the image if it's about to be drawn at a fraction
+        of its pixel size (or None if the full-size image should be used)"""
+        if not ns_ctx.isDrawingToScreen():
+            return None # don't throw away any detail when generating pdf or eps output
+        if self._pixels is not None:
+            return None # the bitmap is mutable so its reductions can't be cached
+
+        # find the image's on-screen size by combining the _screen_transform (which has
+        # already been applied) with any zoom or backing-scale factor of the destination
+        m = CGContextGetUserSpaceToDeviceSpaceTransform(ns_ctx.graphicsPort())
+        w, h = self._nsImage.size()
+        size = (w * math.hypot(m.a, m.b), h * math.hypot(m.c, m.d))
+        return _ctx._imagecache.mipmap(self._nsImage, size)
+
     def _draw(self):
         """Draw an image on the given coordinates."""
 
@@ -243,14 +376,436 @@ class Image(EffectsMixin, TransformMixin, BoundsMixin, Grob):
             with self.effects.applied():    # apply any blend/alpha/shadow effects
                 ns_ctx.setImageInterpolation_(NSImageInterpolationHigh)
                 bounds = ((0,0), self._nsImage.size()) # draw the image at (0,0)
-                self._nsImage.drawAtPoint_fromRect_operation_fraction_((0,0), bounds, NSCompositeSourceOver, self.alpha)
+                reduced = self._mipmap(ns_ctx)
+                if reduced is not None:
+                    # scale a downsampled copy back up to the full-size image's bounds
+                    src = ((0,0), reduced.size())
+                    reduced.drawInRect_fromRect_operation_fraction_(bounds, src, NSCompositeSourceOver, self.alpha)
+                else:
+                    self._nsImage.drawAtPoint_fromRect_operation_fraction_((0,0), bounds, NSCompositeSourceOver, self.alpha)
                 # NB: the nodebox source warns about quartz bugs triggered by drawing
                 # EPSs to other origin points. no clue whether this still applies...
 
 
+### memory-bounded cache of decoded images (shared by all the Image objects in a context) ###
+
+class ImageCache(object):
+    """An LRU cache of the NSImages loaded by Image._lazyload (keyed by path, url, or data hash)
+
+    Each entry is charged for the memory its decoded bitmap will occupy (4 bytes per pixel)
+    and the least recently used images are dropped once the total exceeds `budget` bytes.
+    Images that have been requested since the last call to unpin() (i.e., the ones being
+    drawn in the current frame) are never evicted, even if that means exceeding the budget.
+
+    The cache also holds the mipmap chains (successive halvings) of bitmap images that are
+    drawn at a reduced size. These are built on demand, charged against the same budget, and
+    may be requested from the export pipeline's rasterizing thread (hence the lock).
+
+    If a `disk` directory is given (or the PLOTDEVICE_THUMBNAILS environment variable is set)
+    the reduced levels of images loaded from files are also saved to a ThumbnailCache there,
+    letting later runs skip decoding the full-size originals altogether.
+    """
+    def __init__(self, budget=IMAGE_CACHE_BUDGET, disk=None):
+        self.budget = budget
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self._entries = odict() # key -> (image, mtime, nbytes) in least- to most-recently used order
+        self._origins = {}      # pyobjc_id of a cached NSImage -> its cache key
+        self._files = {}        # key of an image loaded from a file -> its pixel dims (if known)
+        self._pinned = set()
+        self._lock = RLock()
+
+        disk = disk or os.environ.get('PLOTDEVICE_THUMBNAILS')
+        self.disk = ThumbnailCache(disk) if disk else None
+        self.prefetcher = None
+
+    def get(self, key, mtime=None, pin=True):
+        """Return the cached NSImage for `key` (or None if it's absent or older than `mtime`)
+
+        Unless `pin` is False, the entry can't be evicted until the next call to unpin().
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and mtime is not None and entry[1] < mtime:
+                self._drop(key)
+                entry = None
+            if not entry:
+                self.misses += 1
+                return None
+
+            self._entries[key] = self._entries.pop(key) # move to the most-recently-used end
+            if pin:
+                self._pinned.add(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, image, mtime=None, nbytes=None, origin=None, dims=None, pin=True):
+        """Add a newly loaded NSImage to the cache (evicting older entries if necessary)
+
+        If the image is a reference to a file that hasn't been read yet, its pixel `dims` should
+        be passed since they can't be determined without decoding it.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._drop(key) # also forgets the id of the image being replaced
+            if nbytes is None:
+                nbytes = 4 * dims[0] * dims[1] if dims else _decoded_size(image)
+            self._entries[key] = (image, mtime, nbytes)
+            self.nbytes += nbytes
+            if pin:
+                self._pinned.add(key)
+            if not _is_chain(key):
+                self._origins[objc.pyobjc_id(image)] = key
+                if origin:
+                    self._files[key] = dims
+            self._evict()
+            return image
+
+    def mipmap(self, image, size):
+        """Return the smallest power-of-two reduction of a bitmap NSImage whose pixel dimensions
+        are still at least `size` (or None if there's no smaller level that's large enough)"""
+        with self._lock:
+            origin = self._origin(image)
+            dims = self._files.get(origin[0]) if origin else None
+        if not (dims and self.disk):
+            rep = _bitmap_rep(image)
+            if rep is None:
+                return None # vector images are drawn at full resolution
+            dims = rep.pixelsWide(), rep.pixelsHigh()
+
+        pw, ph = dims
+        scale = max(size[0] / float(pw), size[1] / float(ph))
+        if not 0 < scale <= 0.5:
+            return None
+        depth = min(int(math.floor(math.log(1.0 / scale, 2))), int(math.log(max(pw, ph), 2)))
+
+        # the chain is stored as an (original, {depth:level}) pair. holding onto the full-size
+        # image keeps it from being deallocated and its id reused, but it's only charged to the
+        # chain if it isn't also in the cache under its own key (in which case evicting it
+        # drops the chain as well)
+        key = ('mipmap', objc.pyobjc_id(image))
+        with self._lock:
+            entry = self._entries.get(key)
+            owner = self._entries.get(self._origins.get(objc.pyobjc_id(image)))
+            cached = owner is not None and owner[0] is image
+        levels = dict(entry[0][1]) if entry else {}
+        levels[0] = image
+        if depth in levels:
+            self.get(key) # just mark the chain as recently used
+            return levels[depth]
+
+        # try loading the level from disk before resorting to decoding & resampling the original
+        level = None
+        if self.disk and origin:
+            dim = max(_level_size(pw, ph, depth))
+            level = self.disk.get(origin[0], origin[1], dim)
+        if level is None:
+            start = max(d for d in levels if d < depth)
+            for d in range(start+1, depth+1):
+                levels[d] = _halve(levels[d-1])
+            level = levels[depth]
+            if self.disk and origin:
+                self.disk.put(origin[0], origin[1], dim, level)
+        levels[depth] = level
+
+        del levels[0]
+        nbytes = sum(_decoded_size(lvl) for lvl in levels.values())
+        if not cached:
+            nbytes += _decoded_size(image)
+        self.put(key, (image, levels), nbytes=nbytes)
+        return level
+
+    def prefetch(self, paths, window=PREFETCH_WINDOW):
+        """Start decoding the image files at `paths` in the background (see ImagePrefetcher)"""
+        if self.prefetcher is None:
+            self.prefetcher = ImagePrefetcher(self)
+        self.prefetcher.window = window
+        self.prefetcher.add(paths)
+
+    def wait(self, path):
+        """Block until a prefetch of `path` (if one is in progress) has been added to the cache"""
+        if self.prefetcher:
+            self.prefetcher.claim(path)
+
+    def unpin(self):
+        """Allow the images used in the previous frame to be evicted"""
+        with self._lock:
+            self._pinned.clear()
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._origins.clear()
+            self._files.clear()
+            self._pinned.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Hit/miss/eviction counts and the current memory footprint"""
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    images=len(self._entries), bytes=self.nbytes, budget=self.budget)
+
+    def _origin(self, image):
+        # the (path, mtime) of the file a cached NSImage was loaded from
+        key = self._origins.get(objc.pyobjc_id(image))
+        entry = self._entries.get(key)
+        if key in self._files and entry and entry[0] is image:
+            return key, entry[1]
+
+    def _evict(self):
+        for key in list(self._entries):
+            if self.nbytes <= self.budget:
+                break
+            if key in self._pinned or key not in self._entries:
+                continue
+            self._drop(key)
+            self.evictions += 1
+
+    def _drop(self, key):
+        image, _, nbytes = self._entries.pop(key)
+        self.nbytes -= nbytes
+        if _is_chain(key):
+            return
+
+        # forget the image's id along with any mipmap chain built from it (which would
+        # otherwise keep the now-uncharged original alive)
+        img_id = objc.pyobjc_id(image)
+        if self._origins.get(img_id) == key:
+            del self._origins[img_id]
+        self._files.pop(key, None)
+        chain = self._entries.pop(('mipmap', img_id), None)
+        if chain:
+            self.nbytes -= chain[2]
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+class ImagePrefetcher(object):
+    """Decodes image files on a pool of background threads and adds them to an ImageCache
+
+    Paths are decoded in the order they were added and no more than `window` of them can be
+    decoded ahead of their use. A path holds its slot in the window until Image._lazyload claims
+    it (waiting for the decode to finish if it's still in progress), at which point the next
+    path in line is handed to the workers. Since paths are expected to be drawn in order,
+    claiming one also releases any earlier paths the script skipped over (and if it jumps
+    past the window altogether, the paths it skipped are dropped from the queue). Files that
+    fail to load are left for _lazyload to report.
+    """
+    def __init__(self, cache, workers=None, window=PREFETCH_WINDOW):
+        self.cache = cache
+        self.window = window
+        self._upcoming = deque() # (key, abspath) pairs not yet handed to the workers
+        self._queued = set()     # the keys in _upcoming
+        self._claims = odict()   # key -> Event that's set once the image is in the cache (for
+                                 # the paths in the window, in the order they were added)
+        self._lock = RLock()
+        self._jobs = Queue()
+        for i in range(workers or min(4, cpu_count())):
+            worker = Thread(target=self._work, name='plotdevice-prefetch')
+            worker.daemon = True
+            worker.start()
+
+    def add(self, paths):
+        # resolve relative paths now (while the cwd is still the script's directory) but key
+        # the cache entries the same way _lazyload will
+        with self._lock:
+            for path in paths:
+                key = NSString.stringByExpandingTildeInPath(path)
+                if key not in self._queued and key not in self._claims:
+                    self._queued.add(key)
+                    self._upcoming.append((key, os.path.abspath(key)))
+        self._fill()
+
+    def claim(self, key):
+        """Wait for a path to finish decoding (if it was prefetched) and free its slot in the window"""
+        done = None
+        with self._lock:
+            if key in self._claims:
+                # release any paths ahead of this one (which the script must have skipped)
+                for skipped in list(self._claims):
+                    if skipped == key:
+                        break
+                    del self._claims[skipped]
+                done = self._claims.pop(key)
+            elif key in self._queued:
+                # the script has jumped past the window so drop everything up to this path
+                # (which it will load for itself)
+                self._claims.clear()
+                while True:
+                    skipped, _ = self._upcoming.popleft()
+                    self._queued.discard(skipped)
+                    if skipped == key:
+                        break
+            else:
+                return
+        self._fill()
+        if done is not None:
+            done.wait()
+
+    def _fill(self):
+        with self._lock:
+            while self._upcoming and len(self._claims) < self.window:
+                key, path = self._upcoming.popleft()
+                self._queued.discard(key)
+                self._claims[key] = done = Event()
+                self._jobs.put((key, path, done))
+
+    def _work(self):
+        while True:
+            key, path, done = self._jobs.get()
+            try:
+                with autorelease():
+                    mtime = os.path.getmtime(path)
+                    # (don't pin the images since they may not be drawn in the current frame)
+                    if self.cache.get(key, mtime, pin=False) is None:
+                        image = NSImage.alloc().initWithContentsOfFile_(path)
+                        if image is not None:
+                            # touch the bitmap data to force the image to be decoded now
+                            # rather than lazily (on the main thread) when it's first drawn
+                            for rep in image.representations():
+                                if isinstance(rep, NSBitmapImageRep):
+                                    rep.bitmapData()
+                            self.cache.put(key, _configured(image), mtime, origin=key, pin=False)
+            except Exception:
+                pass
+            finally:
+                done.set() # (the slot stays taken until the path is claimed)
+
+def _is_chain(key):
+    # mipmap chains are keyed by ('mipmap', pyobjc_id) while images use a path, url, or hash
+    return isinstance(key, tuple) and key[0] == 'mipmap'
+
+def _configured(image):
+    # set up a freshly loaded NSImage for drawing in our flipped coordinate system
+    image.setFlipped_(True)
+    image.setCacheMode_(NSImageCacheNever)
+    return image
+
+def _pixel_image(pixels, size=None):
+    """Return an NSImage whose bitmap uses an (h,w,4) uint8 array as its backing store"""
+    h, w = pixels.shape[:2]
+    rep = NSBitmapImageRep.alloc().initWithBitmapDataPlanes_pixelsWide_pixelsHigh_bitsPerSample_samplesPerPixel_hasAlpha_isPlanar_colorSpaceName_bitmapFormat_bytesPerRow_bitsPerPixel_(
+      (pixels, None, None, None, None), w, h, 8, 4, True, False, NSDeviceRGBColorSpace, 0, w*4, 32
+    )
+    image = NSImage.alloc().initWithSize_(size or (w, h))
+    image.addRepresentation_(rep)
+    return _configured(image)
+
+def _pixel_dims(path):
+    # read a bitmap file's pixel dimensions from its header (without decoding the image)
+    src = CGImageSourceCreateWithURL(NSURL.fileURLWithPath_(path), None)
+    props = CGImageSourceCopyPropertiesAtIndex(src, 0, None) if src else None
+    if props and kCGImagePropertyPixelWidth in props:
+        return int(props[kCGImagePropertyPixelWidth]), int(props[kCGImagePropertyPixelHeight])
+    return None
+
+def _decoded_size(image):
+    # the largest of the image's bitmap reps (vector reps report 0 pixels so use the point size)
+    w, h = image.size()
+    pixels = [rep.pixelsWide() * rep.pixelsHigh() for rep in image.representations()]
+    return 4 * max(pixels + [int(w * h)])
+
+def _bitmap_rep(image):
+    for rep in image.representations():
+        if isinstance(rep, NSBitmapImageRep) and rep.pixelsWide() > 0:
+            return rep
+    return None
+
+def _level_size(w, h, depth):
+    # the pixel dimensions of a mipmap level (rounding up at each halving as _halve does)
+    for i in range(depth):
+        w, h = max(1, (w+1) // 2), max(1, (h+1) // 2)
+    return w, h
+
+def _halve(image):
+    """Return a copy of a bitmap NSImage at half its pixel dimensions (rounding up)"""
+    src = _bitmap_rep(image).CGImage()
+    w, h = _level_size(CGImageGetWidth(src), CGImageGetHeight(src), 1)
+
+    # resample in the source's colorspace if possible (not all of them can back a bitmap context)
+    bitmap = None
+    for space in CGImageGetColorSpace(src), CGColorSpaceCreateDeviceRGB():
+        bitmap = CGBitmapContextCreate(None, w, h, 8, 0, space, kCGImageAlphaPremultipliedLast)
+        if bitmap is not None:
+            break
+    CGContextSetInterpolationQuality(bitmap, kCGInterpolationHigh)
+    CGContextDrawImage(bitmap, ((0,0), (w,h)), src)
+
+    return _bitmap_image(CGBitmapContextCreateImage(bitmap))
+
+def _bitmap_image(cgimage):
+    # wrap a CGImage in an NSImage configured the same way _lazyload does the originals
+    rep = NSBitmapImageRep.alloc().initWithCGImage_(cgimage)
+    image = NSImage.alloc().initWithSize_((rep.pixelsWide(), rep.pixelsHigh()))
+    image.addRepresentation_(rep)
+    return _configured(image)
+
+class ThumbnailCache(object):
+    """A directory of downsampled images stored as raw pixels (for reuse across processes)
+
+    Files are keyed by (absolute path, mtime, max dimension) and contain rows of premultiplied
+    8-bit RGBA followed by a short trailer with the pixel dimensions. They're memory-mapped
+    and handed straight to Quartz when read rather than being decoded. Whenever the directory
+    grows beyond `capacity` bytes, the least recently used files are deleted.
+    """
+    _trailer = struct.Struct('<4sII') # magic number, width, height
+
+    def __init__(self, root, capacity=THUMBNAIL_CACHE_CAPACITY):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.capacity = capacity
+        self._quota = DiskQuota(self.root, capacity, ('.rgba',))
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+    def get(self, src, mtime, dim):
+        """Return a cached NSImage for the file at `src` (or None if there isn't one)"""
+        NSDataReadingMappedIfSafe = 1
+        fn = self._filename(src, mtime, dim)
+        try:
+            with open(fn, 'rb') as f:
+                f.seek(-self._trailer.size, os.SEEK_END)
+                magic, w, h = self._trailer.unpack(f.read(self._trailer.size))
+                length = f.tell()
+            os.utime(fn, None) # mark as recently used
+        except (IOError, OSError, struct.error):
+            return None
+        if magic != 'PDTH' or length != w*h*4 + self._trailer.size:
+            return None
+
+        data, err = NSData.dataWithContentsOfFile_options_error_(fn, NSDataReadingMappedIfSafe, None)
+        if data is None:
+            return None
+        provider = CGDataProviderCreateWithCFData(data)
+        cgimage = CGImageCreate(w, h, 8, 32, w*4, CGColorSpaceCreateDeviceRGB(), kCGImageAlphaPremultipliedLast,
+                                provider, None, True, kCGRenderingIntentDefault)
+        return _bitmap_image(cgimage)
+
+    def put(self, src, mtime, dim, image):
+        """Save the pixels of a bitmap NSImage (failing silently if the disk isn't cooperating)"""
+        cgimage = _bitmap_rep(image).CGImage()
+        w, h = CGImageGetWidth(cgimage), CGImageGetHeight(cgimage)
+        pixels = bytearray(w*h*4)
+        bitmap = CGBitmapContextCreate(pixels, w, h, 8, w*4, CGColorSpaceCreateDeviceRGB(), kCGImageAlphaPremultipliedLast)
+        CGContextDrawImage(bitmap, ((0,0), (w,h)), cgimage)
+
+        try:
+            with atomic_write(self._filename(src, mtime, dim)) as f:
+                f.write(pixels)
+                f.write(self._trailer.pack('PDTH', w, h))
+        except (IOError, OSError):
+            return
+        self._quota.add(len(pixels) + self._trailer.size)
+
+    def _filename(self, src, mtime, dim):
+        key = repr((os.path.abspath(src), mtime, dim))
+        return os.path.join(self.root, sha1(key).hexdigest() + '.rgba')
+
 ### context manager for calls to `with export(...)` ###
 
-import time
 re_padded = re.compile(r'{(\d+)}')
 class ImageWriter(object):
     def __init__(self, fname, format, **opts):
@@ -364,16 +919,12 @@ class ImageWriter(object):
         """Add a new frame or page with the current contents of the canvas."""
         if not self.session:
             if self.anim:
-                self.session = MovieExportSession(self.fname, self.format, **self.opts)
+                self.session = MovieExportSession(self.fname, self.format, sync=True, **self.opts)
             else:
-                self.session = ImageExportSession(self.fname, self.format, **self.opts)
+                self.session = ImageExportSession(self.fname, self.format, sync=True, **self.opts)
         self.session.add(_ctx.canvas)
 
     def finish(self):
         """Blocks until disk I/O is complete"""
         self.session.done()
-        while True:
-            if self.session.writer.doneWriting():
-                break
-            time.sleep(0.1)
 
@@ -1,21 +1,24 @@
 # encoding: utf-8
 import re
 import sys
+from bisect import bisect_left
 from collections import namedtuple
+from ..util import odict
 from ..lib.cocoa import *
 
 from plotdevice import DeviceError
 from .typography import *
+from .typography import _frozen
 from .geometry import Transform, Region, Size, Point, Pair
 from .colors import Color
 from .bezier import Bezier
 from .atoms import TransformMixin, ColorMixin, EffectsMixin, StyleMixin, BoundsMixin, Grob
-from ..util import _copy_attrs, trim_zeroes, numlike, ordered, XMLParser, read
+from ..util import _copy_attrs, trim_zeroes, numlike, ordered, XMLParser, ElementIndex, read
 from ..lib import foundry
 from . import _ns_context
 
 _ctx = None
-__all__ = ("Text", "LEFT", "RIGHT", "CENTER", "JUSTIFY",)
+__all__ = ("Text", "Labels", "LEFT", "RIGHT", "CENTER", "JUSTIFY",)
 
 # text alignments
 LEFT = "left"
@@ -29,6 +32,13 @@ _TEXT=dict(
     justify = NSJustifiedTextAlignment
 )
 
+METRICS_CACHE_SIZE = 4096 # number of measured strings to remember
+STYLE_CACHE_SIZE = 1024   # number of resolved style cascades to remember
+LAYOUT_POOL_SIZE = 8      # number of idle layout managers to keep around for reuse
+STREAM_THRESHOLD = 1<<18  # length beyond which xml strings are parsed & styled in batches
+PAGE_WINDOW = 4096        # minimum number of chars to load at a time into an overleaf() page
+APPROX_OPTS = StyleMixin.fontOpts + StyleMixin.aatOpts + ('fill', 'leading') # kwargs that approx=True can handle
+
 
 class Text(EffectsMixin, TransformMixin, BoundsMixin, StyleMixin, Grob):
     # from TransformMixin: transform transformmode translate() rotate() scale() skew() reset()
@@ -37,25 +47,29 @@ class Text(EffectsMixin, TransformMixin, BoundsMixin, StyleMixin, Grob):
     # from StyleMixin:     stylesheet fill _parse_style()
     stateAttrs = ('_nodes', )
     opts = ('str', 'xml', 'src')
+    _source = None # the full string when this object is a page produced by overleaf()
+    _cursor = 0    # the index in _source of the first character in our store
+    _grafs = None  # the offsets in _source just past each of its paragraph breaks
 
     def __init__(self, *args, **kwargs):
 
         # assemble the NSMachinery
-        self._engine = NSLayoutManager.alloc().init()
-        self._engine.setUsesScreenFonts_(False)
-        self._engine.setUsesFontLeading_(False)
-        self._store = NSTextStorage.alloc().init()
-        self._store.addLayoutManager_(self._engine)
+        self._engine, self._store = _layouts.checkout()
 
         if args and isinstance(args[0], Text):
             # create a parallel set of nstext objects when copying an existing Text
-            # then bail out immediately (ignoring any other args)
+            # then bail out immediately (ignoring any other args). when called by overleaf()
+            # the store is left empty for _fill() to load with a range of the source string
             orig = args[0]
             self.inherit(orig)
             self._frames = [TextFrame(self) for f in orig._frames]
             for src, dst in zip(orig._frames, self._frames):
                 dst.offset, dst.size = src.offset, src.size
-            self._store.appendAttributedString_(orig._store)
+            self._source = kwargs.get('_source', orig._source)
+            self._cursor = kwargs.get('_cursor', orig._cursor)
+            self._grafs = kwargs.get('_grafs', orig._grafs)
+            if '_source' not in kwargs:
+                self._store.appendAttributedString_(orig._store)
             return
 
         # let the various mixins have a crack at the kwargs
@@ -65,7 +79,7 @@ class Text(EffectsMixin, TransformMixin, BoundsMixin, StyleMixin, Grob):
         self._frames = [TextFrame(self)]
 
         # maintain a lookup table of nodes within xml input
-        self._nodes = {}
+        self._nodes = ElementIndex()
 
         # look for a string as the first positional arg or an xml/str kwarg
         if args and isinstance(args[0], basestring):
@@ -79,7 +93,7 @@ class Text(EffectsMixin, TransformMixin, BoundsMixin, StyleMixin, Grob):
         self.append(**{k:v for k,v in kwargs.items() if k in self.opts})
 
     def __repr__(self):
-        total = len(self.text)
+        total = len(self)
         displayed = sum(self.frames[-1]._chars)
         msg = "%i character%s" % (total, '' if total==1 else 's')
         if displayed < total:
@@ -108,6 +122,9 @@ class Text(EffectsMixin, TransformMixin, BoundsMixin, StyleMixin, Grob):
         StyleMixin.validate(kwargs)
         attrib_txt = None
 
+        # a page produced by overleaf() needs the rest of its string loaded before being extended
+        self._load()
+
         if src is not None:
             # fetch the url or file's contents as unicode
             txt = read(src, format='txt')
@@ -142,48 +159,22 @@ class Text(EffectsMixin, TransformMixin, BoundsMixin, StyleMixin, Grob):
 
             # if the text is xml, parse it an overlay any stylesheet entries that map to
             # its tag names. otherwise apply the merged style to the entire string
-            if is_xml:
-                # find any tagged regions that need styling
-                parser = XMLParser(decoded, offset=len(self.text))
-
-                # update our internal lookup table of nodes
-                for tag, elts in parser.nodes.items():
-                    old_elts = self._nodes.get(tag, [])
-                    self._nodes[tag] = old_elts + elts
-
-                # start building the display-string (with all the tags now removed)
-                attrib_txt = NSMutableAttributedString.alloc().initWithString_(parser.text)
-
-                # generate the proper `ns' font attrs for each unique cascade of xml tags
-                attrs = {seq:self._fontify(merged_style, *seq) for seq in sorted(parser.regions)}
-
-                # apply the attributes to the runs found by the parser
-                for cascade, runs in parser.regions.items():
-                    style = attrs[cascade]
-                    for rng in runs:
-                        attrib_txt.setAttributes_range_(style, rng)
+            if is_xml and len(decoded) > STREAM_THRESHOLD:
+                # parse long documents in batches, appending each one to the store as it's
+                # styled rather than building up the whole attributed string first
+                self._stream(decoded, merged_style)
+            elif is_xml:
+                # find any tagged regions that need styling (and add the elements to our
+                # internal lookup table of nodes)
+                parser = XMLParser(decoded, offset=self._store.length(), nodes=self._nodes)
+                attrib_txt = self._markup(parser.text, parser.regions, merged_style)
             else:
                 # don't parse as xml, just apply the current font(), align(), and fill()
                 attrs = self._fontify(merged_style)
                 attrib_txt = NSMutableAttributedString.alloc().initWithString_attributes_(decoded, attrs)
 
-            # ensure the very-first character of a Text is indented flush left. also watch for
-            # double-newlines at the edge of the existing string and the appended chars. grafs
-            # can suppress their indentation with a \b (a.k.a. \x08) at the beginning of the
-            # line and un-indented lead-grafs can force indentation by beginning with \t
-            pre_txt = self._store.string()
-            if not pre_txt or re.search(r'\n[\n\x08]$', pre_txt):
-                Text._dedent(attrib_txt)
-            elif pre_txt.endswith('\n'):
-                if re.match(r'\n[^\n]', attrib_txt.string()):
-                    Text._dedent(attrib_txt, 1)
-                elif re.match(r'\x08', attrib_txt.string()):
-                    Text._dedent(attrib_txt)
-
-            # ensure that any paragraph with more than one leading newline is indented flush-left
-            # (and let `\n\b` override auto-indentation)
-            for m in re.finditer(r'\n\x08|\n\n+[^\n]', attrib_txt.string()):
-                Text._dedent(attrib_txt, m.end()-1)
+            if attrib_txt:
+                self._autodent(attrib_txt)
 
         if attrib_txt:
             # let the typesetter deal with the new substring
@@ -195,8 +186,22 @@ class Text(EffectsMixin, TransformMixin, BoundsMixin, StyleMixin, Grob):
     ### NSAttributedString de/manglers ###
 
     def _fontify(self, defaults, *styles):
-        """Merge the named-styles and defaults in order and return nsattibutedstring attrs"""
+        """Merge the named-styles and defaults in order and return nsattibutedstring attrs
 
+        The attrs are cached by the stylesheet's contents, the cascade of style names, and the
+        baseline spec, and are shared between Text objects (so don't modify them in place).
+        """
+        try:
+            key = (self.stylesheet._version, styles, _frozen(defaults), self._grid.dpx)
+        except TypeError:
+            return self._cascade(defaults, *styles)
+
+        attrs = _ctx._stylecache.get(key)
+        if attrs is None:
+            attrs = _ctx._stylecache.put(key, self._cascade(defaults, *styles))
+        return attrs
+
+    def _cascade(self, defaults, *styles):
         # use the inherited context settings as a baseline spec
         spec = dict(defaults)
 
@@ -248,6 +253,54 @@ class Text(EffectsMixin, TransformMixin, BoundsMixin, StyleMixin, Grob):
         # build the dict of features for this combination of styles
         return dict(NSFont=font._nsFont, NSColor=color, NSParagraphStyle=graf, NSKern=kern)
 
+    def _markup(self, txt, regions, defaults):
+        """Build an attributed string by styling the runs of text the XMLParser found"""
+        # start building the display-string (with all the tags now removed)
+        attrib_txt = NSMutableAttributedString.alloc().initWithString_(txt)
+
+        # generate the proper `ns' font attrs for each unique cascade of xml tags
+        attrs = {seq:self._fontify(defaults, *seq) for seq in sorted(regions)}
+
+        # apply the attributes to the runs found by the parser
+        for cascade, runs in regions.items():
+            style = attrs[cascade]
+            for rng in runs:
+                attrib_txt.setAttributes_range_(style, rng)
+        return attrib_txt
+
+    def _stream(self, xml, defaults):
+        """Parse, style, and append a long xml string one batch at a time"""
+        self._store.beginEditing()
+        for txt, regions in XMLParser.stream(xml, offset=self._store.length(), nodes=self._nodes):
+            if txt:
+                attrib_txt = self._markup(txt, regions, defaults)
+                self._autodent(attrib_txt)
+                self._store.appendAttributedString_(attrib_txt)
+        self._store.endEditing()
+        self._resized()
+
+    def _autodent(self, attrib_txt):
+        """Fix up the first-line indentation of a string that's about to be appended to the store"""
+        # ensure the very-first character of a Text is indented flush left. also watch for
+        # double-newlines at the edge of the existing string and the appended chars. grafs
+        # can suppress their indentation with a \b (a.k.a. \x08) at the beginning of the
+        # line and un-indented lead-grafs can force indentation by beginning with \t
+        # (only the store's last two characters matter so don't bridge the whole string)
+        end = self._store.length()
+        pre_txt = self._store.attributedSubstringFromRange_((max(0, end-2), min(end, 2))).string()
+        if not pre_txt or re.search(r'\n[\n\x08]$', pre_txt):
+            Text._dedent(attrib_txt)
+        elif pre_txt.endswith('\n'):
+            if re.match(r'\n[^\n]', attrib_txt.string()):
+                Text._dedent(attrib_txt, 1)
+            elif re.match(r'\x08', attrib_txt.string()):
+                Text._dedent(attrib_txt)
+
+        # ensure that any paragraph with more than one leading newline is indented flush-left
+        # (and let `\n\b` override auto-indentation)
+        for m in re.finditer(r'\n\x08|\n\n+[^\n]', attrib_txt.string()):
+            Text._dedent(attrib_txt, m.end()-1)
+
     @classmethod
     def _dedent(cls, attrib_txt, idx=0, inherit=False):
         """Removes first-line paragraph indentation of at the given attributed-string index.
@@ -274,27 +327,75 @@ class Text(EffectsMixin, TransformMixin, BoundsMixin, StyleMixin, Grob):
     def overleaf(self):
         """Returns a Text object containing any characters that did not fit within this object's bounds.
         If the entire string fits within the current object, returns None."""
-        seen = u"".join(getattr(f, 'text') for f in self._frames)
-        full = self.text
-        if full not in seen:
-            next_pg = self.copy()
-
-            # delete the first page's-worth of chars and update indices
-            nc = len(seen)
-            next_pg._store.beginEditing()
-            next_pg._store.deleteCharactersInRange_([0, nc])
-            next_pg._store.endEditing()
-            nodes = {}
-            for tag, elts in self._nodes.items():
-                nodes[tag] = [e._replace(start=e.start-nc, end=e.end-nc) for e in elts if e.end-nc > 0]
-            next_pg._nodes = nodes
+        self._fill()
+        nc = sum(self._frames[-1]._chars)
+        if nc < self._store.length():
+            # rather than copying the whole remainder of the string, the new page shares a
+            # snapshot of the original (and its paragraph breaks) and only loads as much of
+            # it as it can display
+            if self._source is not None:
+                source, grafs = self._source, self._grafs
+            else:
+                source = self._store.copy()
+                grafs = _paragraph_breaks(source)
+            next_pg = Text(self, _source=source, _grafs=grafs, _cursor=self._cursor+nc)
+            next_pg._nodes = self._nodes.shifted(-nc)
 
             # if the page-break is in the middle of a paragraph, preserve the first character's initial
             # indentation (since otherwise it'll be treated as a `first' line of a new paragraph)
-            if not seen.endswith('\n'):
-                Text._dedent(next_pg._store, inherit=True)
+            midgraf = nc and self._store.attributedSubstringFromRange_((nc-1, 1)).string() != u'\n'
+            next_pg._fill(max(PAGE_WINDOW, 2*nc), midgraf)
             return next_pg
 
+    def _fill(self, chars=PAGE_WINDOW, midgraf=False):
+        """Load paragraphs from the source string into a page's store until its frames overflow
+
+        Does nothing for Text objects that weren't created by overleaf(). The `chars` arg sets
+        the minimum number of characters to append (doubling with each subsequent pass) and
+        the `midgraf` flag dedents the first line if the store is being loaded for the first time.
+        Each pass appends at most twice `chars`, so paragraphs longer than that are loaded a
+        word-break-delimited piece at a time.
+        """
+        if self._source is None:
+            return
+
+        total = self._source.length()
+        while True:
+            loaded = self._store.length()
+            start = self._cursor + loaded
+            if start >= total or sum(self._frames[-1]._chars) < loaded:
+                break
+
+            # round up to the end of a paragraph so its line-breaks aren't affected by the cut
+            # (or, if the paragraph runs on past the cap, to the next word instead)
+            target, cap = min(start+chars, total), min(start+2*chars, total)
+            i = bisect_left(self._grafs, target)
+            if i < len(self._grafs) and self._grafs[i] <= cap:
+                end = self._grafs[i]
+            else:
+                end = _word_break(self._source, target, cap)
+            rng = (start, end-start)
+            self._store.beginEditing()
+            self._store.appendAttributedString_(self._source.attributedSubstringFromRange_(rng))
+            if midgraf and not loaded:
+                Text._dedent(self._store, inherit=True)
+            self._store.endEditing()
+            chars *= 2
+
+    def _load(self):
+        """Load the remainder of the source string into a page's store (and stop paging it in)
+
+        Called before any operation that needs to see the whole string rather than just the
+        portion that's been laid out so far.
+        """
+        if self._source is None:
+            return
+
+        start = self._cursor + self._store.length()
+        rest = self._source.attributedSubstringFromRange_((start, self._source.length()-start))
+        self._store.appendAttributedString_(rest)
+        self._source = self._grafs = None
+
     def flow(self, columns=all, layout=None):
         """Add as many text frames as necessary to fully lay out the string
 
@@ -326,10 +427,12 @@ class Text(EffectsMixin, TransformMixin, BoundsMixin, StyleMixin, Grob):
         while self._frames[1:]:
             self._frames.pop()._eject()
         frame = self._frames[0]
+        self._fill()
         while len(self._frames) < count and sum(frame._glyphs) < self._engine.numberOfGlyphs():
             frame = TextFrame(frame)
             self._frames.append(frame)
             yield frame
+            self._fill()
 
     ### Layout geometry ###
 
@@ -366,6 +469,7 @@ class Text(EffectsMixin, TransformMixin, BoundsMixin, StyleMixin, Grob):
 
     def __getitem__(self, index):
         """Subscripting a Text using indices into its .text string returns a TextMatch"""
+        self._load()
         match = TextMatch(self)
         if isinstance(index, slice):
             match.start, match.end, _ = index.indices(len(self))
@@ -378,7 +482,9 @@ class Text(EffectsMixin, TransformMixin, BoundsMixin, StyleMixin, Grob):
         return match
 
     def __len__(self):
-        return len(self.text)
+        if self._source is not None:
+            return self._source.length() - self._cursor
+        return self._store.length()
 
     def find(self, regex, matches=0):
         """Find all matching portions of the text string using regular expressions
@@ -413,7 +519,9 @@ class Text(EffectsMixin, TransformMixin, BoundsMixin, StyleMixin, Grob):
         if not hasattr(regex, 'pattern'):
             nonregex = "Text.find() must be called with an re.compile'd pattern object or a regular expression string"
             raise DeviceError(nonregex)
-        return self._seek(regex.finditer(self.text), matches)
+        if matches is all:
+            self._load() # (pages only have enough of their string loaded to fill their frames)
+        return self._seek(regex.finditer(unicode(self._store.string())), matches)
 
     def select(self, tag_name, matches=0):
         """Find all matching portions of the text string using regular expressions
@@ -439,13 +547,23 @@ class Text(EffectsMixin, TransformMixin, BoundsMixin, StyleMixin, Grob):
         """
         if isinstance(tag_name, str):
             tag_name = tag_name.decode('utf-8')
-        return self._seek(self._nodes.get(tag_name, []), matches)
+
+        # unless we're including the overflow, only look at elements that begin in a frame
+        if matches is all:
+            self._load()
+        shown = None if matches is all else sum(self._frames[-1]._chars)
+        return self._seek(self._nodes.scan(tag_name, end=shown), matches)
 
     def _seek(self, stream, limit):
+        # rather than asking the layout manager which frames each match falls in, find the
+        # last laid-out character once and stop at the first match that begins beyond it
+        shown = sum(self._frames[-1]._chars)
+        overflow = shown < self._store.length() and limit is not all
+
         found = []
         for m in stream:
             match = TextMatch(self, m)
-            if not match.frames and limit is not all:
+            if overflow and match.start >= shown:
                 break
             found.append(match)
             if len(found) == limit:
@@ -455,16 +573,19 @@ class Text(EffectsMixin, TransformMixin, BoundsMixin, StyleMixin, Grob):
     @property
     def text(self):
         """Returns the unicode string being typeset"""
+        self._load()
         return unicode(self._store.string())
 
     @property
     def words(self):
         """Returns a TextMatch for each word in the text string (whitespace separated)"""
+        self._load()
         return [TextMatch(self, w) for w in self._store.words()]
 
     @property
     def paragraphs(self):
         """Returns a TextMatch for each `line' in the text string (newline separated)"""
+        self._load()
         return [TextMatch(self, w) for w in self._store.paragraphs()]
 
     @property
@@ -477,6 +598,14 @@ class Text(EffectsMixin, TransformMixin, BoundsMixin, StyleMixin, Grob):
         """Returns a list of LineFragments, one for each line in all of the TextFrames"""
         return foundry.line_fragments(self)
 
+    def _recycle(self):
+        # return the NSMachinery to the pool once a throwaway Text is no longer needed
+        for frame in self._frames:
+            frame._eject()
+        _layouts.checkin(self._engine, self._store)
+        self._engine = self._store = None
+        self._frames = []
+
     ### Calculating dimensions & rendering ###
 
     def _resized(self):
@@ -491,6 +620,9 @@ class Text(EffectsMixin, TransformMixin, BoundsMixin, StyleMixin, Grob):
         frame.offset = (0,0)
         frame.size = (dims.w, dims.h)
 
+        # if we're a page of a longer string, make sure enough of it is loaded to fill the frames
+        self._fill()
+
         # if the rect isn't fully specified, size it to fit
         if not (dims.w and dims.h):
             # compute the portion that's actually filled and add 1px of extra padding to the
@@ -897,3 +1029,313 @@ class TextFrame(BoundsMixin, Grob):
         codependent = "TextFrames can't be drawn directly; plot() the parent Text object instead"
         raise DeviceError(codependent)
 
+
+
+class Labels(EffectsMixin, TransformMixin, StyleMixin, Grob):
+    """A batch of short strings that are typeset together and drawn as a single grob
+
+    The labels share a style as well as a single text store and layout manager (rather than
+    each having its own the way separate Text objects do), so plotting thousands of them
+    is far cheaper. Each label is positioned with its baseline at the corresponding y value.
+    Its x value marks the label's left edge, center, or right edge depending on the `align`
+    setting in effect.
+
+    Properties:
+      `strings` - the list of label strings
+      `xs` and `ys` - lists with the coordinates of each label's anchor point
+      `widths` and `heights` - lists with the size of each label's line of text
+      `bounds` - a Region enclosing all the labels
+    """
+    # from TransformMixin: transform transformmode translate() rotate() scale() skew() reset()
+    # from EffectsMixin:   alpha blend shadow
+    # from StyleMixin:     stylesheet fill _parse_style()
+    stateAttrs = ('_text', '_labels', '_runs', '_boxes')
+
+    def __init__(self, *args, **kwargs):
+        if args and isinstance(args[0], Labels):
+            # make a copy of the original's text store along with its label geometry
+            self.inherit(args[0])
+            return
+
+        super(Labels, self).__init__(**kwargs)
+        strings, xs, ys = args
+        strings = [s if isinstance(s, unicode) else s.decode('utf-8') if isinstance(s, str) else repr(s)
+                   for s in strings]
+        xs = [xs]*len(strings) if numlike(xs) else list(xs)
+        ys = [ys]*len(strings) if numlike(ys) else list(ys)
+        if not len(strings) == len(xs) == len(ys):
+            mismatch = 'Labels needs the same number of strings, xs, and ys (not %i, %i, and %i)'
+            raise DeviceError(mismatch % (len(strings), len(xs), len(ys)))
+        self._labels = zip(strings, xs, ys)
+
+        # typeset all the strings at once as left-aligned, single-line paragraphs (keeping
+        # any newlines within a label in the same graf) and apply the alignment ourselves
+        style = {k:v for k,v in kwargs.items() if k in StyleMixin.opts}
+        style['align'] = LEFT
+        joined = u"\n".join(s.replace(u"\n", u"\u2028") for s in strings)
+        self._text = Text(joined, 0, 0, **style)
+        self._layout(self._font.align)
+
+    def _layout(self, align):
+        # find the glyphs for each label along with the origin that places its baseline at (x,y)
+        engine, block = self._text._engine, self._text._frames[0]._block
+        self._runs, self._boxes = [], []
+        start = 0
+        for txt, x, y in self._labels:
+            glyphs, _ = engine.glyphRangeForCharacterRange_actualCharacterRange_((start, len(txt)), None)
+            start += len(txt) + 1
+            if not txt:
+                self._boxes.append((x, y, 0, 0))
+                continue
+
+            (left, top), (w, h) = engine.boundingRectForGlyphRange_inTextContainer_(glyphs, block)
+            frag, _ = engine.lineFragmentRectForGlyphAtIndex_effectiveRange_(glyphs.location, None)
+            baseline = frag.origin.y + engine.locationForGlyphAtIndex_(glyphs.location).y
+            nudge = {RIGHT:w, CENTER:w/2.0}.get(align, 0)
+
+            px, py = self._to_px(Point(x, y))
+            self._runs.append((glyphs, (px - left - nudge, py - baseline)))
+            self._boxes.append(tuple(self._from_px(v) for v in (px-nudge, py-baseline+top, w, h)))
+
+    def __repr__(self):
+        return "Labels(%i string%s)" % (len(self), '' if len(self)==1 else 's')
+
+    def __len__(self):
+        return len(self._labels)
+
+    @property
+    def strings(self):
+        return [txt for txt, x, y in self._labels]
+
+    @property
+    def xs(self):
+        return [x for txt, x, y in self._labels]
+
+    @property
+    def ys(self):
+        return [y for txt, x, y in self._labels]
+
+    @property
+    def widths(self):
+        return [w for x, y, w, h in self._boxes]
+
+    @property
+    def heights(self):
+        return [h for x, y, w, h in self._boxes]
+
+    @property
+    def bounds(self):
+        """Returns the bounding box enclosing all of the labels"""
+        box = Region()
+        for rect in self._boxes:
+            box = box.union(Region(*rect))
+        return box
+
+    @property
+    def _screen_transform(self):
+        xf = Transform()
+        if self._transformmode == CENTER:
+            # rotate/scale/etc. around the center of the whole batch
+            bounds = self._to_px(self.bounds)
+            nudge = Transform().translate(*(bounds.origin + bounds.size/2.0))
+            xf.prepend(nudge)
+            xf.prepend(self.transform)
+            xf.prepend(nudge.inverse)
+        else:
+            xf.prepend(self.transform)
+        return xf
+
+    def _draw(self):
+        engine = self._text._engine
+        with _ns_context():                  # save and restore the gstate
+            self._screen_transform.concat()  # apply the transform once for the whole batch
+            with self.effects.applied():     # apply any blend/alpha/shadow effects
+                for glyphs, origin in self._runs:
+                    engine.drawGlyphsForGlyphRange_atPoint_(glyphs, origin)
+
+
+### layout caching ###
+
+class LayoutPool(object):
+    """A stash of idle NSLayoutManager/NSTextStorage pairs that can be reused by new Text objects"""
+    def __init__(self, size=LAYOUT_POOL_SIZE):
+        self.size = size
+        self._idle = []
+
+    def checkout(self):
+        if self._idle:
+            return self._idle.pop()
+        engine = NSLayoutManager.alloc().init()
+        engine.setUsesScreenFonts_(False)
+        engine.setUsesFontLeading_(False)
+        store = NSTextStorage.alloc().init()
+        store.addLayoutManager_(engine)
+        return engine, store
+
+    def checkin(self, engine, store):
+        if len(self._idle) < self.size:
+            store.beginEditing()
+            store.deleteCharactersInRange_((0, store.length()))
+            store.endEditing()
+            self._idle.append((engine, store))
+
+_layouts = LayoutPool()
+
+def _paragraph_breaks(attrib_txt):
+    # the offsets just past each paragraph separator (i.e., where paragraphRangeForRange_ would
+    # end a paragraph) so overleaf() pages can round their windows up without rescanning the string
+    return [m.end() for m in re.finditer(u'\r\n|[\n\r\u2029]', unicode(attrib_txt.string()))]
+
+def _word_break(attrib_txt, idx, limit):
+    # the start of the first word after idx (or `limit' if it's further away than that), for
+    # cutting a paragraph without splitting a word or bridging the rest of the string
+    if limit >= attrib_txt.length():
+        return limit
+    end = attrib_txt.nextWordFromIndex_forward_(idx, True)
+    if idx < end <= limit:
+        return end
+    # don't separate the halves of a surrogate pair when there's no word break to cut at
+    last = attrib_txt.attributedSubstringFromRange_((limit-1, 1)).string()
+    return limit-1 if u'\ud800' <= last <= u'\udbff' else limit
+
+class StyleCache(object):
+    """An LRU cache of the attribute dicts generated by Text._fontify
+
+    Since the same few style cascades tend to be applied over and over (to every label in a
+    chart, say), the resulting NSFont, NSColor, and NSParagraphStyle objects are shared by
+    all the Text objects that use them rather than being reconstructed each time.
+    """
+    def __init__(self, size=STYLE_CACHE_SIZE):
+        self.size = size
+        self.hits = self.misses = 0
+        self._entries = odict() # key -> attrs dict in least- to most-recently used order
+
+    def get(self, key):
+        attrs = self._entries.pop(key, None)
+        if attrs is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries[key] = attrs # move to the most-recently-used end
+        return attrs
+
+    def put(self, key, attrs):
+        self._entries[key] = attrs
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        return attrs
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        """Hit/miss counts and the number of cached cascades"""
+        return dict(hits=self.hits, misses=self.misses, entries=len(self._entries), size=self.size)
+
+class MetricsCache(object):
+    """An LRU cache of the sizes computed by measure(), textmetrics(), and friends
+
+    Entries are keyed by the string, the layout dimensions, the style kwargs, the context's
+    current font, the stylesheet's contents, and the canvas units, so repeated measurements
+    (e.g., in a loop searching for the largest font size that fits) can skip building a Text
+    object and laying it out. Measurements of file-based text (or styles that can't be
+    expressed as a hashable key) always fall through to a fresh layout. Misses borrow their
+    layout manager from a pool rather than allocating a new one each time.
+
+    Misses can also be estimated (when called with approx=True) from per-face tables of
+    character advances and kerning pairs rather than being typeset at all.
+    """
+    def __init__(self, size=METRICS_CACHE_SIZE):
+        self.size = size
+        self.hits = self.misses = self.evictions = self.estimates = 0
+        self._entries = odict() # key -> (w,h) in least- to most-recently used order
+        self._fonts = {}        # style key -> resolved Font for estimates
+        self._tables = {}       # (psname, features) -> foundry.AdvanceTable
+
+    def measure(self, txt, width=None, height=None, approx=False, verify=False, **kwargs):
+        """Return the Size of a string laid out with the given dimensions & style
+
+        With approx=True, single lines of text whose style only involves font settings are
+        measured by adding up their characters' advances rather than running the typesetter
+        (falling back to a full layout if the line wouldn't fit within the width or height).
+        Passing verify=True along with it forces an exact measurement, so a layout search can
+        use estimates for its candidates and then confirm the one it settles on.
+        """
+        key = self._key(txt, width, height, kwargs)
+        if key in self._entries:
+            self.hits += 1
+            dims = self._entries[key] = self._entries.pop(key) # move to the most-recently-used end
+            return Size(*dims) # (Sizes are mutable so hand out a fresh one each time)
+
+        if approx and not verify:
+            size = self._estimate(txt, width, height, kwargs)
+            if size is not None:
+                self.estimates += 1
+                return size
+
+        self.misses += 1
+        text = Text(txt, 0, 0, width, height, **kwargs)
+        size = text.metrics
+        text._recycle()
+
+        if key is not None:
+            self._entries[key] = tuple(size)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return size
+
+    def clear(self):
+        self._entries.clear()
+        self._fonts.clear()
+        self._tables.clear()
+
+    def stats(self):
+        """Hit/miss/eviction/estimate counts and the number of cached measurements"""
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    estimates=self.estimates, entries=len(self._entries), size=self.size,
+                    faces=len(self._tables))
+
+    def _estimate(self, txt, width, height, kwargs):
+        # only plain, single-line strings can be summed up without a layout pass
+        if not isinstance(txt, basestring) or not txt or '\n' in txt:
+            return None
+        if any(k not in APPROX_OPTS for k in kwargs):
+            return None
+
+        # find the face & size the string would be set in (reusing the Font for repeat styles)
+        opts = {k:v for k,v in kwargs.items() if k not in ('fill', 'leading')}
+        try:
+            style = (_frozen(opts), _frozen(_ctx._font))
+        except TypeError:
+            return None
+        if style not in self._fonts:
+            if len(self._fonts) >= self.size:
+                self._fonts.clear()
+            self._fonts[style] = Font(**opts)
+        font = self._fonts[style]
+
+        face = (font._face.psname, _frozen(font._features))
+        if face not in self._tables:
+            self._tables[face] = foundry.AdvanceTable(font._nsFont)
+
+        # add the per-character tracking to the advances and use the leading for the height
+        kern = (font.tracking or 0) * font.size / 1000.0
+        leading = kwargs.get('leading', font.leading)
+        dpx = _ctx._grid.dpx
+        w = (self._tables[face].width(txt, font.size) + kern*len(txt)) / dpx
+        h = font.size * leading / dpx
+        if (width and w > width) or (height and h > height):
+            return None
+        return Size(w, h)
+
+    def _key(self, txt, width, height, kwargs):
+        if not isinstance(txt, basestring) or 'src' in kwargs:
+            return None
+
+        # the fill color (which doesn't affect layout) is left out of the key
+        opts = {k:v for k,v in kwargs.items() if k != 'fill'}
+        try:
+            return (txt, width, height, _frozen(opts), _ctx._stylesheet._version, _frozen(_ctx._font), _ctx._grid.dpx)
+        except TypeError:
+            return None
@@ -327,6 +327,7 @@ class Stylesheet(object):
 
     def __init__(self, styles=None):
         self._styles = dict(styles or {})
+        self._key = None # hashable snapshot of the styles (or None if they've since changed)
 
     def __repr__(self):
         return "Stylesheet(%r)"%(self._styles)
@@ -353,9 +354,20 @@ class Stylesheet(object):
     def __delitem__(self, key):
         if key in self._styles:
             del self._styles[key]
+            self._key = None
 
     def copy(self):
-        return Stylesheet(self._styles)
+        sheet = Stylesheet(self._styles)
+        sheet._key = self._key
+        return sheet
+
+    @property
+    def _version(self):
+        # caches are keyed by the stylesheet's contents rather than its identity so they can
+        # be shared by copies of it (and by the fresh one the context starts each frame with)
+        if self._key is None:
+            self._key = _frozen(self._styles)
+        return self._key
 
     @property
     def styles(self):
@@ -376,4 +388,19 @@ class Stylesheet(object):
             if color:
                 spec['fill'] = color
             self._styles[name] = spec
+            self._key = None
         return self[name]
+
+def _frozen(obj):
+    # a hashable equivalent of a style value (or a TypeError if there isn't one)
+    if isinstance(obj, dict):
+        return tuple(sorted((k, _frozen(v)) for k,v in obj.items()))
+    elif isinstance(obj, (list, tuple)):
+        return tuple(_frozen(v) for v in obj)
+    elif isinstance(obj, Font):
+        return (obj._face.psname, _frozen(obj._metrics), _frozen(obj._features))
+    elif isinstance(obj, Color):
+        return obj.nsColor # (which compares by value and reflects the current output mode)
+    elif obj is None or isinstance(obj, (basestring, bool, int, long, float)):
+        return obj
+    raise TypeError('unhashable style value: %r' % obj)
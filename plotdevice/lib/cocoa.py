@@ -1,15 +1,20 @@
 # all the NSBits and NSPieces
 
-from Quartz import CALayer, CGColorCreate, CGContextAddPath, CGContextAddRect, CGContextBeginPath, \
+from Quartz import CALayer, CGBitmapContextCreate, CGBitmapContextCreateImage, CGColorCreate, \
+                   CGColorSpaceCreateDeviceRGB, CGContextAddPath, CGContextAddRect, CGContextBeginPath, \
                    CGContextBeginTransparencyLayer, CGContextBeginTransparencyLayerWithRect, \
-                   CGContextClip, CGContextClipToMask, CGContextDrawPath, CGContextEOClip, \
-                   CGContextEndTransparencyLayer, CGContextRestoreGState, CGContextSaveGState, \
-                   CGContextSetAlpha, CGContextSetBlendMode, CGContextSetFillColorWithColor, \
+                   CGContextClip, CGContextClipToMask, CGContextDrawImage, CGContextDrawPath, CGContextEOClip, \
+                   CGContextEndTransparencyLayer, CGContextGetUserSpaceToDeviceSpaceTransform, \
+                   CGContextRestoreGState, CGContextSaveGState, CGContextSetAlpha, CGContextSetBlendMode, \
+                   CGContextSetFillColorWithColor, CGContextSetInterpolationQuality, \
                    CGContextSetLineCap, CGContextSetLineDash, CGContextSetLineJoin, CGContextSetLineWidth, \
                    CGContextSetStrokeColorWithColor, CGImageGetBitsPerComponent, CGImageGetBitsPerPixel, \
-                   CGImageGetBytesPerRow, CGImageGetDataProvider, CGImageGetHeight, CGImageGetWidth, \
-                   CGImageMaskCreate, CGPathAddCurveToPoint, CGPathAddLineToPoint, CGPathCloseSubpath, \
-                   CGPathCreateCopy, CGPathCreateMutable, CGPathRelease, CGPathMoveToPoint, kCGBlendModeClear, \
+                   CGDataProviderCreateWithCFData, CGImageCreate, CGImageGetBytesPerRow, \
+                   CGImageGetColorSpace, CGImageGetDataProvider, CGImageGetHeight, \
+                   CGImageGetWidth, CGImageMaskCreate, CGImageSourceCopyPropertiesAtIndex, \
+                   CGImageSourceCreateWithURL, CGPathAddCurveToPoint, CGPathAddLineToPoint, \
+                   CGPathCloseSubpath, CGPathCreateCopy, CGPathCreateMutable, CGPathRelease, \
+                   CGPathMoveToPoint, kCGBlendModeClear, \
                    kCGBlendModeColor, kCGBlendModeColorBurn, kCGBlendModeColorDodge, kCGBlendModeCopy, \
                    kCGBlendModeDarken, kCGBlendModeDestinationAtop, kCGBlendModeDestinationIn, \
                    kCGBlendModeDestinationOut, kCGBlendModeDestinationOver, kCGBlendModeDifference, \
@@ -17,9 +22,11 @@ from Quartz import CALayer, CGColorCreate, CGContextAddPath, CGContextAddRect, C
                    kCGBlendModeLuminosity, kCGBlendModeMultiply, kCGBlendModeNormal, kCGBlendModeOverlay, \
                    kCGBlendModePlusDarker, kCGBlendModePlusLighter, kCGBlendModeSaturation, \
                    kCGBlendModeScreen, kCGBlendModeSoftLight, kCGBlendModeSourceAtop, kCGBlendModeSourceIn, \
-                   kCGBlendModeSourceOut, kCGBlendModeXOR, kCGLineCapButt, kCGLineCapRound, kCGLineCapSquare, \
-                   kCGLineJoinBevel, kCGLineJoinMiter, kCGLineJoinRound, kCGPathFill, kCGPathFillStroke, \
-                   kCGPathStroke, kCIInputImageKey
+                   kCGBlendModeSourceOut, kCGBlendModeXOR, kCGImageAlphaPremultipliedLast, \
+                   kCGImagePropertyPixelHeight, kCGImagePropertyPixelWidth, kCGInterpolationHigh, \
+                   kCGLineCapButt, kCGLineCapRound, kCGLineCapSquare, kCGLineJoinBevel, kCGLineJoinMiter, \
+                   kCGLineJoinRound, kCGPathFill, kCGPathFillStroke, kCGPathStroke, kCGRenderingIntentDefault, \
+                   kCIInputImageKey
 from AppKit import NSAlert, NSApp, NSApplication, NSApplicationActivationPolicyAccessory, \
                    NSBackingStoreBuffered, NSBeep, NSBezierPath, NSBitmapImageRep, NSBorderlessWindowMask, \
                    NSButton, NSCenterTextAlignment, NSChangeAutosaved, NSChangeCleared, NSChangeDone, \
@@ -44,7 +51,7 @@ from AppKit import NSAlert, NSApp, NSApplication, NSApplicationActivationPolicyA
                    NSWindowBackingLocationVideoMemory, NSWindowController, NSWorkspace, NSKernAttributeName
 from Foundation import CIAffineTransform, CIColorMatrix, CIContext, CIFilter, CIImage, \
                    CIVector, Foundation, NO, NSAffineTransform, NSAffineTransformStruct, \
-                   NSAttributedString, NSAutoreleasePool, NSBundle, NSData, NSDate, NSDateFormatter, \
+                   NSAttributedString, NSAutoreleasePool, NSBundle, NSCache, NSData, NSDate, NSDateFormatter, \
                    NSFileCoordinator, NSFileHandle, NSFileHandleDataAvailableNotification, NSIntersectionRange, \
                    NSHeight, NSInsetRect, NSIntersectionRect, NSLocale, NSLog, NSMacOSRomanStringEncoding, \
                    NSMakeRange, NSMidX, NSMidY, NSMutableAttributedString, NSNotificationCenter, NSObject,\
@@ -1,12 +1,17 @@
 # encoding: utf-8
 import os
 import re
+import json
+import time
 import objc
+import atexit
 import difflib
+from hashlib import sha1
 from operator import itemgetter, attrgetter
 from collections import namedtuple, OrderedDict as odict, defaultdict as ddict
 from .cocoa import *
 from ..util import numlike
+from ..util.disk import atomic_write
 import cFoundry
 
 from plotdevice import DeviceError
@@ -20,6 +25,14 @@ Face = namedtuple('Face', ['family', 'psname', 'weight','wgt', 'width','wid', 'v
 LineFragment = namedtuple("LineFragment", ["bounds", "used", "baseline", "span", "text", "frame"])
 Vandercook = objc.lookUpClass('Vandercook')
 
+GLYPH_CACHE_BUDGET = 32 * 1024 * 1024 # bytes of glyph outlines to keep around for trace_text
+FONT_INDEX = '~/Library/Caches/io.plotdevice.PlotDevice/fonts.json' # on-disk catalogue of faces
+REFRESH_INTERVAL = 1.0 # minimum seconds between checks for newly (un)installed fonts
+FONT_DIRS = ('/System/Library/Fonts', '/System/Library/Fonts/Supplemental', '/Library/Fonts',
+             '~/Library/Fonts', '/Network/Library/Fonts') # folders the installed fonts live in
+SHORTLIST = 24 # number of trigram-matched family names to rank when suggesting alternatives
+EM = 1000.0 # point size at which AdvanceTables measure characters
+
 # introspection methods for postscript names & families
 
 def font_exists(psname):
@@ -272,10 +285,16 @@ def trace_text(txt_obj, rng=None):
         offset = frame._to_px(frame.offset)
         frame_rng = NSIntersectionRange(rng, frame._chars)
         if frame_rng.length:
-            subpath = Vandercook.traceGlyphs_atOffset_withLayout_(frame_rng, offset, txt_obj._engine)
+            subpath = Vandercook.traceGlyphs_atOffset_withLayout_cache_(frame_rng, offset, txt_obj._engine, _outlines)
             nspath.appendBezierPath_(subpath)
     return txt_obj._from_px(nspath)
 
+# the glyph outlines traced so far, keyed by psname, glyph id, and point size (and evicted
+# by the NSCache itself once their total size in bytes exceeds the budget)
+_outlines = NSCache.alloc().init()
+_outlines.setName_('plotdevice.glyphs')
+_outlines.setTotalCostLimit_(GLYPH_CACHE_BUDGET)
+
 def line_fragments(txt_obj, rng=None):
     """Returns a list of dictionaries describing the line fragments in the entire Text object
     or a sub-range of it based on character indices"""
@@ -515,22 +534,88 @@ def parse_display_name(dname):
 
     return weight, wgt_val, width, wid_val, variant
 
+def fonts_fingerprint():
+    """Returns a digest of the modification times of the FONT_DIRS
+
+    Installing or removing a font adds or deletes a file in one of the folders, so this
+    changes along with the set of installed fonts without having to enumerate them.
+    """
+    stamps = []
+    for path in FONT_DIRS:
+        try:
+            mtime = os.stat(os.path.expanduser(path)).st_mtime
+        except OSError:
+            mtime = None
+        stamps.append('%s %r' % (path, mtime))
+    return sha1('\n'.join(stamps)).hexdigest()
+
 class Librarian(object):
+    """Catalogues the installed fonts (caching the results of family & face lookups)
+
+    The font & family lists, per-family Face lists, psname->family mappings, and encodings
+    are saved to an index file at exit and reloaded by later sessions as long as the set of
+    installed fonts hasn't changed (as determined by fonts_fingerprint). The fonts are only
+    enumerated when there's no usable index. While running, the fingerprint is re-checked at
+    most once every REFRESH_INTERVAL seconds.
+    """
     _mgr = NSLayoutManager.alloc().init()
 
-    def __init__(self):
-        self._fonts = _fm.availableFonts()
-        self._fams = sorted(_fm.availableFontFamilies())
+    def __init__(self, index=FONT_INDEX):
+        self._mgr.setUsesFontLeading_(False)
+        self._index = os.path.expanduser(index) if index else None
+        self._load(fonts_fingerprint())
+
+    def _load(self, fingerprint):
+        self._fingerprint = fingerprint
+        self._checked = time.time()
         self._members = {} # famname -> [Face(), Face(), ...]
         self._parents = {} # psname -> famname
         self._enc = {}     # psname -> encoding
         self._specs = {}   # spec_dict -> psname
         self._fuzzy = {}   # fammy name -> famname
-        self._mgr.setUsesFontLeading_(False)
+        self._lookup = None # FamilyIndex of the current _fams
+        self._dirty = False
+
+        # pick up where a previous session left off if the fonts are the same as last time
+        try:
+            with open(self._index) as f:
+                index = json.load(f)
+            if index['fingerprint'] != self._fingerprint:
+                raise ValueError('stale font index')
+            self._fonts = index['fonts']
+            self._fams = index['families']
+            self._members = {fam:[Face(*f) for f in faces] for fam, faces in index['members'].items()}
+            self._parents = index['parents']
+            self._enc = index['encodings']
+        except (TypeError, IOError, ValueError, KeyError):
+            self._fonts = list(_fm.availableFonts())
+            self._fams = sorted(_fm.availableFontFamilies())
+            self._dirty = True
+
+    def _save(self):
+        """Write the catalogue to the index file (if anything has been added to it)"""
+        if not (self._index and self._dirty):
+            return
+        index = dict(fingerprint=self._fingerprint, fonts=self._fonts, families=self._fams,
+                     members=self._members, parents=self._parents, encodings=self._enc)
+        try:
+            if not os.path.isdir(os.path.dirname(self._index)):
+                os.makedirs(os.path.dirname(self._index))
+            with atomic_write(self._index, 'w') as f:
+                json.dump(index, f)
+            self._dirty = False
+        except (IOError, OSError):
+            pass # the index is only an optimization so don't complain if it can't be written
 
     def refresh(self):
-        if self._fonts != _fm.availableFonts():
-            self.__init__()
+        now = time.time()
+        if now - self._checked < REFRESH_INTERVAL:
+            return
+        self._checked = now
+        fingerprint = fonts_fingerprint()
+        if fingerprint != self._fingerprint:
+            self._save()
+            self._load(fingerprint)
 
     @property
     def font_names(self):
@@ -547,6 +632,7 @@ class Librarian(object):
         if psname not in self._parents:
             font = NSFont.fontWithName_size_(psname, 12)
             self._parents[psname] = font.familyName()
+            self._dirty = True
         return self._parents[psname]
 
     def encoding(self, psname):
@@ -557,6 +643,7 @@ class Librarian(object):
             enc = font.mostCompatibleStringEncoding()
             enc_name = NSString.localizedNameOfStringEncoding_(enc)
             self._enc[psname] = re.sub(r' \(Mac OS.*?\)$', '', enc_name)
+            self._dirty = True
         return self._enc[psname]
 
     def best_face(self, spec):
@@ -608,31 +695,16 @@ class Librarian(object):
     def best_fam(self, word):
         """Returns a valid family name if the arg fuzzy matches any existing families"""
         self.refresh()
+        if self._lookup is None:
+            self._lookup = FamilyIndex(self._fams)
 
-        # first try for an exact match
         word = re.sub(r'  +',' ',word.strip())
-        if word in self._fams:
-            return word
-
         if word not in self._fuzzy:
-            # do a case-insensitive, no-whitespace comparison
-            q = sanitized(word)
-            corpus = sanitized(self._fams)
-            if q in corpus:
-                self._fuzzy[word] = self._fams[corpus.index(q)]
-            elif q:
-                # if still no match, compare against a list of names with all the noise words taken out
-                corpus = debranded(self._fams, keep=branding(word))
-                if word in corpus:
-                    self._fuzzy[word] = self._fams[corpus.index(word)]
-                elif q in sanitized(corpus):
-                    # case-insensitive with the de-noised names
-                    self._fuzzy[word] = self._fams[sanitized(corpus).index(q)]
-
-            if word not in self._fuzzy:
+            self._fuzzy[word] = self._lookup.find(word)
+
+            if self._fuzzy[word] is None:
                 # give up but first do a broad search and suggest other names in the exception
-                in_corpus = difflib.get_close_matches(q, corpus, 4, cutoff=0)
-                matches = [self._fams[corpus.index(m)] for m in in_corpus]
+                matches = self._lookup.suggest(word)
                 nomatch = "ambiguous font family name \"%s\""%word
                 if matches:
                     nomatch += '.\nDid you mean: %s'%[m.encode('utf-8') for m in matches]
@@ -736,9 +808,107 @@ class Librarian(object):
 
             # save the collection to the cache before returning it
             self._members[famname] = sorted(fam, key=attrgetter('italic','wid','wgt'))
+            self._dirty = True
 
         if names:
             return [f[0] for f in self._members[famname]]
         return self._members[famname]
 
+class FamilyIndex(object):
+    """Lookup tables for resolving mis-capitalized, misspelled, or (de)branded family names
+
+    Names are matched exactly, then case- and whitespace-insensitively, then with the
+    `std_branding' noise words removed (keeping any that also appear in the query). Each of
+    these is a dict lookup. If nothing matches, suggest() ranks the names that share the most
+    trigrams with the query by their similarity to it.
+    """
+    def __init__(self, fams):
+        self.fams = list(fams)
+        self._exact = set(self.fams)
+        self._clean = sanitized(self.fams)
+        self._sanitized = _first_match(self._clean, self.fams)
+        self._debranded = {} # frozenset of removed brand words -> (names, sanitized names) maps
+        self._trigrams = ddict(list)
+        for i, name in enumerate(self._clean):
+            for gram in _trigrams(name):
+                self._trigrams[gram].append(i)
+
+    def find(self, word):
+        """Return the family name that `word` refers to (or None if there's no match)"""
+        if word in self._exact:
+            return word
+
+        # do a case-insensitive, no-whitespace comparison
+        q = sanitized(word)
+        if q in self._sanitized:
+            return self._sanitized[q]
+        elif q:
+            # if still no match, compare against the names with all the noise words taken out
+            # (both as-is and case-insensitively)
+            names, clean_names = self._without_branding(branding(word))
+            return names.get(word) or clean_names.get(q)
+
+    def suggest(self, word, count=4):
+        """Return a list of the family names most similar to `word`"""
+        q = sanitized(word) or ''
+        overlap = ddict(int)
+        for gram in _trigrams(q):
+            for i in self._trigrams.get(gram, []):
+                overlap[i] += 1
+        shortlist = sorted(overlap, key=overlap.get, reverse=True)[:SHORTLIST] or range(len(self.fams))
+        similarity = lambda i: difflib.SequenceMatcher(None, q, self._clean[i]).ratio()
+        return [self.fams[i] for i in sorted(shortlist, key=similarity, reverse=True)[:count]]
+
+    def _without_branding(self, keep):
+        removed = frozenset(std_branding).difference(keep)
+        if removed not in self._debranded:
+            corpus = debranded(self.fams, keep=keep)
+            self._debranded[removed] = (_first_match(corpus, self.fams),
+                                        _first_match(sanitized(corpus), self.fams))
+        return self._debranded[removed]
+
+def _first_match(keys, fams):
+    # map each key to the first family it was derived from
+    mapping = {}
+    for key, fam in zip(keys, fams):
+        mapping.setdefault(key, fam)
+    return mapping
+
+def _trigrams(name):
+    padded = ' %s ' % name
+    return set(padded[i:i+3] for i in range(len(padded)-2))
+
+class AdvanceTable(object):
+    """Character advances & pairwise kerning for a single face, for estimating line widths
+
+    Each character (and each adjacent pair) is measured once with the string-drawing machinery
+    the first time it's encountered. After that the width of a line can be found by summing
+    the table entries rather than running the typesetter. Ligatures, contextual alternates, and
+    combining characters aren't accounted for, so the results are only approximate.
+    """
+    def __init__(self, ns_font):
+        ns_font = NSFont.fontWithDescriptor_size_(ns_font.fontDescriptor(), EM)
+        self._attrs = {"NSFont":ns_font}
+        self._advances = {} # char -> width in em units
+        self._kerning = {}  # pair -> adjustment to the sum of their advances in em units
+
+    def width(self, txt, size):
+        """Return the estimated width (in points) of a single line of text at a given point size"""
+        advances, kerning = self._advances, self._kerning
+        total = 0.0
+        for c in txt:
+            if c not in advances:
+                advances[c] = self._measure(c)
+            total += advances[c]
+        for i in xrange(len(txt)-1):
+            pair = txt[i:i+2]
+            if pair not in kerning:
+                kerning[pair] = self._measure(pair) - advances[pair[0]] - advances[pair[1]]
+            total += kerning[pair]
+        return total * size / EM
+
+    def _measure(self, chars):
+        return NSString.stringWithString_(chars).sizeWithAttributes_(self._attrs).width
+
 LIBRARY = Librarian()
+atexit.register(LIBRARY._save)
@@ -1,19 +1,446 @@
-import objc, os, re
+import objc, os, re, sys, json, time, types
+from multiprocessing import cpu_count
+from hashlib import sha1
+from functools import partial
+from collections import deque
+from Queue import Queue
+from threading import Thread, Lock, Condition
 from PyObjCTools import AppHelper
+from .cocoa import *
+from ..util import autorelease, odict
+import plotdevice
+from plotdevice import DeviceError
+try:
+    from ..util.gif import GifWriter
+    from ..util.stream import FrameStream
+    from ..util import png
+except ImportError:
+    # numpy isn't available so fall back to the AnimatedGif writer & NSBitmapImageRep's png encoder
+    # (and don't support streaming exports at all)
+    GifWriter = FrameStream = png = None
 import cIO
 for cls in ["AnimatedGif", "Pages", "SysAdmin", "Video"]:
     globals()[cls] = objc.lookUpClass(cls)
 
+### bitmap encoding for image-file exports ###
+
+_imgTypes = {"gif":  NSGIFFileType,
+             "jpg":  NSJPEGFileType,
+             "jpeg": NSJPEGFileType,
+             "png":  NSPNGFileType,
+             "tiff": NSTIFFFileType}
+
+def bitmap_data(img, format):
+    """Encode an NSImage as the bytes of a gif, jpg, png, or tiff file (returned as NSData)"""
+    if format not in _imgTypes:
+        badformat = "Filename should end in .pdf, .eps, .tiff, .gif, .jpg or .png"
+        raise DeviceError(badformat)
+
+    data = img.TIFFRepresentation()
+    if format == 'tiff':
+        return data
+    rep = NSBitmapImageRep.imageRepWithData_(data)
+    props = {NSImageCompressionFactor:1.0} if format in ('jpg','jpeg') else None
+    return rep.representationUsingType_properties_(_imgTypes[format], props)
+
+def png_data(pixels, level=6, threads=1):
+    """Encode an (h,w,4) array of premultiplied RGBA pixels as the bytes of a png file (returned as NSData)
+
+    Unlike bitmap_data, the pixels are filtered and compressed straight out of the array (rather
+    than round-tripping through a TIFF representation) and zlib releases the GIL while deflating,
+    so multiple frames can be encoded in parallel by the export pipeline's worker threads.
+    """
+    data = png.encode(pixels, level=level, threads=threads)
+    return NSData.dataWithBytes_length_(data, len(data))
+
+### Multi-threaded pipeline for rendering, encoding, & writing frames ###
+
+_EOF = object()
+
+class Stage(object):
+    """One step in an export Pipeline: a bounded input queue serviced by a pool of threads.
+
+    If `workers` is 0 the stage runs inline in the thread calling put(). An `ordered` stage
+    has a single worker that processes items in the order they were submitted to the pipeline
+    (regardless of the order in which upstream workers finish with them).
+    """
+    def __init__(self, name, func, depth=4, workers=1, ordered=False):
+        self.name = name
+        self.func = func
+        self.depth = max(1, depth)
+        self.workers = 1 if ordered else max(0, workers)
+        self.ordered = ordered
+        self.pipeline = None # set by the Pipeline
+        self.output = None   # the next stage downstream (if any)
+
+        self._queue = Queue(maxsize=self.depth)
+        self._threads = []
+        self._pending = {} # reorder buffer for ordered stages
+        self._next = 0
+        self._lock = Lock()
+
+        # metrics
+        self.processed = 0  # items handed off downstream (or consumed by the last stage)
+        self.busy = 0.0     # seconds spent in func (summed over all workers)
+        self.stalled = 0.0  # seconds spent blocked on a full downstream queue
+        self.peak = 0       # maximum number of items found waiting in the input queue
+        self._samples = 0
+        self._occupancy = 0
+
+    def start(self):
+        for i in range(self.workers):
+            worker = Thread(target=self._work, name='plotdevice-%s-%i'%(self.name, i))
+            worker.daemon = True
+            worker.start()
+            self._threads.append(worker)
+
+    def put(self, seq, item):
+        """Add an item to the input queue and return the time spent waiting for a free slot"""
+        if not self.workers:
+            self._process(seq, item)
+            return 0.0
+
+        with self._lock:
+            waiting = self._queue.qsize()
+            self._samples += 1
+            self._occupancy += waiting
+            self.peak = max(self.peak, waiting)
+
+        then = time.time()
+        self._queue.put((seq, item))
+        return time.time() - then
+
+    def join(self):
+        for worker in self._threads:
+            self._queue.put((None, _EOF))
+        for worker in self._threads:
+            worker.join()
+        self._threads = []
+
+    def _work(self):
+        while True:
+            seq, item = self._queue.get()
+            if item is _EOF:
+                return
+            if not self.ordered:
+                self._process(seq, item)
+                continue
+
+            if self.pipeline.error:
+                continue # don't hold onto frames that can't be written once something's failed
+            self._pending[seq] = item
+            while self._next in self._pending:
+                self._process(self._next, self._pending.pop(self._next))
+                self._next += 1
+
+    def _process(self, seq, item):
+        pipeline = self.pipeline
+        if pipeline.error:
+            return # drain the queue without doing any work once something has failed
+
+        then = time.time()
+        try:
+            with autorelease():
+                result = self.func(item)
+        except:
+            pipeline.error = sys.exc_info()
+            return
+        finally:
+            with self._lock:
+                self.busy += time.time() - then
+
+        if self.output:
+            stalled = self.output.put(seq, result)
+        with self._lock:
+            self.processed += 1
+            if self.output:
+                self.stalled += stalled
+
+    @property
+    def metrics(self):
+        elapsed = max(time.time() - self.pipeline.started, 1e-6)
+        return dict(processed=self.processed,
+                    workers=self.workers,
+                    depth=self.depth,
+                    busy=self.busy,
+                    stalled=self.stalled,
+                    throughput=self.processed / elapsed,
+                    utilization=self.busy / (elapsed * max(1, self.workers)),
+                    queued=self._queue.qsize() + len(self._pending),
+                    peak=self.peak,
+                    occupancy=self._occupancy / float(self._samples or 1))
+
+class Pipeline(object):
+    """A chain of Stages with bounded queues between them.
+
+    Calls to put() run the first stage (inline if it has no workers) and block once the
+    queue downstream of it is full, so a fast script can't race arbitrarily far ahead of
+    the encoder. Exceptions raised by any stage are re-raised in the producer's thread on
+    the next call to put() or join() (and every call thereafter, since frames are dropped
+    from that point on).
+    """
+    def __init__(self, *stages):
+        self.stages = stages
+        self.error = None
+        self.started = time.time()
+        self._seq = 0
+        for stage, downstream in zip(stages, stages[1:]+(None,)):
+            stage.pipeline = self
+            stage.output = downstream
+            stage.start()
+
+    def put(self, item):
+        self._check()
+        self.stages[0].put(self._seq, item)
+        self._seq += 1
+        self._check()
+
+    def join(self):
+        """Wait for each stage to drain its queue then shut down the workers"""
+        for stage in self.stages:
+            stage.join()
+        self._check()
+
+    @property
+    def metrics(self):
+        """Per-stage throughput and queue-occupancy figures (keyed by stage name)"""
+        return odict((stage.name, stage.metrics) for stage in self.stages)
+
+    @property
+    def bottleneck(self):
+        """The name of the stage whose workers have been kept busiest"""
+        busiest = max(self.stages, key=lambda stage:stage.metrics['utilization'])
+        return busiest.name
+
+    def _check(self):
+        if self.error:
+            etype, val, tb = self.error
+            raise etype, val, tb
+
+### Content-hashes of display lists (and of previously exported frames) ###
+
+class _Uncacheable(Exception):
+    pass
+
+_SKIP = object() # placeholder passed down the pipeline in lieu of an unchanged frame
+
+class ContentHash(object):
+    """Computes digests of grobs (or whole display lists) by value
+
+    Objects are followed down through their attributes, containers, callbacks, and images
+    so that two display lists hash the same only if they'll draw the same. Anything that
+    can't be serialized (e.g., an opaque pointer) makes the whole digest None.
+    """
+    _volatile = ('_segment_cache', '_rollback') # grob attrs that don't affect the output
+
+    def __init__(self):
+        self._images = odict() # digests of recently seen NSImages
+
+    def __call__(self, obj, salt=''):
+        """Return a hex digest of `obj` (or None if it can't be serialized)"""
+        h = sha1(salt)
+        try:
+            self._update(h, obj, set())
+        except _Uncacheable:
+            return None
+        return h.hexdigest()
+
+    def _update(self, h, obj, seen):
+        if obj is None or isinstance(obj, (bool, int, long, float, basestring)):
+            h.update('%s%r;' % (type(obj).__name__, obj))
+        elif isinstance(obj, (list, tuple)):
+            h.update('%s[' % type(obj).__name__)
+            for item in obj:
+                self._update(h, item, seen)
+            h.update(']')
+        elif isinstance(obj, dict):
+            h.update('{')
+            for key in sorted(obj, key=repr):
+                h.update(repr(key))
+                self._update(h, obj[key], seen)
+            h.update('}')
+        elif isinstance(obj, (set, frozenset)):
+            self._update(h, sorted(obj, key=repr), seen)
+        elif isinstance(obj, types.ModuleType):
+            h.update('module %s;' % obj.__name__)
+        elif isinstance(obj, (type, types.ClassType)):
+            h.update('class %s.%s;' % (obj.__module__, obj.__name__))
+        elif isinstance(obj, (types.FunctionType, types.CodeType)) and id(obj) in seen:
+            h.update('@%s;' % getattr(obj, '__name__', 'code'))
+        elif isinstance(obj, types.FunctionType):
+            # callbacks differ by their bytecode, constants, defaults, closure cells, and
+            # the globals they refer to (not just their names)
+            seen.add(id(obj))
+            code = obj.func_code
+            h.update('function %s(' % obj.__name__)
+            self._update(h, code, seen)
+            self._update(h, obj.func_defaults, seen)
+            self._update(h, [_cell_contents(cell) for cell in obj.func_closure or ()], seen)
+            self._update(h, {name:obj.func_globals[name] for name in code.co_names if name in obj.func_globals}, seen)
+            h.update(')')
+        elif isinstance(obj, types.CodeType):
+            seen.add(id(obj))
+            h.update('code(%s' % obj.co_code)
+            self._update(h, (obj.co_consts, obj.co_names), seen)
+            h.update(')')
+        elif isinstance(obj, types.MethodType):
+            h.update('method(')
+            self._update(h, (obj.im_func, obj.im_self), seen)
+            h.update(')')
+        elif isinstance(obj, partial):
+            h.update('partial(')
+            self._update(h, (obj.func, obj.args, obj.keywords or {}), seen)
+            h.update(')')
+        elif isinstance(obj, types.BuiltinFunctionType):
+            h.update('builtin %s.%s(' % (getattr(obj, '__module__', None), obj.__name__))
+            self._update(h, getattr(obj, '__self__', None), seen)
+            h.update(')')
+        elif isinstance(obj, NSImage):
+            h.update(self._image_digest(obj))
+        elif isinstance(obj, NSLayoutManager):
+            h.update('NSLayoutManager;') # derived entirely from the text storage & containers
+        elif isinstance(obj, NSObject):
+            try:
+                h.update(NSKeyedArchiver.archivedDataWithRootObject_(obj).bytes())
+            except Exception:
+                raise _Uncacheable()
+        elif id(obj) in seen:
+            h.update('@%s;' % type(obj).__name__)
+        else:
+            seen.add(id(obj))
+            attrs = dict(getattr(obj, '__dict__', {}))
+            for cls in type(obj).__mro__:
+                slots = getattr(cls, '__slots__', ())
+                for slot in [slots] if isinstance(slots, basestring) else slots:
+                    if hasattr(obj, slot):
+                        attrs[slot] = getattr(obj, slot)
+            if not hasattr(obj, '__dict__') and not attrs:
+                raise _Uncacheable() # an opaque pointer or some such
+
+            h.update('%s(' % type(obj).__name__)
+            for attr in sorted(attrs):
+                if attr not in self._volatile:
+                    h.update(attr)
+                    self._update(h, attrs[attr], seen)
+            h.update(')')
+
+    def _image_digest(self, img):
+        # hashing the pixels is expensive so remember the most recent images' digests (holding a
+        # reference to each so its id can't be reused while it's in the table)
+        key = objc.pyobjc_id(img)
+        if key in self._images and self._images[key][0] is img:
+            return self._images[key][1]
+        digest = sha1(img.TIFFRepresentation().bytes()).hexdigest()
+        self._images[key] = (img, digest)
+        while len(self._images) > 64:
+            self._images.popitem(last=False)
+        return digest
+
+
+class FrameCache(object):
+    """A manifest of the content-hashes of the frames previously written to an image sequence.
+
+    Each frame's digest covers its serialized display list plus the export options. Frames
+    whose digest matches the manifest (and whose output file is still present) can be skipped
+    rather than rasterized and encoded again. Entries are only added once the writer has put
+    the file on disk, so an interrupted export can be resumed by simply re-running it.
+    """
+    VERSION = 1
+
+    def __init__(self, name_tmpl, **opts):
+        self.name_tmpl = name_tmpl
+        dirname, basename = os.path.split(name_tmpl)
+        self.path = os.path.join(dirname, '.%s.frames' % basename.replace('%', '#'))
+        self.salt = json.dumps([self.VERSION, plotdevice.__version__, sorted(opts.items())])
+        self.saved = 0
+        self._lock = Lock()
+        self._hash = ContentHash()
+        self._pending = deque() # (num, digest) pairs in the order they were given to the writer
+        self._written = 0
+
+        try:
+            with open(self.path) as f:
+                manifest = json.load(f)
+            assert manifest['salt'] == self.salt
+            self.frames = {int(num):tuple(entry) for num, entry in manifest['frames'].items()}
+        except Exception:
+            self.frames = {}
+
+    def digest(self, canvas):
+        """Return a hex digest of the canvas's contents (or None if it can't be serialized)"""
+        return self._hash((canvas.pagesize, canvas.background, canvas._grobs), self.salt)
+
+    def lookup(self, num, digest):
+        """Whether the output file for frame `num` already contains a frame with this digest"""
+        with self._lock:
+            entry = self.frames.get(num)
+        if digest is None or entry is None or entry[0] != digest:
+            return False
+        try:
+            return os.path.getsize(self.name_tmpl % num) == entry[1]
+        except OSError:
+            return False
+
+    def pending(self, num, digest):
+        """Note that frame `num` has been handed to the writer (but isn't on disk yet)"""
+        with self._lock:
+            self.frames.pop(num, None)
+            self._pending.append((num, digest))
+
+    def confirm(self, written):
+        """Record the digests of the frames the writer has finished with (`written` is its
+        running total of frames written)"""
+        with self._lock:
+            while self._written < written and self._pending:
+                num, digest = self._pending.popleft()
+                self._written += 1
+                if digest is None:
+                    continue
+                try:
+                    self.frames[num] = (digest, os.path.getsize(self.name_tmpl % num))
+                except OSError:
+                    pass
+
+    def save(self):
+        with self._lock:
+            frames = {str(num):entry for num, entry in self.frames.items()}
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(dict(salt=self.salt, frames=frames), f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            pass
+        self.saved = time.time()
+
+def _cell_contents(cell):
+    try:
+        return cell.cell_contents
+    except ValueError:
+        return None # a closure variable that hasn't been assigned yet
+
 ### Session objects which wrap the GCD-based export managers ###
 
 class ExportSession(object):
+    """Base class for the image, movie, and stream exporters
 
-    def __init__(self):
+    Subclasses must define a _stages() method returning the list of Stages (see _stage)
+    that each canvas passed to add() should flow through on its way to the writer. The
+    pipeline is only constructed once the first frame is added.
+    """
+
+    # default queue depths & worker counts for the stages of the export pipeline
+    _depth = dict(render=1, rasterize=4, encode=4, write=4)
+    _workers = dict(render=0, rasterize=1, encode=max(2, cpu_count()), write=1)
+
+    def __init__(self, sync=False, depth=None, workers=None):
         # state flags
         self.running = True
         self.cancelled = False
+        self.closed = False
         self.added = 0
         self.written = 0
+        self.skipped = 0
         self.total = 0
 
         # callbacks
@@ -24,19 +451,52 @@ class ExportSession(object):
         # one of the cIO classes
         self.writer = None
 
+        # if `sync` is set, progress is reported from add() and done() rather than by
+        # polling from the runloop
+        self.sync = sync
+        self.poll = None
+
+        # frames pass through the render (on the calling thread), rasterize, encode, & write
+        # stages. the depth & workers args can either be ints (applying to all the background
+        # stages) or dicts keyed by stage name
+        self.pipeline = None
+        self._opts = dict(depth=depth, workers=workers)
+        self._submitted = 0
+        self._flushed = Condition() # notified whenever the writer's progress is polled
+
+    def _stage(self, name, func, ordered=False):
+        opts = {}
+        for opt, defaults in ('depth',self._depth), ('workers',self._workers):
+            val = self._opts[opt]
+            if isinstance(val, dict):
+                val = val.get(name)
+            elif name=='render':
+                val = None # always render on the calling thread
+            opts[opt] = defaults[name] if val is None else val
+        return Stage(name, func, ordered=ordered, **opts)
+
+    @property
+    def metrics(self):
+        """Throughput and queue-occupancy figures for each stage of the export pipeline"""
+        return self.pipeline.metrics if self.pipeline else odict()
+
     def begin(self, frames=None, pages=None):
-        from plotdevice.gui import set_timeout
         self.total = frames if frames is not None else pages
-        self.poll = set_timeout(self, "update:", 0.1, repeat=True)
+        if not self.sync:
+            from plotdevice.gui import set_timeout
+            self.poll = set_timeout(self, "update:", 0.1, repeat=True)
 
     def update_(self, note):
-        self.written = self.writer.framesWritten()
+        if self.writer:
+            self.written = self.writer.framesWritten() + self.skipped
+        with self._flushed:
+            self._flushed.notify_all()
         if self._progress:
             # let the delegate update the progress bar
             goal = self.added if self.cancelled else self.total
             self._progress(self.written, goal, self.cancelled)
 
-        if self.writer.doneWriting():
+        if self.closed and (self.writer is None or self.writer.doneWriting()):
             self.shutdown()
 
     def next(self):
@@ -44,6 +504,38 @@ class ExportSession(object):
             return None
         return self.added + 1
 
+    def add(self, canvas):
+        """Queue the canvas's current contents to be rasterized, encoded, and written"""
+        if self.closed:
+            return # the session was shut down during setup (e.g., due to a bad format)
+        if not self.pipeline:
+            self.pipeline = Pipeline(*self._stages())
+        try:
+            self.pipeline.put(canvas)
+        except:
+            self.cancel() # a stage failed so none of the frames after it can be written
+            raise
+        self.added += 1
+        if self.sync:
+            self.update_(None)
+
+    def _snapshot(self, canvas):
+        # called on the main thread (while the canvas is still intact)
+        return canvas._snapshot()
+
+    def _rasterize(self, canvas):
+        return canvas.rasterize(cached=False)
+
+    def _throttle(self):
+        # don't let the objc writer's own queue grow without bound either
+        self._submitted += 1
+        depth = self.pipeline.stages[-1].depth
+        with self._flushed:
+            while self._submitted - self.writer.framesWritten() > depth:
+                # the cIO writers can't signal us when a frame is done so wake up whenever
+                # update_ polls them (or after a short timeout in case nobody's polling)
+                self._flushed.wait(0.05)
+
     def cancel(self):
         if self.cancelled:
             return # be idem potent
@@ -55,8 +547,22 @@ class ExportSession(object):
     def done(self):
         # if self._status:
         #     self._status('finishing')
-        if self.writer:
-            self.writer.closeFile()
+        try:
+            if self.pipeline:
+                self.pipeline.join()
+        except:
+            self.cancel()
+            raise
+        finally:
+            if self.writer:
+                self.writer.closeFile()
+            self.closed = True
+
+        # when running without a runloop, block until the writer is finished
+        while self.sync and self.running:
+            self.update_(None)
+            if self.running:
+                time.sleep(0.05)
 
     def shutdown(self):
         self.running = False
@@ -80,12 +586,17 @@ class ExportSession(object):
 
 re_padded = re.compile(r'{(\d+)}')
 class ImageExportSession(ExportSession):
-    def __init__(self, fname, format='pdf', first=1, last=None, single=False, **rest):
-        super(ImageExportSession, self).__init__()
+    def __init__(self, fname, format='pdf', first=1, last=None, single=False, sync=False, depth=None, workers=None, cache=False, cmyk=False, compression=6, **rest):
+        super(ImageExportSession, self).__init__(sync=sync, depth=depth, workers=workers)
         self.single_file = single or first==last
+        self.format = format
+        self.compression = compression
+        self.cache = None
+
+        # pngs are encoded directly from raw pixel buffers when numpy is present
+        self.raw = format == 'png' and png is not None and not cmyk
         if last is not None:
             self.begin(pages=last-first+1)
-        self.format = format
 
         m = re_padded.search(fname)
         pad = '%%0%id' % int(m.group(1)) if m else None
@@ -104,39 +615,161 @@ class ImageExportSession(ExportSession):
                 name_tmpl = "".join([basename, '-%04d', ext])
             self.writer = Pages.alloc().initWithPattern_(name_tmpl)
 
-    def add(self, canvas):
-        image = canvas._getImageData(self.format)
-        self.writer.addPage_(image)
-        self.added += 1
+            # skip over frames that are unchanged since the last time the sequence was exported
+            if cache:
+                self.cache = FrameCache(name_tmpl, format=format, cmyk=cmyk, compression=compression)
+        self._digests = deque() # (num, digest) pairs for the frames in the pipeline
+
+    def _stages(self):
+        if self.format in ('pdf','eps'):
+            # vector formats are drawn via an NSView so keep them on the main thread
+            return [self._stage('render', self._render),
+                    self._stage('write', self._write, ordered=True)]
+
+        return [self._stage('render', self._render),
+                self._stage('rasterize', self._rasterize),
+                self._stage('encode', self._encode),
+                self._stage('write', self._write, ordered=True)]
+
+    def _render(self, canvas):
+        if self.cache:
+            num = self.added + 1
+            digest = self.cache.digest(canvas)
+            self._digests.append((num, digest))
+            if self.cache.lookup(num, digest):
+                return _SKIP
+
+        if self.format in ('pdf','eps'):
+            return canvas._getImageData(self.format)
+        return self._snapshot(canvas)
+
+    def _rasterize(self, canvas):
+        if canvas is _SKIP:
+            return canvas
+        if self.raw:
+            return canvas._rgba()
+        return canvas.rasterize(cached=False)
+
+    def _encode(self, img):
+        if img is _SKIP:
+            return img
+        if self.raw:
+            # a sequence is spread across the encode stage's workers one frame apiece, but
+            # a lone image gets split into chunks that are compressed in parallel instead
+            threads = max(1, self.pipeline.stages[-2].workers) if self.single_file else 1
+            return png_data(img, self.compression, threads)
+        return bitmap_data(img, self.format)
+
+    def _write(self, data):
+        if not self.cache:
+            self.writer.addPage_(data)
+        else:
+            num, digest = self._digests.popleft()
+            if data is _SKIP:
+                self.skipped += 1
+                return
+            self.cache.pending(num, digest)
+            self.writer.setPageCount_(num-1) # the writer numbers files based on its page count
+            self.writer.addPage_(data)
+        self._throttle()
+
+    def update_(self, note):
+        cache, writer = self.cache, self.writer
+        super(ImageExportSession, self).update_(note)
+        if cache and writer:
+            # add the frames that have hit the disk to the manifest
+            cache.confirm(writer.framesWritten())
+            if not self.running or time.time() - cache.saved > 1.0:
+                cache.save()
 
 class MovieExportSession(ExportSession):
-    def __init__(self, fname, format='mov', first=1, last=None, fps=30, bitrate=1, loop=0, **rest):
-        super(MovieExportSession, self).__init__()
+    def __init__(self, fname, format='mov', first=1, last=None, fps=30, bitrate=1, loop=0, sync=False, depth=None, workers=None, palette='local', quantize='median', **rest):
+        if format not in ('mov', 'gif'):
+            badformat = 'Unrecognized movie format: %s (should be mov or gif)' % format
+            raise DeviceError(badformat)
+        super(MovieExportSession, self).__init__(sync=sync, depth=depth, workers=workers)
         try:
             os.unlink(fname)
         except:
             pass
-        if last is not None:
-            self.begin(frames=last-first+1)
         self.fname = fname
         self.format = format
         self.fps = fps
         self.loop = loop
         self.bitrate = bitrate
+        if last is not None:
+            self.begin(frames=last-first+1)
 
-    def add(self, canvas):
-        image = canvas.rasterize()
+        # gifs are encoded from raw pixel buffers (with frame differencing) when numpy is present
+        self.raw = format == 'gif' and GifWriter is not None
+        if self.raw:
+            self.writer = GifWriter(fname, fps, loop, palette=palette, quantize=quantize)
+
+    def _stages(self):
+        # frames are encoded by the Video/AnimatedGif writer on its own queue
+        return [self._stage('render', self._snapshot),
+                self._stage('rasterize', self._rasterize),
+                self._stage('write', self._write, ordered=True)]
+
+    def _rasterize(self, canvas):
+        if self.raw:
+            return canvas._rgba()
+        return canvas.rasterize(cached=False)
+
+    def _write(self, image):
         if not self.writer:
             dims = image.size()
             if self.format == 'mov':
-                self.writer = Video.alloc()
-                self.writer.initWithFile_size_fps_bitrate_(self.fname, dims, self.fps, self.bitrate)
+                writer = Video.alloc()
+                writer.initWithFile_size_fps_bitrate_(self.fname, dims, self.fps, self.bitrate)
             elif self.format == 'gif':
-                self.writer = AnimatedGif.alloc()
-                self.writer.initWithFile_size_fps_loop_(self.fname, dims, self.fps, self.loop)
-            else:
-                print 'unrecognized output format: %s' % self.format
-                return self.shutdown()
-        self.writer.addFrame_(image)
-        self.added += 1
+                writer = AnimatedGif.alloc()
+                writer.initWithFile_size_fps_loop_(self.fname, dims, self.fps, self.loop)
+            self.writer = writer
+
+        if self.raw:
+            self.writer.addFrame(image)
+        else:
+            self.writer.addFrame_(image)
+            self._throttle()
+
+class StreamExportSession(ExportSession):
+    def __init__(self, fname, format='png', first=1, last=None, fps=30, sync=False, depth=None, workers=None, compression=6, **rest):
+        super(StreamExportSession, self).__init__(sync=sync, depth=depth, workers=workers)
+        if FrameStream is None:
+            nonumpy = 'Streaming frames to a pipe requires numpy'
+            raise DeviceError(nonumpy)
+        if last is not None:
+            self.begin(frames=last-first+1)
+        self.format = format
+        self.writer = FrameStream(fname, format, fps=fps, compression=compression)
+
+    def _stages(self):
+        # frames are written as soon as they're encoded. the writes block while the reader
+        # is busy, which fills the bounded queues and stalls the renderer in turn
+        return [self._stage('render', self._render),
+                self._stage('rasterize', self._rasterize),
+                self._stage('encode', self._encode),
+                self._stage('write', self._write, ordered=True)]
+
+    def _render(self, canvas):
+        # tag the frame with its FRAME number
+        return self.added + 1, self._snapshot(canvas)
+
+    def _rasterize(self, frame):
+        num, canvas = frame
+        return num, canvas._rgba()
 
+    def _encode(self, frame):
+        num, pixels = frame
+        return self.writer.encode(pixels, num)
+
+    def _write(self, data):
+        self.writer.addFrame(data)
+
+    def update_(self, note):
+        # notice if the reader closed its end of the pipe (checking here rather than in the
+        # write stage so the delegate's callbacks are made from the main thread)
+        if self.writer and self.writer.broken:
+            self.cancel()
+        super(StreamExportSession, self).update_(note)
@@ -9,9 +9,10 @@ This is the back-end of the `plotdevice` command line script in the 'app' subdir
 distribution (or the bin directory of your virtualenv once installed). It expects the parsed args
 from the front-end to be passed as a json blob piped to stdin.
 
-If an export option was specified, the output file(s) will be generated and the script will terminate
-once disk i/o completes. Otherwise a window will open to display the script's output and will remain
-until dismissed by quitting the app or sending a ctrl-c from the console.
+If an export option was specified, the output file(s) will be generated (without starting up the
+runloop) and the script will terminate once disk i/o completes. Otherwise a window will open to
+display the script's output and will remain until dismissed by quitting the app or sending a
+ctrl-c from the console.
 """
 
 import sys
@@ -19,6 +20,7 @@ import os
 import json
 import select
 import signal
+from threading import Thread
 from math import floor, ceil
 from os.path import dirname, abspath, exists, join
 from codecs import open
@@ -28,6 +30,7 @@ import objc # ...otherwise this would fail
 from PyObjCTools import AppHelper
 from plotdevice.lib.cocoa import *
 from plotdevice.gui import ScriptController
+from plotdevice.run.sandbox import Sandbox
 from plotdevice.util import rsrc_path
 from plotdevice.run import encoding
 
@@ -81,21 +84,6 @@ class ScriptAppDelegate(NSObject):
                 NSApp().activateIgnoringOtherApps_(True)
             self.script.showWindow_(self)
             AppHelper.callAfter(self.script.scriptedRun)
-        elif self.mode=='headless':
-            # create a window-less WindowController
-            self.script = ConsoleScript.alloc().init()
-            self.script.setScript_options_(pth, self.opts)
-
-            # BUG? FEATURE? (it's a mystery!)
-            # exports will stall if `last` isn't an int. this should probably
-            # be handled by the command line arg-parser though, no?
-            if not opts.get('last',None):
-                opts['last'] = opts.get('first', 1)
-
-            # kick off an export session
-            format = self.opts['export'].rsplit('.',1)[1]
-            kind = 'movie' if format in ('mov','gif') else 'image'
-            self.script.exportInit(kind, self.opts['export'], self.opts)
 
     def catchInterrupts_(self, sender):
         read, write, timeout = select.select([sys.stdin.fileno()], [], [], 0)
@@ -151,7 +139,51 @@ class ScriptWatcher(NSObject):
             self.mtime = file_mtime
             return True
 
-class ConsoleScript(ScriptController):
+class ConsoleOutput(object):
+    """Mixin for the console delegates that writes the script's output and export progress to the terminal
+
+    Script output is sent to _stdout (or stderr) and the progress meter is redrawn on stderr
+    after each write. Expects the delegate to have a `vm` attribute with the Sandbox.
+    """
+    _stdout = STDOUT
+    _buf = '' # cache the export progress message between stdout writes
+
+    def echo(self, output):
+        STDERR.write(ERASER)
+        for isErr, data in output:
+            stream = STDERR if isErr else self._stdout
+            stream.write(data)
+            stream.flush()
+        if self._buf:
+            STDERR.write(self._buf)
+            STDERR.flush()
+
+    def exportStatus(self, event):
+        if event == 'cancelled':
+            msg = 'Halted after %i frames. Finishing file I/O...\n' % self.vm.session.added
+        else:
+            msg = ''
+        self._stdout.flush()
+        STDERR.write(ERASER + msg)
+        STDERR.flush()
+
+        if event=='complete':
+            self._buf = ''
+
+    def exportProgress(self, written, total, cancelled):
+        if cancelled:
+            msg = "%i frames to go..."%(total-written)
+        else:
+            padding = len(str(total)) - len(str(written))
+            msg = "%s%i/%i frames written"%(' '*padding, written, total)
+
+        dots = progress(written, total)
+        self._buf = '\r%s %s\r%s'%(dots, msg, dots[:1+dots.count('#')])
+        STDERR.write(ERASER + self._buf)
+        STDERR.flush()
+
+
+class ConsoleScript(ScriptController, ConsoleOutput):
 
     def init(self):
         self._init_state()
@@ -168,9 +200,7 @@ class ConsoleScript(ScriptController):
     @property
     def unicode_src(self):
         """Read in our script file's contents (honoring its `# encoding: ...` if present)"""
-        src = file(self.path).read()
-        enc = encoding(src) or 'utf-8'
-        return src.decode(enc)
+        return read_script(self.path)
 
     def scriptedRun(self):
         # this is the first run that gets triggered at invocation
@@ -199,15 +229,10 @@ class ConsoleScript(ScriptController):
     def windowWillClose_(self, note):
         NSApp().terminate_(self)
 
+    # (ScriptController's methods come first in the mro so defer to the mixin explicitly)
+
     def echo(self, output):
-        STDERR.write(ERASER)
-        for isErr, data in output:
-            stream = STDERR if isErr else STDOUT
-            stream.write(data)
-            stream.flush()
-        if self._buf:
-            STDERR.write(self._buf)
-            STDERR.flush()
+        ConsoleOutput.echo(self, output)
 
     def exportFrame(self, status, canvas=None):
         super(ConsoleScript, self).exportFrame(status, canvas)
@@ -216,33 +241,75 @@ class ConsoleScript(ScriptController):
 
     def exportStatus(self, event):
         super(ConsoleScript, self).exportStatus(event)
-
-        if event == 'cancelled':
-            msg = 'Halted after %i frames. Finishing file I/O...\n' % self.vm.session.added
-        else:
-            msg = ''
-        STDOUT.flush()
-        STDERR.write(ERASER + msg)
-        STDERR.flush()
-
+        ConsoleOutput.exportStatus(self, event)
         if event=='complete':
-            self._buf = ''
             NSApp().delegate().done()
 
     def exportProgress(self, written, total, cancelled):
         super(ConsoleScript, self).exportProgress(written, total, cancelled)
+        ConsoleOutput.exportProgress(self, written, total, cancelled)
 
-        if cancelled:
-            msg = "%i frames to go..."%(total-written)
+
+class ConsoleExport(ConsoleOutput):
+    """Window-less exporter used when the command line tool is invoked with --export
+
+    Acts as the Sandbox's delegate and drives Sandbox.export_sync (which renders the frames
+    in a plain loop rather than on the runloop). Progress is reported via stderr and a CANCEL
+    message from the front-end on stdin halts the export (after finishing the file i/o).
+
+    If the --pipe option was used, frames are streamed to the export path (or to stdout if
+    it's `-', in which case the script's own output is redirected to stderr).
+    """
+    def __init__(self, opts):
+        self.opts = opts
+        if opts.get('pipe') and opts['export']=='-':
+            self._stdout = STDERR
+
+        self.vm = Sandbox(self)
+        self.vm.path = opts['file']
+        self.vm.source = read_script(opts['file'])
+        self.vm.metadata = opts
+
+        watcher = Thread(target=self._catch_interrupts, name='plotdevice-stdin')
+        watcher.daemon = True
+        watcher.start()
+
+    def run(self):
+        """Perform the export and return the process's exit status"""
+        opts = self.opts
+
+        # exports will stall if `last` isn't an int
+        if not opts.get('last',None):
+            opts['last'] = opts.get('first', 1)
+
+        if opts.get('pipe'):
+            kind = 'stream'
+            opts['format'] = opts['pipe']
         else:
-            padding = len(str(total)) - len(str(written))
-            msg = "%s%i/%i frames written"%(' '*padding, written, total)
+            format = opts['export'].rsplit('.',1)[1]
+            kind = 'movie' if format in ('mov','gif') else 'image'
+        self.vm.export_sync(kind, opts['export'], opts)
+        return 1 if self.vm.crashed else 0
+
+    def _catch_interrupts(self):
+        while True:
+            line = sys.stdin.readline()
+            if not line:
+                return
+            if 'CANCEL' in line:
+                session = self.vm.session
+                if session:
+                    session.cancel()
 
-        dots = progress(written, total)
-        self._buf = '\r%s %s\r%s'%(dots, msg, dots[:1+dots.count('#')])
-        STDERR.write(ERASER + self._buf)
-        STDERR.flush()
+    def exportFrame(self, status, canvas=None):
+        if status.output:
+            self.echo(status.output)
 
+def read_script(path):
+    """Read in a script file's contents (honoring its `# encoding: ...` if present)"""
+    src = file(path).read()
+    enc = encoding(src) or 'utf-8'
+    return src.decode(enc)
 
 def progress(written, total, width=20):
     pct = int(ceil(width*written/float(total)))
@@ -258,8 +325,12 @@ if __name__ == '__main__':
         print "bad args"
         sys.exit(1)
 
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if mode=='headless':
+        # render & write the export without creating an NSApplication or starting the runloop
+        sys.exit(ConsoleExport(opts).run())
+
     app = ScriptApp.sharedApplicationForMode_(mode)
     delegate = ScriptAppDelegate.alloc().initWithOpts_forMode_(opts, mode)
     app.setDelegate_(delegate)
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
     AppHelper.runEventLoop(installInterrupt=False)
@@ -7,7 +7,7 @@ from PyObjCTools import AppHelper
 from Foundation import *
 from AppKit import *
 from ..run import stacktrace, coredump, uncoded, encoding
-from ..lib.io import MovieExportSession, ImageExportSession
+from ..lib.io import MovieExportSession, ImageExportSession, StreamExportSession
 from plotdevice import util, context, gfx, Halted, DeviceError
 
 __all__ = ['Sandbox']
@@ -33,7 +33,7 @@ class Delegate(object):
         pass
     def exportStatus(self, status):
         pass
-    def exportProgress(self, written, total):
+    def exportProgress(self, written, total, cancelled):
         pass
 
 class Sandbox(object):
@@ -277,16 +277,49 @@ class Sandbox(object):
         """Export graphics and animations to image and movie files.
 
         args:
-            kind - 'image' or 'movie'
-            fname - path to outputfile
+            kind - 'image', 'movie', or 'stream'
+            fname - path to outputfile (or '-' to stream frames to stdout)
             opts - dictionary with required keys:
                      first, last, format
                    for a movie export also include:
                      bitrate, fps, loop
                    and for an image sequence:
                      cmyk, single
+                   a stream's format can be rgba, y4m, or png
         """
+        if self._exportBegin(kind, fname, opts):
+            # start looping through frames, calling draw() and adding the canvas
+            # to the export-session on each iteration
+            self._exportFrame()
 
+    def export_sync(self, kind, fname, opts):
+        """Export graphics and animations without relying on a runloop.
+
+        Takes the same arguments as export() but draws the frames in a plain loop
+        (with the encoding and file i/o handled by background threads) and only
+        returns once the output file has been completely written. The delegate's
+        export* callbacks are invoked from the calling thread.
+
+        Returns True if every frame was exported, False if the script failed or
+        the session was cancelled.
+        """
+        if not self._exportBegin(kind, fname, dict(opts, sync=True)):
+            return False
+
+        session = self.session
+        try:
+            while session.next():
+                with util.autorelease():
+                    self._exportStep(session)
+        except:
+            # stop the pipeline's threads (and finish off the file) before letting the error through
+            session.cancel()
+            raise
+        finally:
+            self._exportEnd(session)
+        return not session.cancelled
+
+    def _exportBegin(self, kind, fname, opts):
         # pull off the file extension and use that as the format
         opts.setdefault('format', fname.lower().rsplit('.',1)[-1])
 
@@ -297,52 +330,56 @@ class Sandbox(object):
         firstpass = self.run(cmyk=opts.get('cmyk',False))
         self.delegate.exportFrame(firstpass, canvas=None)
         if not firstpass.ok:
-            return
+            return False
 
         # call the script's setup() routine and pass the output along to the delegate
         if self.animated:
             setup = self.run("setup")
             self.delegate.exportFrame(setup)
             if not setup.ok:
-                return
+                return False
 
         # set up an export manager and attach the delegate's callbacks
-        ExportSession = ImageExportSession if kind=='image' else MovieExportSession
-        self.session = ExportSession(fname, **opts)
-        self.session.on(progress=self.delegate.exportProgress,
-                        status=self.delegate.exportStatus,
-                        complete=self._exportComplete)
-
-        # start looping through frames, calling draw() and adding the canvas
-        # to the export-session on each iteration
-        self._exportFrame()
+        ExportSession = dict(image=ImageExportSession, movie=MovieExportSession, stream=StreamExportSession)[kind]
+        self.session = session = ExportSession(fname, **opts)
+        session.on(progress=self.delegate.exportProgress,
+                   status=self.delegate.exportStatus,
+                   complete=self._exportComplete)
+        return session.running
 
     def _exportFrame(self):
-        if self.session.next():
-            # step to the proper FRAME value
-            self._meta.next = self.session.next()
+        session = self.session
+        if session and session.next():
+            self._exportStep(session)
 
-            # run the draw() function if it exists (or the whole top-level if not)
-            result = self.run(method="draw" if self.animated else None)
+            # give the runloop a chance to collect events between frames
+            AppHelper.callLater(0.001, self._exportFrame)
+        elif session:
+            self._exportEnd(session)
 
-            # let the delegate draw to the screen
-            self.delegate.exportFrame(result, self.canvas)
+    def _exportStep(self, session):
+        # step to the proper FRAME value
+        self._meta.next = session.next()
 
-            # pass the frame content to the file-writer
-            if result.ok:
-                self.session.add(self.canvas)
+        # run the draw() function if it exists (or the whole top-level if not)
+        result = self.run(method="draw" if self.animated else None)
 
-            # know when to fold 'em
-            if result.ok in (False, 'HALTED'):
-                self.session.cancel()
+        # let the delegate draw to the screen
+        self.delegate.exportFrame(result, self.canvas)
 
-            # give the runloop a chance to collect events between frames
-            AppHelper.callLater(0.001, self._exportFrame)
-        else:
-            # we've drawn the final frame in the export
-            result = self.call("stop")
-            self.delegate.exportFrame(result, canvas=None)
-            self.session.done()
+        # pass the frame content to the file-writer
+        if result.ok:
+            session.add(self.canvas)
+
+        # know when to fold 'em
+        if result.ok in (False, 'HALTED'):
+            session.cancel()
+
+    def _exportEnd(self, session):
+        # we've drawn the final frame in the export
+        result = self.call("stop")
+        self.delegate.exportFrame(result, canvas=None)
+        session.done()
 
     def _exportComplete(self):
         self.session = None
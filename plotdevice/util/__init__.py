@@ -2,6 +2,7 @@ import os
 import re
 import json
 import csv
+from bisect import bisect_left, bisect_right
 from contextlib import contextmanager
 from collections import namedtuple
 from codecs import open
@@ -11,7 +12,7 @@ from Foundation import NSAutoreleasePool
 from os.path import abspath, dirname, exists, join
 from random import choice, shuffle
 from plotdevice import DeviceError, INTERNAL
-from .http import GET
+from .http import GET, fetch_all
 
 __all__ = ('grid', 'random', 'shuffled', 'choice', 'ordered', 'order', 'files', 'read', 'autotext', '_copy_attr', '_copy_attrs', 'odict', 'ddict', 'adict')
 
@@ -280,10 +281,20 @@ escapes = [('break','0C'), ('indent', '09'), ('flush', '08')]
 doctype = '<!DOCTYPE plod [ %s ]>' % "".join(['<!ENTITY %s "&#xE0%s;" >'%e for e in escapes])
 HEAD = "%s<%s>" % (doctype, INTERNAL)
 TAIL = "</%s>" % INTERNAL
+BATCH_SIZE = 64 * 1024 # bytes of xml to parse between the batches yielded by XMLParser.stream
 class XMLParser(object):
+    """Strips the markup from an xml string, recording the tag-cascade for each run of text
+
+    Once parsed, the `text` property has the plain string and `regions` maps each cascade
+    (a tuple of nested tag names) to the list of (start, length) ranges it applies to. The
+    elements themselves are added to `nodes` (an ElementIndex) with their character offsets.
+
+    Long documents can be processed piecemeal with XMLParser.stream() which parses the input
+    in batches and yields the text & regions for each one as it goes.
+    """
     _log = 0
 
-    def __init__(self, txt, offset=0):
+    def __init__(self, txt=None, offset=0, nodes=None):
         # configure the parsing machinery/callbacks
         p = expat.ParserCreate()
         p.StartElementHandler = self._enter
@@ -298,21 +309,71 @@ class XMLParser(object):
         self.stack = []
         self.cursor = offset
         self.regions = ddict(list)
-        self.nodes = ddict(list)
+        self.nodes = ElementIndex() if nodes is None else nodes
         self.body = []
 
+        # keep the most recently fed bytes around for the line-ending & error-message logic
+        self._xml = ''
+        self._fed = 0 # bytes passed to expat so far
+        self._nl = 0  # newlines passed to expat so far
+
+        # parse the input xml string all at once
+        if txt is not None:
+            self.feed(txt, final=True)
+
+    @classmethod
+    def stream(cls, txt, offset=0, nodes=None, batch=BATCH_SIZE):
+        """Parse an xml string incrementally, yielding a (text, regions) pair for each batch
+
+        The input is fed to the parser in roughly `batch`-sized pieces (split at newlines) and
+        the ranges in each batch's regions are relative to the start of its text. Elements are
+        added to the `nodes` index as they're closed.
+        """
+        parser = cls(offset=offset, nodes=nodes)
+        if isinstance(txt, unicode):
+            txt = txt.encode('utf-8')
+        pos = 0
+        while pos < len(txt):
+            brk = txt.find('\n', pos+batch)
+            end = len(txt) if brk < 0 else brk+1
+            parser.feed(txt[pos:end], final=end==len(txt))
+            pos = end
+            yield parser.drain()
+        if not txt:
+            parser.feed('', final=True)
+            yield parser.drain()
+
+    def feed(self, txt, final=False):
+        """Parse the next piece of the xml string (with `final` set for the last one)"""
         # wrap everything in a root node (and include the whitespace entities which shift
         # the tty escapes into the unicode PUA for the duration)
         if isinstance(txt, unicode):
             txt = txt.encode('utf-8')
-        self._xml = HEAD+txt+TAIL
+        if not self._fed:
+            txt = HEAD+txt
+        if final:
+            txt = txt+TAIL
+
+        # hang onto the tail of the previous piece in case a tag straddles the boundary
+        prev = self._xml[-1024:]
+        self._xml, self._base = prev+txt, self._fed-len(prev)
+        self._line = self._nl-prev.count('\n') # line number at the start of self._xml
+        self._fed += len(txt)
+        self._nl += txt.count('\n')
 
-        # parse the input xml string
         try:
-            self._expat.Parse(self._xml, True)
+            self._expat.Parse(txt, final)
         except expat.ExpatError, e:
             self._expat_error(e)
 
+    def drain(self):
+        """Return the (text, regions) parsed since the last drain and clear them"""
+        batch = self.text, dict(self.regions)
+        self.regions = ddict(list)
+        self.body = []
+        self._offset = self.cursor
+        return batch
+
     @property
     def text(self):
         # returns the processed string (with all markup removed and tty-escapes un-shifted)
@@ -322,7 +383,8 @@ class XMLParser(object):
         # correct the column and line-string for our wrapper element
         col = e.offset
         err = "\n".join(e.args)
-        line = self._xml.split("\n")[e.lineno-1]
+        lines = self._xml.split("\n")
+        line = lines[max(0, e.lineno-1-self._line)]
         if line.startswith(HEAD):
             line = line[len(HEAD):]
             col -= len(HEAD)
@@ -391,18 +453,116 @@ class XMLParser(object):
 
         # hang onto line-ending self-closed tags so they can be applied to the next '\n' in _chars
         if node.start==node.end:
-            at = self._expat.CurrentByteIndex
+            at = self._expat.CurrentByteIndex - self._base
             if self._xml[at-2:at]=='/>' and self._xml[at:at+1]=="\n":
                 node = node._replace(end=node.start+1)
                 self._crlf = node
 
-        self.nodes[name].append(node)
+        # record every element but our wrapper
+        if name != INTERNAL:
+            self.nodes.add(node)
         self.log(u'</%s>'%(name), indent=-1)
 
-        # if we've exited the root node, clean up the parsed elements
-        if name == INTERNAL:
-            del self.nodes[INTERNAL]
-            self.nodes = {tag:ordered(elts, 'start') for tag,elts in self.nodes.items()}
+class ElementIndex(object):
+    """The character ranges of the elements in a Text object's xml, grouped by tag name
+
+    Each tag's Elements are kept sorted by their start offsets (along with parallel lists of
+    the starts and of the running-maximum of the ends) so the ones overlapping a given range
+    of characters can be found by bisection rather than by scanning the entire list.
+
+    Shifting the index (as overleaf() does after deleting the previous page's characters)
+    doesn't touch the Elements themselves. The new index shares its lists with the original
+    and applies the offset as Elements are read out of it (copying the lists only if one of
+    the indices is later added to).
+    """
+    def __init__(self, elts=()):
+        self._tags = {}             # tag -> [starts, elts, maxends] (in unshifted coordinates)
+        self._delta = 0             # offset between the stored ranges and the reported ones
+        self._floor = float('-inf') # stored elements ending at or before this have been cut off
+        self._shared = False        # whether the lists must be copied before being modified
+        for elt in elts:
+            self.add(elt)
+
+    def add(self, elt):
+        if self._shared:
+            self._tags = {tag:[list(starts), list(elts), None] for tag, (starts, elts, _) in self._tags.items()}
+            self._shared = False
+
+        elt = elt._replace(start=elt.start-self._delta, end=elt.end-self._delta)
+        entry = self._tags.setdefault(elt.tag, [[], [], None])
+        starts, elts, _ = entry
+        idx = bisect_right(starts, elt.start)
+        starts.insert(idx, elt.start)
+        elts.insert(idx, elt)
+        entry[2] = None # the running-max of the ends will be recalculated on the next scan
+
+    def scan(self, tag, start=None, end=None):
+        """Yield a tag's Elements in order, optionally limiting them to those overlapping a range
+
+        Zero-length elements (e.g., self-closed tags) count as overlapping if they fall within
+        the [start, end) range.
+        """
+        entry = self._tags.get(tag)
+        if not entry:
+            return
+
+        starts, elts, maxends = entry
+        if maxends is None:
+            maxends, reach = [], float('-inf')
+            for elt in elts:
+                reach = max(reach, elt.end)
+                maxends.append(reach)
+            entry[2] = maxends
+
+        # translate the range to the stored coordinates then skip past the run of elements
+        # that all end before it begins and stop at the first one that starts after it ends
+        delta, floor = self._delta, self._floor
+        lo = start-delta if start is not None else floor
+        lo_idx = bisect_left(maxends, max(lo, floor))
+        hi_idx = bisect_left(starts, end-delta) if end is not None else len(elts)
+        for elt in elts[lo_idx:hi_idx]:
+            if elt.end <= floor:
+                continue
+            if start is not None and elt.end <= lo and elt.start < lo:
+                continue
+            yield elt._replace(start=elt.start+delta, end=elt.end+delta) if delta else elt
+
+    def get(self, tag, default=None):
+        """Return a list of a tag's Elements in order of their starting offsets"""
+        elts = list(self.scan(tag))
+        return elts if elts else default
+
+    def overlapping(self, start, end, tag=None):
+        """Return the Elements (optionally limited to a single tag) that overlap a char range"""
+        found = []
+        for name in [tag] if tag else self._tags.keys():
+            found.extend(self.scan(name, start, end))
+        return ordered(found, 'start')
+
+    def shifted(self, delta):
+        """Return a new index with the ranges offset by `delta` (dropping any that end up < 0)"""
+        index = self.copy()
+        index._delta = self._delta + delta
+        index._floor = max(self._floor, -index._delta)
+        return index
+
+    def copy(self):
+        index = ElementIndex()
+        index._tags, index._delta, index._floor = self._tags, self._delta, self._floor
+        index._shared = self._shared = True
+        return index
+
+    def keys(self):
+        return [tag for tag in self._tags if any(True for _ in self.scan(tag))]
+
+    def items(self):
+        return [(tag, self.get(tag)) for tag in self.keys()]
+
+    def __contains__(self, tag):
+        return tag in self.keys()
+
+    def __len__(self):
+        return sum(len(elts) for tag, elts in self.items())
 
 
 def csv_reader(pth, encoding, dialect=csv.excel, **kwargs):
@@ -455,10 +615,22 @@ def read(pth, format=None, encoding='utf-8', cols=None, **kwargs):
     you can call read() with cols=True in which case each row will be a dictionary
     using those names as keys. If the file doesn't define its own column names,
     you can pass a list of strings as the `cols` parameter.
+
+    If `pth` is a list of paths, a list with the contents of each file is returned
+    (with any urls among them downloaded concurrently rather than one at a time).
     """
-    if re.match(r'https?:', pth):
+    if not isinstance(pth, basestring):
+        is_url = [bool(re.match(r'https?:', p)) for p in pth]
+        responses = iter(fetch_all([p for p, url in zip(pth, is_url) if url]))
+        return [_read(p, next(responses) if url else None, format, encoding, cols, **kwargs)
+                for p, url in zip(pth, is_url)]
+    return _read(pth, None, format, encoding, cols, **kwargs)
+
+def _read(pth, fd, format, encoding, cols, **kwargs):
+    # `fd` is the response for an already-fetched url (if any)
+    if fd is None and re.match(r'https?:', pth):
         fd, _ = GET(pth)
-    else:
+    elif fd is None:
         fd = file(os.path.expanduser(pth), 'Urb')
 
     format = format.lstrip('.') if format else pth.rsplit('.',1)[-1]
@@ -0,0 +1,81 @@
+# encoding: utf-8
+"""
+disk.py
+
+Bookkeeping for the on-disk caches (decoded thumbnails, http responses, and the font index)
+
+Cache directories may be shared by several threads and processes at once, so files are
+written to a temp file and renamed into place (meaning readers never see a partial entry)
+and the size of the directory is rescanned before anything is deleted from it.
+"""
+
+import os
+from contextlib import contextmanager
+from threading import current_thread
+
+__all__ = ('atomic_write', 'unlink', 'DiskQuota')
+
+@contextmanager
+def atomic_write(path, mode='wb'):
+    """Yields a file that will be moved into place at `path` once the block completes (or
+    deleted if the block raises an exception)"""
+    tmp = '%s.%i-%i.tmp' % (path, os.getpid(), current_thread().ident)
+    try:
+        with open(tmp, mode) as f:
+            yield f
+        os.rename(tmp, path)
+    except:
+        unlink(tmp)
+        raise
+
+def unlink(path):
+    """Delete a file (if it still exists)"""
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+class DiskQuota(object):
+    """Keeps a cache directory under `capacity` bytes by deleting its least recently used entries
+
+    An entry is the set of files in `root` sharing a stem and having one of the extensions in
+    `exts` (e.g., foo.meta & foo.body). Its size is the total of its files' sizes and it was
+    last used at the latest of their mtimes (so readers should touch a file when using it).
+    Files are deleted in the order their extensions are listed in `exts`.
+    """
+    def __init__(self, root, capacity, exts):
+        self.root = root
+        self.capacity = capacity
+        self.exts = tuple(exts)
+        self.usage = None # bytes in use as of the last scan (plus any added since)
+
+    def add(self, nbytes):
+        """Account for a newly written entry (pruning the directory if it's now too large)"""
+        if self.usage is not None:
+            self.usage += nbytes
+            if self.usage <= self.capacity:
+                return
+        self.prune()
+
+    def prune(self):
+        # rescan the directory (since other processes may be sharing it) and delete the
+        # least recently used entries until we're comfortably under the limit
+        entries = {}
+        for name in os.listdir(self.root):
+            stem, ext = os.path.splitext(name)
+            if ext not in self.exts:
+                continue
+            try:
+                st = os.stat(os.path.join(self.root, name))
+            except OSError:
+                continue
+            used, size = entries.get(stem, (0, 0))
+            entries[stem] = (max(used, st.st_mtime), size + st.st_size)
+
+        self.usage = sum(size for _, size in entries.values())
+        for stem, (used, size) in sorted(entries.items(), key=lambda e: e[1][0]):
+            if self.usage <= self.capacity * 0.9:
+                break
+            for ext in self.exts:
+                unlink(os.path.join(self.root, stem+ext))
+            self.usage -= size
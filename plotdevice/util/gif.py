@@ -0,0 +1,381 @@
+# encoding: utf-8
+"""
+gif.py
+
+Animated GIF encoder operating on raw RGBA frame buffers (with numpy doing the heavy lifting).
+
+Frames are passed to GifWriter.addFrame as (h,w,4) uint8 arrays. Each frame is cropped to the
+bounding box of the pixels that differ from what's already on screen and the unchanged pixels
+within that box are encoded as transparent. The remaining colors are reduced to a per-frame (or
+global) palette using median-cut or octree quantization before being LZW-compressed.
+
+The module only depends on the standard library and numpy so it can be used on any platform.
+"""
+
+import struct
+import numpy as np
+
+__all__ = ('GifWriter', 'quantize', 'lzw_encode')
+
+ALPHA_CUTOFF = 128 # pixels with less opacity than this are treated as transparent
+
+class GifWriter(object):
+    """Writes RGBA frames to an animated gif file.
+
+    args:
+        fname - path to the output file (or a file-like object with a write method)
+        fps - frames per second
+        loop - 0 to play once, -1 to loop forever, or an integer number of repetitions
+        palette - 'local' to build a new color table for each frame or 'global' to quantize
+                  every frame to the palette of the first one
+        quantize - 'median' (median cut) or 'octree'
+        colors - the maximum number of entries in a color table (2-256)
+
+    The framesWritten(), doneWriting(), and closeFile() methods mirror the interface of
+    the cIO writers so export sessions can use the two interchangeably.
+    """
+    def __init__(self, fname, fps=30, loop=0, palette='local', quantize='median', colors=256):
+        if palette not in ('local', 'global'):
+            raise ValueError('palette must be "local" or "global" (not %r)' % palette)
+        if quantize not in ('median', 'octree'):
+            raise ValueError('quantize must be "median" or "octree" (not %r)' % quantize)
+
+        self.fps = fps
+        self.loop = loop
+        self.palette = palette
+        self.quantize = quantize
+        self.colors = max(2, min(256, colors))
+
+        self._file = open(fname, 'wb') if isinstance(fname, basestring) else fname
+        self._size = None       # canvas dimensions (set by the first frame)
+        self._global = None     # palette shared by all frames (if palette='global')
+        self._pending = None    # the most recent frame (which can't be written until we see the next)
+        self._clock = 0.0       # running total of frame durations (in hundredths of a second)
+        self._written = 0
+        self._done = False
+
+    ### cIO-style interface ###
+
+    def addFrame(self, rgba):
+        """Add an (h,w,4) uint8 array of (premultiplied) RGBA pixels to the animation"""
+        rgba = unpremultiply(np.asarray(rgba, dtype=np.uint8))
+        h, w = rgba.shape[:2]
+        if self._size is None:
+            self._size = (w, h)
+        elif self._size != (w, h):
+            raise ValueError('frame size changed from %ix%i to %ix%i' % (self._size+(w,h)))
+
+        keys = _keys(rgba)
+        delay = self._tick()
+        pending = self._pending
+
+        if pending is None:
+            # the first frame is drawn over a transparent screen
+            base = np.zeros_like(keys)
+            if self.palette == 'global':
+                opaque = keys != 0
+                self._global, _ = quantize(rgba[opaque][:, :3], self.colors-1, self.quantize)
+            self._header()
+        else:
+            # the screen after the pending frame is drawn is (by construction) that frame's pixels.
+            # if the new frame has transparent pixels that are currently opaque, the pending frame
+            # will need to be erased (disposal method 2) before this one is drawn.
+            base = pending.keys
+            if np.any((keys == 0) & (base != 0)):
+                pending.rect = (0, 0, w, h)
+                pending.disposal = 2
+                base = np.zeros_like(keys)
+
+        changed = keys != base
+        if pending is not None and not changed.any():
+            # identical frames just extend the duration of the previous one
+            pending.delay = min(pending.delay + delay, 0xffff)
+            self._written += 1
+            return
+
+        if pending is not None:
+            self._flush(pending)
+        self._pending = _Frame(rgba, keys, base, _bbox(changed, w, h), delay)
+
+    def framesWritten(self):
+        return self._written
+
+    def doneWriting(self):
+        return self._done
+
+    def closeFile(self):
+        if self._done:
+            return
+        if self._pending is not None:
+            self._flush(self._pending)
+            self._pending = None
+        if self._size is not None:
+            self._file.write(';') # trailer
+        self._file.close()
+        self._done = True
+
+    ### file structure ###
+
+    def _tick(self):
+        # round the running clock rather than each frame's delay so fractional durations
+        # (e.g., 3.33/100ths of a second at 30fps) don't accumulate error
+        start = self._clock
+        self._clock += 100.0 / self.fps
+        return int(round(self._clock)) - int(round(start))
+
+    def _header(self):
+        w, h = self._size
+        flags = 0x70 # 8 bits per primary color
+        table = ''
+        if self._global is not None:
+            bits = _depth(len(self._global)+1)
+            flags |= 0x80 | (bits-1)
+            table = _color_table(self._global, bits)
+        self._file.write('GIF89a' + struct.pack('<HHBBB', w, h, flags, 0, 0) + table)
+
+        if self.loop:
+            count = 0 if self.loop < 0 else self.loop
+            self._file.write('\x21\xff\x0bNETSCAPE2.0' + struct.pack('<BBHB', 3, 1, count, 0))
+
+    def _flush(self, frame):
+        x, y, w, h = frame.rect
+        rgba = frame.rgba[y:y+h, x:x+w]
+        keys = frame.keys[y:y+h, x:x+w]
+        base = frame.base[y:y+h, x:x+w]
+
+        # pixels that are unchanged or transparent get the transparent index, the rest are quantized
+        clear = (keys == base) | (keys == 0)
+        visible = ~clear
+        if self._global is not None:
+            palette = self._global
+            labels = _nearest(rgba[visible][:, :3], palette)
+            transparent = len(palette)
+        else:
+            limit = self.colors-1 if clear.any() else self.colors
+            palette, labels = quantize(rgba[visible][:, :3], limit, self.quantize)
+            transparent = len(palette) if clear.any() else None
+
+        indices = np.zeros((h, w), dtype=np.uint8)
+        if transparent is not None:
+            indices[clear] = transparent
+        indices[visible] = labels
+
+        # graphic control extension (disposal method, delay, and transparency)
+        packed = (frame.disposal << 2) | (transparent is not None)
+        gce = '\x21\xf9\x04' + struct.pack('<BHBB', packed, frame.delay, transparent or 0, 0)
+
+        # image descriptor (plus a local color table if we're not using the global one)
+        if self._global is not None:
+            bits = _depth(len(self._global)+1)
+            desc = '\x2c' + struct.pack('<HHHHB', x, y, w, h, 0)
+        else:
+            bits = _depth(len(palette) + (transparent is not None))
+            desc = '\x2c' + struct.pack('<HHHHB', x, y, w, h, 0x80 | (bits-1)) + _color_table(palette, bits)
+
+        self._file.write(gce + desc + lzw_encode(indices, max(2, bits)))
+        self._written += 1
+
+class _Frame(object):
+    def __init__(self, rgba, keys, base, rect, delay):
+        self.rgba = rgba        # the frame's pixels
+        self.keys = keys        # packed colors (with every transparent pixel as 0)
+        self.base = base        # packed colors of the screen the frame will be drawn onto
+        self.rect = rect        # the (x,y,w,h) region that needs to be encoded
+        self.delay = delay      # duration in 1/100ths of a second
+        self.disposal = 1       # leave in place (1) or clear to transparent (2) after display
+
+### pixel helpers ###
+
+def unpremultiply(rgba):
+    alpha = rgba[..., 3]
+    partial = (alpha > 0) & (alpha < 255)
+    if not partial.any():
+        return rgba
+    rgba = rgba.copy()
+    rgb = rgba[partial][:, :3].astype(np.uint32) * 255 // alpha[partial][:, None]
+    rgba[partial, :3] = np.minimum(rgb, 255)
+    return rgba
+
+def _keys(rgba):
+    """Pack the pixels into uint32s, mapping every transparent pixel to 0"""
+    r, g, b, a = [rgba[..., i].astype(np.uint32) for i in range(4)]
+    keys = 0xff000000 | (r << 16) | (g << 8) | b
+    keys[a < ALPHA_CUTOFF] = 0
+    return keys
+
+def _bbox(mask, w, h):
+    """The (x,y,w,h) bounds of the true values in `mask` (or a single pixel if there are none)"""
+    rows, cols = np.any(mask, axis=1), np.any(mask, axis=0)
+    if not rows.any():
+        return (0, 0, 1, 1)
+    y0, y1 = np.argmax(rows), h - np.argmax(rows[::-1])
+    x0, x1 = np.argmax(cols), w - np.argmax(cols[::-1])
+    return (int(x0), int(y0), int(x1-x0), int(y1-y0))
+
+def _depth(n):
+    """The number of bits needed to index a color table of n entries (1-8)"""
+    return max(1, int(n-1).bit_length())
+
+def _color_table(palette, bits):
+    table = np.zeros((1 << bits, 3), dtype=np.uint8)
+    table[:len(palette)] = palette
+    return table.tostring()
+
+### color quantization ###
+
+def quantize(rgb, colors=256, method='median'):
+    """Reduce an (n,3) array of uint8 colors to a palette of at most `colors` entries
+
+    Returns a (palette, labels) tuple where palette is a (k,3) uint8 array and labels is
+    an (n,) array of the palette index assigned to each of the input colors.
+    """
+    rgb = np.asarray(rgb, dtype=np.uint8).reshape(-1, 3)
+    if not len(rgb):
+        return np.zeros((1,3), dtype=np.uint8), np.zeros(0, dtype=np.uint8)
+
+    packed = (rgb[:,0].astype(np.uint32) << 16) | (rgb[:,1].astype(np.uint32) << 8) | rgb[:,2]
+    uniq, inverse, counts = np.unique(packed, return_inverse=True, return_counts=True)
+    ucolors = np.column_stack([(uniq >> 16) & 0xff, (uniq >> 8) & 0xff, uniq & 0xff]).astype(np.int32)
+
+    if len(uniq) <= colors:
+        # no need to lose any information
+        return ucolors.astype(np.uint8), inverse.astype(np.uint8)
+
+    if method == 'octree' and colors >= 8:
+        groups = _octree(ucolors, counts, colors)
+    else:
+        groups = _median_cut(ucolors, counts, colors)
+
+    # each palette entry is the population-weighted average of the colors in its group
+    weights = np.bincount(groups, weights=counts)
+    palette = np.column_stack([np.bincount(groups, weights=counts*ucolors[:,i]) / weights for i in range(3)])
+    return np.round(palette).astype(np.uint8), groups[inverse].astype(np.uint8)
+
+def _median_cut(ucolors, counts, n):
+    """Group the unique colors by recursively splitting the most significant box at its median"""
+    def box(idx):
+        colors = ucolors[idx]
+        spread = colors.max(axis=0) - colors.min(axis=0)
+        axis = int(np.argmax(spread))
+        score = spread[axis] * counts[idx].sum() if len(idx) > 1 else -1
+        return (score, axis, idx)
+
+    boxes = [box(np.arange(len(ucolors)))]
+    while len(boxes) < n:
+        i = max(range(len(boxes)), key=lambda i:boxes[i][0])
+        score, axis, idx = boxes[i]
+        if score <= 0:
+            break # nothing left to split
+
+        # sort along the widest channel and split at the population-weighted median
+        order = idx[np.argsort(ucolors[idx, axis], kind='mergesort')]
+        population = np.cumsum(counts[order])
+        cut = int(np.searchsorted(population, population[-1] / 2.0)) + 1
+        cut = min(max(cut, 1), len(order)-1)
+        boxes[i:i+1] = [box(order[:cut]), box(order[cut:])]
+
+    groups = np.zeros(len(ucolors), dtype=np.intp)
+    for label, (score, axis, idx) in enumerate(boxes):
+        groups[idx] = label
+    return groups
+
+def _octree(ucolors, counts, n):
+    """Group the unique colors by the deepest octree level with no more than n nodes, then
+    subdivide the most populous of those nodes as long as the palette still has room"""
+    r, g, b = [ucolors[:, i] for i in range(3)]
+    def nodes(depth):
+        shift = 8 - depth
+        ids = ((r >> shift) << (2*depth)) | ((g >> shift) << depth) | (b >> shift)
+        return np.unique(ids, return_inverse=True)[1]
+
+    depth = 7
+    coarse = nodes(depth)
+    while coarse.max()+1 > n:
+        depth -= 1
+        coarse = nodes(depth)
+    if depth == 7:
+        return coarse
+
+    fine = nodes(depth+1)
+    n_coarse, n_fine = coarse.max()+1, fine.max()+1
+    parent = np.zeros(n_fine, dtype=np.intp)
+    parent[fine] = coarse
+    children = np.bincount(parent, minlength=n_coarse)
+    population = np.bincount(coarse, weights=counts, minlength=n_coarse)
+
+    order = np.argsort(-population, kind='mergesort')
+    extra = np.cumsum(children[order] - 1)
+    split = np.zeros(n_coarse, dtype=bool)
+    split[order[extra <= n - n_coarse]] = True
+
+    ids = np.where(split[coarse], n_coarse + fine, coarse)
+    return np.unique(ids, return_inverse=True)[1]
+
+def _nearest(rgb, palette, chunk=4096):
+    """Map each color to the index of the closest palette entry"""
+    rgb = np.asarray(rgb, dtype=np.uint8).reshape(-1, 3)
+    packed = (rgb[:,0].astype(np.uint32) << 16) | (rgb[:,1].astype(np.uint32) << 8) | rgb[:,2]
+    uniq, inverse = np.unique(packed, return_inverse=True)
+    ucolors = np.column_stack([(uniq >> 16) & 0xff, (uniq >> 8) & 0xff, uniq & 0xff]).astype(np.int32)
+    pal = np.asarray(palette, dtype=np.int32)
+
+    labels = np.empty(len(uniq), dtype=np.uint8)
+    for i in range(0, len(uniq), chunk):
+        dist = ((ucolors[i:i+chunk, None, :] - pal[None, :, :])**2).sum(axis=2)
+        labels[i:i+chunk] = np.argmin(dist, axis=1)
+    return labels[inverse]
+
+### compression ###
+
+def lzw_encode(indices, min_code_size):
+    """Compress an array of palette indices and return the bytes of a GIF image-data block"""
+    clear = 1 << min_code_size
+    eoi = clear + 1
+    pixels = np.asarray(indices, dtype=np.uint8).ravel().tolist()
+
+    # walk the pixels building up the code table. this is the one inherently serial part
+    # so it's kept as lean as possible (int keys, bound methods, no attribute lookups)
+    codes, widths = [clear], [min_code_size+1]
+    emit, emit_width = codes.append, widths.append
+    table = {}
+    lookup = table.get
+    width, next_code = min_code_size+1, eoi+1
+    prefix = pixels[0]
+    for k in pixels[1:]:
+        code = lookup((prefix << 8) | k)
+        if code is not None:
+            prefix = code
+            continue
+
+        emit(prefix)
+        emit_width(width)
+        if next_code < 4095:
+            table[(prefix << 8) | k] = next_code
+            next_code += 1
+            if next_code > (1 << width):
+                width += 1
+        else:
+            # the table is full: start over
+            emit(clear)
+            emit_width(width)
+            table.clear()
+            width, next_code = min_code_size+1, eoi+1
+        prefix = k
+    codes.extend([prefix, eoi])
+    widths.extend([width, width])
+
+    # pack the variable-width codes into a little-endian bitstream
+    codes = np.array(codes, dtype=np.uint32)
+    widths = np.array(widths, dtype=np.uint8)
+    bits = (codes[:, None] >> np.arange(12, dtype=np.uint32)) & 1
+    stream = bits[np.arange(12) < widths[:, None]].astype(np.uint8)
+    stream = np.concatenate([stream, np.zeros(-len(stream) % 8, dtype=np.uint8)])
+    data = np.dot(stream.reshape(-1, 8), 1 << np.arange(8)).astype(np.uint8).tostring()
+
+    # split into length-prefixed sub-blocks of up to 255 bytes
+    blocks = [chr(min_code_size)]
+    for i in xrange(0, len(data), 255):
+        chunk = data[i:i+255]
+        blocks.append(chr(len(chunk)) + chunk)
+    blocks.append('\x00')
+    return ''.join(blocks)
@@ -1,274 +1,439 @@
 # encoding: utf-8
-# author: dbr/Ben
-# project: tvdb_api
-# repository: http://github.com/dbr/tvdb_api
-# license: unlicense (http://unlicense.org/)
-
-"""
-urllib2 caching handler
-Modified from http://code.activestate.com/recipes/491261/
 """
-from __future__ import with_statement
+http.py
 
-__author__ = "dbr/Ben"
-__version__ = "1.9"
+Caching HTTP client used when read() or Image() are passed a url.
+
+Responses are kept in an on-disk cache that is bounded by size (with the least recently used
+entries being pruned) and are revalidated with conditional requests (If-None-Match and
+If-Modified-Since) once their freshness lifetime has passed. Connections are kept alive and
+reused for later requests to the same host, and cached bodies are streamed from disk rather
+than being read into memory up front.
+"""
 
 import os
+import sys
 import time
+import json
 import errno
+import socket
 import httplib
 import urllib2
-import StringIO
-from hashlib import md5
-from threading import RLock
-from Foundation import NSDateFormatter, NSLocale, NSTimeZone, NSDate
-
-_date_parser = NSDateFormatter.alloc().init()
-_date_parser.setLocale_(NSLocale.alloc().initWithLocaleIdentifier_("en_US_POSIX"))
-_date_parser.setDateFormat_("EEE',' dd' 'MMM' 'yyyy HH':'mm':'ss zzz")
-_date_parser.setTimeZone_(NSTimeZone.timeZoneForSecondsFromGMT_(0))
-
+import urlparse
+from hashlib import sha1
+from StringIO import StringIO
+from email.utils import parsedate_tz, mktime_tz
+from Queue import Queue
+from threading import Lock, Event, Thread, BoundedSemaphore
+from .disk import atomic_write, unlink, DiskQuota
+
+__all__ = ('GET', 'fetch', 'fetch_all', 'fetch_async', 'Fetcher', 'HTTPCache', 'ConnectionPool', 'Response')
+
+CACHE_DIR = '/tmp/plod'
+CACHE_CAPACITY = 256 * 1024 * 1024 # bytes of response bodies to keep on disk
+MAX_AGE = 21600                    # freshness lifetime for responses that don't specify one
+MAX_REDIRECTS = 5
+CHUNK_SIZE = 64 * 1024
+MAX_WORKERS = 8                    # default number of concurrent fetches
 
 def GET(url):
-    """Return the contents of a url (from cache if possible)"""
-    opener = urllib2.build_opener(CacheHandler("/tmp/plod"))
-    response = opener.open(url)
-
-    last_mod = _date_parser.dateFromString_(response.headers.get('Last-Modified'))
-    if not last_mod:
-        last_mod = NSDate.date()
-    return response, last_mod.timeIntervalSince1970()
+    """Return the contents of a url (from cache if possible) as a (response, mtime) tuple
 
-cache_lock = RLock()
+    The mtime is the server's Last-Modified date (or the time the response was cached
+    if the server didn't provide one) in seconds since the epoch.
+    """
+    resp = fetch(url)
+    return resp, resp.mtime
 
-def locked_function(origfunc):
-    """Decorator to execute function under lock"""
-    def wrapped(*args, **kwargs):
-        cache_lock.acquire()
-        try:
-            return origfunc(*args, **kwargs)
-        finally:
-            cache_lock.release()
-    return wrapped
+def fetch(url, cache=None, pool=None):
+    """Return a file-like Response for a url, consulting (and updating) the cache first
 
-def calculate_cache_path(cache_location, url):
-    """Checks if [cache_location]/[hash_of_url].headers and .body exist
+    Fresh cache entries are returned without touching the network, stale ones are revalidated
+    with a conditional request, and everything else is downloaded and stored. The `cache` and
+    `pool` args default to module-wide instances (with the cache living in /tmp/plod).
     """
-    thumb = md5(url).hexdigest()
-    header = os.path.join(cache_location, thumb + ".headers")
-    body = os.path.join(cache_location, thumb + ".body")
-    return header, body
-
-def check_cache_time(path, max_age):
-    """Checks if a file has been created/modified in the [last max_age] seconds.
-    False means the file is too old (or doesn't exist), True means it is
-    up-to-date and valid"""
-    if not os.path.isfile(path):
-        return False
-    cache_modified_time = os.stat(path).st_mtime
-    time_now = time.time()
-    if cache_modified_time < time_now - max_age:
-        # Cache is old
-        return False
+    cache = cache or _shared('cache', lambda: HTTPCache())
+    pool = pool or _shared('pool', lambda: ConnectionPool())
+
+    meta = cache.lookup(url)
+    if meta and cache.fresh(meta):
+        return cache.open(meta)
+
+    headers = {'Accept-Encoding':'identity'}
+    if meta:
+        etag, last_mod = meta['etag'], meta['last_modified']
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_mod:
+            headers['If-Modified-Since'] = last_mod
+
+    location = url
+    for i in range(MAX_REDIRECTS+1):
+        conn, resp = pool.request('GET', location, headers)
+        if resp.status not in (301, 302, 303, 307, 308) or not resp.getheader('Location'):
+            break
+        # follow redirects (though the validators only apply to the original url)
+        resp.read()
+        pool.release(conn, resp)
+        location = urlparse.urljoin(location, resp.getheader('Location'))
+        headers.pop('If-None-Match', None)
+        headers.pop('If-Modified-Since', None)
     else:
-        return True
-
-@locked_function
-def exists_in_cache(cache_location, url, max_age):
-    """Returns if header AND body cache file exist (and are up-to-date)"""
-    hpath, bpath = calculate_cache_path(cache_location, url)
-    if os.path.exists(hpath) and os.path.exists(bpath):
-        return(
-            check_cache_time(hpath, max_age)
-            and check_cache_time(bpath, max_age)
-        )
-    else:
-        # File does not exist
-        return False
+        # (the last redirect's connection has already been released)
+        toomany = 'Too many redirects while fetching %s' % url
+        raise urllib2.HTTPError(url, resp.status, toomany, resp.msg, None)
 
-@locked_function
-def store_in_cache(cache_location, url, response):
-    """Tries to store response in cache."""
-    hpath, bpath = calculate_cache_path(cache_location, url)
     try:
-        outf = open(hpath, "wb")
-        headers = str(response.info())
-        outf.write(headers)
-        outf.close()
-
-        outf = open(bpath, "wb")
-        outf.write(response.read())
-        outf.close()
-    except IOError:
-        return True
-    else:
-        return False
-
-@locked_function
-def delete_from_cache(cache_location, url):
-    """Deletes a response in cache."""
-    hpath, bpath = calculate_cache_path(cache_location, url)
+        if resp.status == 304 and meta:
+            # the cached copy is still valid so just update its headers
+            resp.read()
+            result = cache.open(cache.refresh(meta, resp.msg))
+        elif not 200 <= resp.status < 300:
+            body = resp.read()
+            raise urllib2.HTTPError(url, resp.status, resp.reason, resp.msg, StringIO(body))
+        elif cache.storable(resp.msg):
+            result = cache.open(cache.store(url, resp))
+        else:
+            result = Response(url, StringIO(resp.read()), str(resp.msg), time.time())
+    except:
+        pool.discard(conn) # don't return a connection with a half-read response to the pool
+        raise
+    pool.release(conn, resp)
+    return result
+
+def fetch_all(urls, max_workers=MAX_WORKERS):
+    """Fetch a list of urls concurrently and return their Responses (in the same order)
+
+    The requests are spread across `max_workers` threads (while still limiting the number of
+    simultaneous connections to any single host) and the responses are added to the same
+    cache that GET uses. If any of the fetches fail, the first error is re-raised once all of
+    them have finished.
+    """
+    fetcher = Fetcher(max_workers)
     try:
-        if os.path.exists(hpath):
-            os.remove(hpath)
-        if os.path.exists(bpath):
-            os.remove(bpath)
-    except IOError:
-        return True
-    else:
-        return False
+        futures = [fetcher.submit(url) for url in urls]
+        for f in futures:
+            f.wait()
+        return [f.result() for f in futures]
+    finally:
+        fetcher.shutdown()
+
+def fetch_async(url):
+    """Start fetching a url in the background and return a Future for its Response"""
+    return _shared('fetcher', lambda: Fetcher()).submit(url)
+
+_globals, _globals_lock = {}, Lock()
+def _shared(name, factory):
+    # lazily create the module-wide cache & pool
+    with _globals_lock:
+        if name not in _globals:
+            _globals[name] = factory()
+        return _globals[name]
+
+### background fetching ###
+
+class Future(object):
+    """The eventual result of a Fetcher job"""
+    def __init__(self):
+        self._done = Event()
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+
+    def result(self):
+        """Block until the job is finished then return its value (or re-raise its exception)"""
+        self._done.wait()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def _finish(self, result=None, exc_info=None):
+        self._result, self._exc_info = result, exc_info
+        self._done.set()
+
+class Fetcher(object):
+    """A pool of threads that fetch urls (through a shared cache & ConnectionPool)"""
+    def __init__(self, max_workers=MAX_WORKERS, cache=None, pool=None):
+        self.max_workers = max_workers
+        self.cache = cache
+        self.pool = pool
+        self._jobs = Queue()
+        self._threads = []
+
+    def submit(self, url):
+        """Queue a url to be fetched and return a Future for its Response"""
+        future = Future()
+        self._jobs.put((url, future))
+        if len(self._threads) < min(self.max_workers, self._jobs.qsize()+len(self._threads)):
+            worker = Thread(target=self._work, name='plotdevice-fetch')
+            worker.daemon = True
+            worker.start()
+            self._threads.append(worker)
+        return future
+
+    def shutdown(self):
+        for t in self._threads:
+            self._jobs.put(None)
+        self._threads = []
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            url, future = job
+            try:
+                future._finish(fetch(url, self.cache, self.pool))
+            except Exception:
+                future._finish(exc_info=sys.exc_info())
 
-class CacheHandler(urllib2.BaseHandler):
-    """Stores responses in a persistant on-disk cache.
+### keep-alive connections ###
 
-    If a subsequent GET request is made for the same URL, the stored
-    response is returned, saving time, resources and bandwidth
+class ConnectionPool(object):
+    """Holds on to idle HTTP/1.1 connections so they can be reused (keyed by scheme, host & port)
+
+    No more than `per_host` connections will be open to a given host at once (with additional
+    requests blocking until one is released) and the idle ones are kept around for reuse.
+    Connections are safe to use from multiple threads since each request checks one out for
+    its exclusive use.
     """
-    @locked_function
-    def __init__(self, cache_location, max_age = 21600):
-        """The location of the cache directory"""
-        self.max_age = max_age
-        self.cache_location = cache_location
-        if not os.path.exists(self.cache_location):
+    def __init__(self, per_host=6, timeout=30):
+        self.per_host = per_host
+        self.timeout = timeout
+        self._idle = {}
+        self._slots = {}
+        self._lock = Lock()
+
+    def request(self, method, url, headers={}):
+        """Send a request and return the (connection, response) once the headers arrive
+
+        The caller must read the response body and then pass both values to release() (or
+        pass the connection to discard() if something went wrong).
+        """
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+
+        with self._lock:
+            slots = self._slots.setdefault(key, BoundedSemaphore(self.per_host))
+        slots.acquire()
+        while True:
             try:
-                os.mkdir(self.cache_location)
-            except OSError, e:
-                if e.errno == errno.EEXIST and os.path.isdir(self.cache_location):
-                    # File exists, and it's a directory,
-                    # another process beat us to creating this dir, that's OK.
-                    pass
-                else:
-                    # Our target dir is already a file, or different error,
-                    # relay the error!
+                conn, reused = self._checkout(key)
+                conn.request(method, path, headers=headers)
+                return conn, conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    slots.release()
                     raise
-
-    def default_open(self, request):
-        """Handles GET requests, if the response is cached it returns it
-        """
-        if request.get_method() is not "GET":
-            return None # let the next handler try to handle the request
-
-        if exists_in_cache(
-            self.cache_location, request.get_full_url(), self.max_age
-        ):
-            return CachedResponse(
-                self.cache_location,
-                request.get_full_url(),
-                set_cache_header = True
-            )
-        else:
+                # an idle connection may have been dropped by the server so try a fresh one
+            except:
+                slots.release()
+                raise
+
+    def release(self, conn, resp):
+        """Return a connection to the pool (or close it if the server won't keep it alive)"""
+        if resp.will_close:
+            return self.discard(conn)
+        with self._lock:
+            self._idle.setdefault(conn._pool_key, []).append(conn)
+            self._slots[conn._pool_key].release()
+
+    def discard(self, conn):
+        """Close a connection rather than returning it to the pool"""
+        conn.close()
+        with self._lock:
+            self._slots[conn._pool_key].release()
+
+    def close(self):
+        with self._lock:
+            conns = [c for idle in self._idle.values() for c in idle]
+            self._idle.clear()
+        for conn in conns:
+            conn.close()
+
+    def _checkout(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+
+        scheme, host, port = key
+        if scheme not in ('http', 'https'):
+            badscheme = 'Only http and https urls are supported (not %r)' % scheme
+            raise ValueError(badscheme)
+        Connection = httplib.HTTPSConnection if scheme=='https' else httplib.HTTPConnection
+        conn = Connection(host, port, timeout=self.timeout)
+        conn._pool_key = key
+        return conn, False
+
+### on-disk response cache ###
+
+class HTTPCache(object):
+    """A size-bounded directory of cached responses
+
+    Each entry consists of a .body file and a .meta file (a json dict with the url, headers,
+    validators, and storage time). Both are written to temp files and renamed into place so
+    other threads and processes sharing the directory never see partial entries. Reading an
+    entry updates the .meta file's mtime and the least recently read entries are deleted once
+    the files total more than `capacity` bytes.
+    """
+    def __init__(self, root=CACHE_DIR, capacity=CACHE_CAPACITY, max_age=MAX_AGE):
+        self.root = root
+        self.capacity = capacity
+        self.max_age = max_age
+        self._quota = DiskQuota(root, capacity, ('.meta', '.body'))
+        try:
+            os.makedirs(root)
+        except OSError, e:
+            # it's fine if another process beat us to creating the dir
+            if not (e.errno == errno.EEXIST and os.path.isdir(root)):
+                raise
+
+    def lookup(self, url):
+        """Return the metadata dict for a cached url (or None if it's missing or incomplete)"""
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta['url'] != url or os.path.getsize(body_path) != meta['length']:
+                return None
+            os.utime(meta_path, None) # mark as recently used
+        except (IOError, OSError, ValueError, KeyError):
             return None
-
-    def http_response(self, request, response):
-        """Gets a HTTP response, if it was a GET request and the status code
-        starts with 2 (200 OK etc) it caches it and returns a CachedResponse
-        """
-        if (request.get_method() == "GET"
-            and str(response.code).startswith("2")
-        ):
-            if 'x-local-cache' not in response.info():
-                # Response is not cached
-                set_cache_header = store_in_cache(
-                    self.cache_location,
-                    request.get_full_url(),
-                    response
-                )
-            else:
-                set_cache_header = True
-
-            return CachedResponse(
-                self.cache_location,
-                request.get_full_url(),
-                set_cache_header = set_cache_header
-            )
-        else:
-            return response
-
-    def https_response(self, request, response):
-        return self.http_response(request,response)
-
-class CachedResponse(StringIO.StringIO):
-    """An urllib2.response-like object for cached responses.
-
-    To determine if a response is cached or coming directly from
-    the network, check the x-local-cache header rather than the object type.
+        return meta
+
+    def fresh(self, meta):
+        """Whether a cached response can be used without revalidating it"""
+        return time.time() - meta['stored'] < meta['lifetime']
+
+    def storable(self, headers):
+        return 'no-store' not in _cache_control(headers)
+
+    def open(self, meta):
+        """Return a Response that streams the cached body from disk"""
+        _, body_path = self._paths(meta['url'])
+        return Response(meta['url'], open(body_path, 'rb'), meta['headers'], meta['mtime'], cached=True)
+
+    def store(self, url, resp):
+        """Save an httplib response to disk (streaming the body) and return its metadata"""
+        meta_path, body_path = self._paths(url)
+        length = 0
+        with atomic_write(body_path) as f:
+            while True:
+                chunk = resp.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+                length += len(chunk)
+
+        meta = dict(url=url, length=length)
+        self._describe(meta, str(resp.msg))
+        self._save(meta_path, meta)
+        self._quota.add(length)
+        return meta
+
+    def refresh(self, meta, headers):
+        """Merge the headers from a 304 response into a cached entry and restart its clock"""
+        msg = httplib.HTTPMessage(StringIO(meta['headers']))
+        for k in headers.keys():
+            if k.lower() not in ('content-length', 'transfer-encoding', 'connection'):
+                msg[k] = headers[k]
+        meta = dict(meta)
+        self._describe(meta, str(msg))
+        self._save(self._paths(meta['url'])[0], meta)
+        return meta
+
+    def clear(self):
+        for name in os.listdir(self.root):
+            if name.endswith(('.meta', '.body')):
+                unlink(os.path.join(self.root, name))
+        self._quota.usage = 0
+
+    def _describe(self, meta, header_text):
+        # pull the validators & expiration info out of the headers
+        msg = httplib.HTTPMessage(StringIO(header_text))
+        now = time.time()
+        last_mod = msg.getheader('Last-Modified')
+        meta.update(headers=header_text, stored=now,
+                    etag=msg.getheader('ETag'), last_modified=last_mod,
+                    mtime=_parse_date(last_mod) or meta.get('mtime') or now,
+                    lifetime=_lifetime(msg, self.max_age))
+
+    def _paths(self, url):
+        digest = sha1(url).hexdigest()
+        return [os.path.join(self.root, digest+ext) for ext in ('.meta', '.body')]
+
+    def _save(self, meta_path, meta):
+        with atomic_write(meta_path, 'w') as f:
+            json.dump(meta, f)
+
+class Response(object):
+    """A file-like object with the body and headers of an http response
+
+    The `headers` attr (also available via info()) is an httplib.HTTPMessage, `mtime` is the
+    Last-Modified date in seconds since the epoch, and `cached` is True if the body is being
+    read from the on-disk cache.
     """
+    def __init__(self, url, fp, header_text, mtime, cached=False):
+        self.url = url
+        self.code = 200
+        self.msg = 'OK'
+        self.headers = httplib.HTTPMessage(StringIO(header_text))
+        self.mtime = mtime
+        self.cached = cached
+        self._fp = fp
 
-    @locked_function
-    def __init__(self, cache_location, url, set_cache_header=True):
-        self.cache_location = cache_location
-        hpath, bpath = calculate_cache_path(cache_location, url)
+    def read(self, size=-1):
+        return self._fp.read(size)
 
-        StringIO.StringIO.__init__(self, file(bpath, "rb").read())
+    def readline(self, size=-1):
+        return self._fp.readline(size)
 
-        self.url     = url
-        self.code    = 200
-        self.msg     = "OK"
-        headerbuf = file(hpath, "rb").read()
-        if set_cache_header:
-            headerbuf += "x-local-cache: %s\r\n" % (bpath)
-        self.headers = httplib.HTTPMessage(StringIO.StringIO(headerbuf))
+    def __iter__(self):
+        return iter(self._fp)
+
+    def close(self):
+        self._fp.close()
 
     def info(self):
-        """Returns headers
-        """
         return self.headers
 
     def geturl(self):
-        """Returns original URL
-        """
         return self.url
 
-    @locked_function
-    def recache(self):
-        new_request = urllib2.urlopen(self.url)
-        set_cache_header = store_in_cache(
-            self.cache_location,
-            new_request.url,
-            new_request
-        )
-        CachedResponse.__init__(self, self.cache_location, self.url, True)
-
-    @locked_function
-    def delete_cache(self):
-        delete_from_cache(
-            self.cache_location,
-            self.url
-        )
-
-if __name__ == "__main__":
-    def main():
-        """Quick test/example of CacheHandler"""
-        url = "http://plotdevice.io"
-        opener = urllib2.build_opener(CacheHandler("/tmp/plod"))
-        response = opener.open(url)
-        print response.headers
-        print "Response:", len(response.read()), 'bytes'
-
-        # response.recache()
-        response = opener.open(url)
-        print response.headers
-        print "After recache:", len(response.read()), 'bytes'
-
-        # Test usage in threads
-        from threading import Thread
-        import sys
-        class CacheThreadTest(Thread):
-            lastdata = None
-            def run(self):
-                req = opener.open(url)
-                newdata = req.read()
-                sys.stdout.write(".")
-                sys.stdout.flush()
-                if self.lastdata is None:
-                    self.lastdata = newdata
-                assert self.lastdata == newdata, "Data was not consistent, uhoh"
-                # req.recache()
-        threads = [CacheThreadTest() for x in range(50)]
-        print "Starting threads",
-        [t.start() for t in threads]
-        print "..done"
-        print "Joining threads",
-        [t.join() for t in threads]
-        print "..done"
-    main()
\ No newline at end of file
+### header parsing ###
+
+def _parse_date(value):
+    parsed = parsedate_tz(value) if value else None
+    return float(mktime_tz(parsed)) if parsed else None
+
+def _cache_control(msg):
+    directives = {}
+    for part in (msg.getheader('Cache-Control') or '').split(','):
+        name, _, val = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = val.strip('"')
+    return directives
+
+def _lifetime(msg, default):
+    """How many seconds a response can be used before it needs to be revalidated"""
+    cc = _cache_control(msg)
+    if 'no-cache' in cc or 'must-revalidate' in cc and 'max-age' not in cc:
+        return 0
+    if 'max-age' in cc:
+        try:
+            return int(cc['max-age'])
+        except ValueError:
+            return 0
+    expires = _parse_date(msg.getheader('Expires'))
+    if expires is not None:
+        date = _parse_date(msg.getheader('Date')) or time.time()
+        return max(0, expires - date)
+    return default
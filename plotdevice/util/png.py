@@ -0,0 +1,136 @@
+# encoding: utf-8
+"""
+png.py
+
+PNG encoder operating on raw RGBA pixel buffers (using numpy for filtering & zlib for compression).
+
+The scanline filter for each row is chosen with the minimum-sum-of-absolute-differences heuristic
+(or can be fixed to one of the five standard filters) and the filtered data can be deflated in
+parallel by splitting it into independently-compressed runs of rows (in the manner of pigz).
+"""
+
+import zlib
+import atexit
+import struct
+import numpy as np
+from threading import Lock
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from .gif import unpremultiply
+
+__all__ = ('encode', 'FILTERS')
+
+FILTERS = ('none', 'sub', 'up', 'average', 'paeth')
+CHUNK_SIZE = 1<<18 # minimum number of bytes to hand to each compression thread
+
+def encode(pixels, level=6, filter='adaptive', threads=1, premultiplied=True, text=None):
+    """Return the contents of a PNG file containing an (h,w,4) or (h,w,3) uint8 array of pixels
+
+    args:
+        level - zlib compression level (0-9)
+        filter - 'adaptive' to pick the best filter for each row or one of the FILTERS to
+                 use the same filter for all of them
+        threads - if greater than 1, compress runs of rows in parallel using the module's
+                  shared pool of cpu_count() threads
+        premultiplied - whether the color channels of an RGBA buffer have been multiplied by
+                        their alpha values (as is the case for bitmaps drawn by Quartz)
+        text - optional dict of latin-1 keyword/value pairs to be stored in tEXt chunks
+    """
+    pixels = np.asarray(pixels, dtype=np.uint8)
+    h, w, channels = pixels.shape
+    if channels not in (3, 4):
+        badshape = 'Expected an array of RGB or RGBA pixels (not %i channels)' % channels
+        raise ValueError(badshape)
+    if channels == 4 and premultiplied:
+        pixels = unpremultiply(pixels)
+
+    scanlines = _filter(np.ascontiguousarray(pixels).reshape(h, w*channels), channels, filter)
+    header = struct.pack('>IIBBBBB', w, h, 8, 6 if channels==4 else 2, 0, 0, 0)
+    notes = [_chunk('tEXt', '%s\0%s' % kv) for kv in sorted((text or {}).items())]
+    return ''.join(['\x89PNG\r\n\x1a\n', _chunk('IHDR', header)] + notes +
+                   [_chunk('IDAT', _deflate(scanlines, level, threads)),
+                    _chunk('IEND', '')])
+
+def _chunk(tag, data):
+    crc = zlib.crc32(data, zlib.crc32(tag)) & 0xffffffff
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', crc)
+
+def _filter(rows, bpp, method):
+    """Prefix each row with a filter-type byte and apply the corresponding filter"""
+    if method != 'adaptive' and method not in FILTERS:
+        badfilter = 'filter must be "adaptive" or one of %s (not %r)' % (", ".join(FILTERS), method)
+        raise ValueError(badfilter)
+
+    h, n = rows.shape
+    out = np.empty((h, n+1), dtype=np.uint8)
+    if method == 'none':
+        out[:, 0] = 0
+        out[:, 1:] = rows
+        return out
+
+    # the neighboring bytes each filter predicts from (with zeros off the top & left edges)
+    x = rows.astype(np.int16)
+    a = np.zeros_like(x); a[:, bpp:] = x[:, :-bpp]       # left
+    b = np.zeros_like(x); b[1:] = x[:-1]                  # up
+    c = np.zeros_like(x); c[1:, bpp:] = x[:-1, :-bpp]     # upper-left
+
+    def paeth():
+        p = a + b - c
+        pa, pb, pc = np.abs(p - a), np.abs(p - b), np.abs(p - c)
+        return np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+    predictors = dict(none=lambda:0, sub=lambda:a, up=lambda:b,
+                      average=lambda:(a + b) >> 1, paeth=paeth)
+
+    if method != 'adaptive':
+        out[:, 0] = FILTERS.index(method)
+        out[:, 1:] = x - predictors[method]()
+        return out
+
+    # try all five and keep the one whose residuals (as signed bytes) are smallest for each row
+    candidates = np.array([(x - predictors[f]()).astype(np.uint8) for f in FILTERS])
+    scores = np.abs(candidates.view(np.int8).astype(np.int32)).sum(axis=2)
+    best = np.argmin(scores, axis=0)
+    out[:, 0] = best
+    out[:, 1:] = candidates[best, np.arange(h)]
+    return out
+
+_pool = None
+_pool_lock = Lock()
+def _workers():
+    # lazily start a single pool of compression threads to be shared by all encode() calls
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(cpu_count())
+            atexit.register(_shutdown)
+    return _pool
+
+def _shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool.join()
+            _pool = None
+
+def _deflate(scanlines, level, threads):
+    """Compress the filtered rows into a zlib stream (in parallel if threads > 1)"""
+    data = scanlines.ravel()
+    rows = len(scanlines)
+    row_bytes = scanlines.shape[1]
+    per_chunk = max(1, CHUNK_SIZE // row_bytes)
+    if threads <= 1 or rows <= per_chunk:
+        return zlib.compress(data.data, level)
+
+    # compress runs of rows as raw deflate streams that are byte-aligned via a sync flush
+    # and can simply be concatenated (with the zlib header and checksum added around them)
+    spans = [(i*row_bytes, min(rows, i+per_chunk)*row_bytes) for i in range(0, rows, per_chunk)]
+    def compress(span):
+        start, end = span
+        z = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        body = z.compress(data[start:end].data)
+        return body + z.flush(zlib.Z_FINISH if end == len(data) else zlib.Z_SYNC_FLUSH)
+
+    bodies = _workers().map(compress, spans)
+    checksum = zlib.adler32(data.data) & 0xffffffff
+    return '\x78\x9c' + ''.join(bodies) + struct.pack('>I', checksum)
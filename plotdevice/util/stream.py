@@ -0,0 +1,122 @@
+# encoding: utf-8
+"""
+stream.py
+
+Writes rendered frames to stdout, a named pipe, or a file as a continuous stream that other
+programs (e.g., ffmpeg or a custom compositor) can consume while the export is still running.
+
+Three framings are supported:
+    rgba - each frame is preceded by a `FRAME <num> <width> <height>\\n' header line and
+           followed by width*height*4 bytes of (non-premultiplied) RGBA pixels
+    y4m  - a YUV4MPEG2 stream (4:4:4, full range) whose per-frame headers carry the frame
+           number as an `Xframe=<num>' parameter (the size is given in the stream header)
+    png  - concatenated png files, each with a `Frame' tEXt chunk holding its number
+
+Writes are blocking so a slow reader will stall the export pipeline (and in turn the renderer)
+rather than having frames pile up in memory or on disk.
+"""
+
+import sys
+import errno
+import numpy as np
+from . import png
+from .gif import unpremultiply
+
+__all__ = ('FrameStream', 'FORMATS')
+
+FORMATS = ('rgba', 'y4m', 'png')
+
+# full-range BT.601 coefficients (as used by jpeg) for the rgb -> y/cb/cr conversion
+_YCBCR = np.array([[ 0.299,     0.587,     0.114   ],
+                   [-0.168736, -0.331264,  0.5     ],
+                   [ 0.5,      -0.418688, -0.081312]], dtype=np.float32)
+_OFFSET = np.array([0.5, 128.5, 128.5], dtype=np.float32) # (with +.5 for rounding)
+
+class FrameStream(object):
+    """Streams encoded frames to a file-like destination
+
+    args:
+        dest - '-' for stdout, or the path to a named pipe or regular file
+        format - 'rgba', 'y4m', or 'png'
+        fps - frame rate advertised in the y4m stream header
+        compression - zlib level for png frames
+
+    Encoding happens in encode() (which is safe to call from multiple threads at once) and
+    the resulting chunks are written in order by addFrame(). The framesWritten(), doneWriting(),
+    and closeFile() methods mirror the interface of the cIO writers.
+    """
+    def __init__(self, dest, format='png', fps=30, compression=6):
+        if format not in FORMATS:
+            raise ValueError('format must be one of %s (not %r)' % (", ".join(FORMATS), format))
+        self.format = format
+        self.fps = fps
+        self.compression = compression
+        self.broken = False # set if the reader hung up on us
+
+        # use the process's real stdout even if sys.stdout is currently being redirected
+        # (n.b. opening a named pipe blocks until the other end has been opened for reading)
+        self._stdout = dest in (None, '-')
+        self._file = sys.__stdout__ if self._stdout else open(dest, 'wb')
+        self._size = None
+        self._written = 0
+        self._done = False
+
+    def encode(self, rgba, num):
+        """Convert an (h,w,4) array of premultiplied RGBA pixels into a framed chunk of bytes"""
+        h, w = rgba.shape[:2]
+        if self.format == 'rgba':
+            pixels = unpremultiply(rgba)
+            body = 'FRAME %i %i %i\n' % (num, w, h) + pixels.tostring()
+        elif self.format == 'y4m':
+            # the premultiplied color channels are already composited against black
+            ycc = np.dot(rgba[..., :3].astype(np.float32), _YCBCR.T) + _OFFSET
+            planes = np.clip(ycc, 0, 255).astype(np.uint8).transpose(2, 0, 1)
+            body = 'FRAME Xframe=%i\n' % num + planes.tostring()
+        elif self.format == 'png':
+            body = png.encode(rgba, level=self.compression, text={'Frame':str(num)})
+        return (w, h), body
+
+    ### cIO-style interface ###
+
+    def addFrame(self, frame):
+        """Write a chunk returned by encode() (blocking until the reader has made room for it)"""
+        size, body = frame
+        if self._size is None:
+            self._size = size
+            if self.format == 'y4m':
+                header = 'YUV4MPEG2 W%i H%i F%i:1 Ip A1:1 C444 XCOLORRANGE=FULL\n' % (size + (self.fps,))
+                self._send(header)
+        elif self._size != size and self.format == 'y4m':
+            raise ValueError('frame size changed from %ix%i to %ix%i' % (self._size+size))
+
+        self._send(body)
+        self._written += 1
+
+    def framesWritten(self):
+        return self._written
+
+    def doneWriting(self):
+        return self._done
+
+    def closeFile(self):
+        if self._done:
+            return
+        try:
+            self._file.flush()
+            if not self._stdout:
+                self._file.close()
+        except IOError, e:
+            if e.errno != errno.EPIPE:
+                raise
+        self._done = True
+
+    def _send(self, data):
+        if self.broken:
+            return
+        try:
+            self._file.write(data)
+            self._file.flush()
+        except IOError, e:
+            if e.errno != errno.EPIPE:
+                raise
+            self.broken = True